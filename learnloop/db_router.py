@@ -0,0 +1,96 @@
+"""
+Primary/replica database routing.
+
+Every write goes to ``default``, the primary. Reads go there too, except
+inside views decorated with ``@replica_reads`` (the catalog pages), whose
+queries are sent to the alias named by ``DATABASE_READ_REPLICA``. Leaving
+that setting empty sends everything to the primary.
+
+A replica lags the primary a little, so someone who has just liked,
+commented or paid would not see it there. ``ReplicaStickinessMiddleware``
+pins a client to the primary for ``DATABASE_REPLICA_STICKY_SECONDS``
+after any request that can write (anything but GET/HEAD/OPTIONS), using a
+short-lived cookie. Parts of a replica view that depend on the viewer's
+own writes can also read the primary explicitly with ``primary()``.
+"""
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = 'db_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+# 'replica' while a @replica_reads view runs, 'primary' inside primary()
+_reads_from = ContextVar('reads_from', default='primary')
+
+
+def replica_alias():
+    """The configured replica alias, or None to read from the primary."""
+    alias = getattr(settings, 'DATABASE_READ_REPLICA', None)
+    return alias if alias and alias in settings.DATABASES else None
+
+
+@contextmanager
+def _reading_from(source):
+    token = _reads_from.set(source)
+    try:
+        yield
+    finally:
+        _reads_from.reset(token)
+
+
+def primary():
+    """Read from the primary for the duration of the ``with`` block."""
+    return _reading_from('primary')
+
+
+def replica_reads(view):
+    """Send a view's reads to the replica, unless the client is pinned to the primary."""
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if getattr(request, 'pinned_to_primary', False):
+            return view(request, *args, **kwargs)
+        with _reading_from('replica'):
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        alias = replica_alias()
+        if alias is None or _reads_from.get() != 'replica':
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            # Reads inside a transaction must see its own writes
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replica rows are copies of primary rows, so they can be related freely
+        databases = {DEFAULT_DB_ALIAS, replica_alias()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class ReplicaStickinessMiddleware:
+    """Keep clients that just wrote something reading from the primary for a while."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.pinned_to_primary = PIN_COOKIE in request.COOKIES or request.method not in SAFE_METHODS
+        response = self.get_response(request)
+        if request.method not in SAFE_METHODS:
+            response.set_cookie(
+                PIN_COOKIE, '1', max_age=getattr(settings, 'DATABASE_REPLICA_STICKY_SECONDS', 10),
+                httponly=True, samesite='Lax',
+            )
+        return response
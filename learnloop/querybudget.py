@@ -0,0 +1,211 @@
+"""
+Per-request SQL query budgets and N+1 detection.
+
+``QueryBudgetMiddleware`` records every query a request runs, groups them
+by SQL shape and flags shapes that repeat (the usual sign of an N+1),
+pointing at the template line that triggered them when there is one.
+Budgets are declared per URL name in ``settings.QUERY_BUDGETS``; the
+result goes into ``X-Query-*`` response headers and a log line, and with
+``QUERY_BUDGET_STRICT`` an exceeded budget raises instead.
+
+Views that deliberately repeat a query (long polls) can opt out with
+``@query_budget_exempt``. In tests, use ``QueryBudgetTestMixin.assertWithinQueryBudget(response)``
+or the ``query_budget()`` context manager.
+"""
+import logging
+import re
+import sys
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# A shape repeated this many times in one request is reported as an N+1
+N_PLUS_ONE_THRESHOLD = 3
+
+_IN_LIST = re.compile(r'IN \((?:%s|\?)(?:, (?:%s|\?))*\)')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+\b')
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def sql_shape(sql):
+    """Normalize SQL so queries that differ only by parameters compare equal."""
+    shape = _IN_LIST.sub('IN (...)', sql)
+    shape = _STRING.sub('?', shape)
+    shape = _NUMBER.sub('?', shape)
+    return shape
+
+
+def _template_location():
+    """Return ``template.html:line`` for the template node being rendered, if any."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        if frame.f_code.co_name == 'render_annotated':
+            node = frame.f_locals.get('self')
+            origin = getattr(node, 'origin', None)
+            token = getattr(node, 'token', None)
+            if origin is not None and token is not None:
+                return f"{origin.template_name}:{token.lineno}"
+        frame = frame.f_back
+    return None
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql,
+                'alias': context['connection'].alias,
+                'time': time.perf_counter() - started,
+                'template': _template_location(),
+            })
+
+    @contextmanager
+    def capture(self):
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self))
+            yield self
+
+    def report(self, label=None, budget=None):
+        return QueryReport(self.queries, label=label, budget=budget)
+
+
+class QueryReport:
+    def __init__(self, queries, label=None, budget=None):
+        self.queries = queries
+        self.label = label
+        self.budget = budget
+
+        shapes = defaultdict(list)
+        for query in queries:
+            shapes[sql_shape(query['sql'])].append(query)
+        self.repeated = {
+            shape: matches for shape, matches in shapes.items()
+            if len(matches) >= N_PLUS_ONE_THRESHOLD
+        }
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(query['time'] for query in self.queries)
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and self.count > self.budget
+
+    def n_plus_one(self):
+        """Yield ``(shape, times, template_locations)`` for each repeated query shape."""
+        for shape, matches in sorted(self.repeated.items(), key=lambda item: -len(item[1])):
+            locations = sorted({query['template'] for query in matches if query['template']})
+            yield shape, len(matches), locations
+
+    def summary(self):
+        budget = f"/{self.budget}" if self.budget is not None else ''
+        line = f"{self.label or 'request'}: {self.count}{budget} queries in {self.total_time * 1000:.1f}ms"
+        if self.repeated:
+            line += f", {len(self.repeated)} repeated shape(s)"
+        return line
+
+    def details(self):
+        lines = [self.summary()]
+        for shape, times, locations in self.n_plus_one():
+            where = f" from {', '.join(locations)}" if locations else ''
+            lines.append(f"  {times}x {shape[:200]}{where}")
+        return '\n'.join(lines)
+
+
+def budget_for(url_name):
+    return getattr(settings, 'QUERY_BUDGETS', {}).get(url_name)
+
+
+def query_budget_exempt(view_func):
+    """Mark a view as exempt from query budgets and N+1 reporting."""
+    view_func.query_budget_exempt = True
+    return view_func
+
+
+def _is_exempt(request):
+    match = getattr(request, 'resolver_match', None)
+    return match is not None and getattr(match.func, 'query_budget_exempt', False)
+
+
+def _url_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else None
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not getattr(settings, 'QUERY_BUDGET_ENABLED', settings.DEBUG):
+            return self.get_response(request)
+
+        recorder = QueryRecorder()
+        with recorder.capture():
+            response = self.get_response(request)
+        if _is_exempt(request):
+            return response
+
+        url_name = _url_name(request)
+        report = recorder.report(label=url_name or request.path, budget=budget_for(url_name))
+        response.query_report = report
+
+        response['X-Query-Count'] = str(report.count)
+        if report.budget is not None:
+            response['X-Query-Budget'] = str(report.budget)
+        if report.repeated:
+            response['X-Query-Repeated'] = str(sum(times for _, times, _ in report.n_plus_one()))
+
+        if report.over_budget or report.repeated:
+            logger.warning(report.details())
+        else:
+            logger.debug(report.summary())
+
+        if report.over_budget and getattr(settings, 'QUERY_BUDGET_STRICT', False):
+            raise QueryBudgetExceeded(report.details())
+        return response
+
+
+@contextmanager
+def query_budget(budget, label=None):
+    """Fail with the query report if the block runs more than ``budget`` queries."""
+    recorder = QueryRecorder()
+    with recorder.capture():
+        yield recorder
+    report = recorder.report(label=label, budget=budget)
+    if report.over_budget:
+        raise QueryBudgetExceeded(report.details())
+
+
+class QueryBudgetTestMixin:
+    """TestCase mixin for checking responses against ``settings.QUERY_BUDGETS``."""
+
+    def assertWithinQueryBudget(self, response, budget=None, allow_repeated=False):
+        report = getattr(response, 'query_report', None)
+        if report is None:
+            self.fail("Response has no query report; is QueryBudgetMiddleware enabled?")
+        budget = budget if budget is not None else report.budget
+        if budget is not None and report.count > budget:
+            self.fail(f"Query budget exceeded ({report.count} > {budget})\n{report.details()}")
+        if not allow_repeated and report.repeated:
+            self.fail(f"Repeated queries (N+1)\n{report.details()}")
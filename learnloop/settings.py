@@ -46,7 +46,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'learnloop.querybudget.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'learnloop.db_router.ReplicaStickinessMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -79,13 +81,41 @@ WSGI_APPLICATION = 'learnloop.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# learnloop.sqlite_backend is Django's SQLite backend plus WAL/cache pragmas on every
+# connection and jittered retries when the database is locked. IMMEDIATE transactions
+# take the write lock up front; write_queue runs one-statement writes of this process
+# one at a time. Measure changes with manage.py bench_sqlite.
+SQLITE_OPTIONS = {
+    'transaction_mode': 'IMMEDIATE',
+    'timeout': 2,  # seconds SQLite itself waits for a lock before the backend retries
+    'busy_retries': 5,
+    'busy_backoff': 0.05,  # seconds, doubled per retry, jittered
+    'write_queue': True,
+    # 'pragmas': {'synchronous': 'FULL'},  # overrides for learnloop.sqlite_backend.base.PRAGMAS
+}
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'learnloop.sqlite_backend',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'OPTIONS': SQLITE_OPTIONS,
+    },
+    # Read replica of default (kept in sync outside Django, e.g. by Litestream or LiteFS).
+    # Without REPLICA_DATABASE_PATH it is just a second connection to the same file.
+    'replica': {
+        'ENGINE': 'learnloop.sqlite_backend',
+        'NAME': os.getenv('REPLICA_DATABASE_PATH', BASE_DIR / 'db.sqlite3'),
+        'OPTIONS': SQLITE_OPTIONS,
+        'TEST': {'MIRROR': 'default'},
+    },
 }
 
+# Catalog pages read from DATABASE_READ_REPLICA; everything else uses default (learnloop.db_router).
+# A client that writes is pinned to the primary for DATABASE_REPLICA_STICKY_SECONDS.
+DATABASE_ROUTERS = ['learnloop.db_router.PrimaryReplicaRouter']
+DATABASE_READ_REPLICA = 'replica' if os.getenv('REPLICA_DATABASE_PATH') else None
+DATABASE_REPLICA_STICKY_SECONDS = 10
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -129,6 +159,28 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Loop attachments are served by the loop_attachment view after an access check (loops.delivery).
+# Set to 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache/lighttpd) to let the
+# front-end server send the file; None streams it from Django.
+LOOP_ATTACHMENT_SENDFILE = None
+LOOP_ATTACHMENT_ACCEL_PREFIX = '/protected-media/'  # internal nginx location aliased to MEDIA_ROOT
+
+# Resumable chunked attachment uploads (loops.uploads); clear out abandoned ones with manage.py clean_uploads
+LOOP_UPLOAD_DIR = BASE_DIR / 'var' / 'uploads'  # keep on the same filesystem as MEDIA_ROOT so files are moved, not copied
+LOOP_UPLOAD_CHUNK_SIZE = 1024 * 1024  # bytes per PUT
+LOOP_UPLOAD_MAX_SIZE = 500 * 1024 * 1024  # bytes
+LOOP_UPLOAD_EXPIRY = 24 * 60 * 60  # seconds an unfinished or unused upload is kept
+
+# Attachments are stored once per content (loops.blobs); run manage.py sweep_attachments
+# periodically to delete files no loop has referenced for LOOP_BLOB_GRACE seconds
+LOOP_BLOB_GRACE = 24 * 60 * 60
+
+# Attachment previews for loop cards (loops.previews); backfill with manage.py generate_previews.
+# PDF and video previews need pdftoppm (poppler-utils) and ffmpeg on the PATH.
+LOOP_PREVIEW_SIZE = (640, 360)  # max width, height in pixels
+LOOP_PREVIEW_WORKERS = 2
+LOOP_PREVIEW_ASYNC = True  # render in a background thread after the loop is saved
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -179,4 +231,69 @@ MPESA_INITIATOR_USERNAME = 'initiator_username'
 
 # Plaintext password for initiator (to be used in B2C, B2B, AccountBalance and TransactionStatusQuery Transactions)
 
-MPESA_INITIATOR_SECURITY_CREDENTIAL = 'initiator_security_credential'
\ No newline at end of file
+MPESA_INITIATOR_SECURITY_CREDENTIAL = 'initiator_security_credential'
+
+# Loop view counting
+# Views are buffered in memory and written back in batches
+LOOP_VIEWS_BUFFERED = True
+LOOP_VIEWS_FLUSH_INTERVAL = 5  # seconds
+LOOP_VIEWS_FLUSH_THRESHOLD = 500  # pending views
+
+# Show "about N loops" totals on listing pages (counts are cached for a few minutes)
+LOOP_LIST_ESTIMATE_TOTALS = True
+
+# Comments shown on the detail page and per "Load older comments" request
+LOOP_COMMENTS_PER_PAGE = 20
+
+# Per-view SQL query budgets (by URL name), checked by QueryBudgetMiddleware.
+# The middleware runs when DEBUG is on; QUERY_BUDGET_STRICT makes overruns raise.
+QUERY_BUDGET_ENABLED = DEBUG
+QUERY_BUDGET_STRICT = False
+QUERY_BUDGETS = {
+    'loops_list': 6,
+    'category': 6,
+    'my_loops': 6,
+    'loop_detail': 10,
+    'loop_comments': 3,
+    'like_loop': 8,
+    'payments:initiate': 7,
+    'payments:pending': 4,
+    'payments:mpesa_callback': 2,
+}
+
+# Daraja API client (payments.gateway)
+MPESA_API_BASE_URL = os.getenv('MPESA_API_BASE_URL', 'https://sandbox.safaricom.co.ke')
+MPESA_CALLBACK_URL = os.getenv('MPESA_CALLBACK_URL', 'https://api.darajambili.com/express-payment')
+MPESA_CONNECT_TIMEOUT = 3.05  # seconds
+MPESA_READ_TIMEOUT = 10  # seconds
+MPESA_POOL_SIZE = 10  # pooled HTTP connections per process
+MPESA_MAX_CONCURRENCY = 4  # Daraja calls in flight per process
+MPESA_BULKHEAD_WAIT = 0.5  # seconds to wait for a free slot before giving up
+
+# Payment job queue and callback inbox (payments.jobs and payments.callbacks,
+# both run by manage.py run_payment_worker)
+PAYMENT_JOB_MAX_ATTEMPTS = 5
+PAYMENT_JOB_RETRY_BASE = 2  # seconds, doubled on every retry
+PAYMENT_JOB_RETRY_MAX = 300  # seconds
+PAYMENT_JOB_LEASE = 60  # seconds before a claimed job is handed to another worker
+PAYMENT_STATUS_MAX_WAIT = 20  # longest long-poll on payments:status, in seconds
+PAYMENT_STATUS_POLL_INTERVAL = 1  # seconds between checks during a long poll
+PAYMENT_CALLBACK_BATCH_SIZE = 500  # inbox rows applied per transaction
+PAYMENT_CALLBACK_ORPHAN_GRACE = 300  # seconds to wait for an unknown CheckoutRequestID to appear
+PAYMENT_RECONCILE_AFTER = 600  # seconds a payment stays Pending before reconcile_payments queries it
+PAYMENT_UNSENT_EXPIRY = 24 * 3600  # seconds before a Pending payment that was never pushed is failed
+
+# Anonymous page cache (loops.page_cache)
+LOOP_PAGE_CACHE_ENABLED = True
+LOOP_PAGE_CACHE_FRESH = 30  # seconds a cached page is served without re-rendering
+LOOP_PAGE_CACHE_STALE = 300  # further seconds a stale page may be served while it re-renders
+LOOP_PAGE_CACHE_LOCK_TIMEOUT = 30  # seconds
+
+# Similar loops (loops.similarity); rebuild nightly with manage.py rebuild_similarity
+LOOP_SIMILARITY_PATH = BASE_DIR / 'var' / 'similarity.npz'
+LOOP_SIMILARITY_TOP_K = 10
+LOOP_SIMILARITY_ASYNC = True  # update neighbours of saved loops in a background thread
+
+# Trending score (loops.trending); renormalize daily with manage.py renormalize_trending
+LOOP_TRENDING_HALF_LIFE = 24 * 60 * 60  # seconds
+LOOP_TRENDING_WEIGHTS = {'view': 1.0, 'like': 5.0, 'comment': 8.0, 'purchase': 20.0}
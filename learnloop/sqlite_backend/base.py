@@ -0,0 +1,166 @@
+"""
+Django's SQLite backend tuned for several workers sharing one database file.
+
+Every new connection gets the pragmas in ``PRAGMAS`` (WAL journal,
+``synchronous=NORMAL``, a memory-mapped file and a larger page cache),
+overridable per database with ``OPTIONS['pragmas']``. WAL lets readers
+carry on while one writer commits; pair it with
+``OPTIONS['transaction_mode'] = 'IMMEDIATE'`` so transactions take the
+write lock when they begin rather than failing half way through.
+
+A statement (or ``BEGIN``) that still finds the database locked once
+SQLite's own busy timeout has run out is retried outside a transaction up
+to ``OPTIONS['busy_retries']`` times, sleeping a jittered, doubling delay
+starting at ``OPTIONS['busy_backoff']`` seconds, so workers that collided
+don't all retry at the same moment.
+
+With ``OPTIONS['write_queue']``, single write statements run outside a
+transaction (view counts, like toggles, callback inserts) take turns
+through a first-come first-served queue per database file, so threads in
+one process wait for each other in order instead of polling SQLite's lock.
+
+``manage.py bench_sqlite`` measures the mixed read/write throughput.
+"""
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db.backends.sqlite3 import base
+
+Database = base.Database
+
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # negative: KiB rather than pages
+    'temp_store': 'MEMORY',
+}
+# Pragmas that do nothing useful (or can't be set) on an in-memory database
+FILE_ONLY_PRAGMAS = {'journal_mode', 'mmap_size'}
+
+BUSY_RETRIES = 5
+BUSY_BACKOFF = 0.05  # seconds before the first retry
+BUSY_BACKOFF_MAX = 2.0
+
+_WRITE_STATEMENT = re.compile(r'^\s*(INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+_BUSY_MESSAGES = ('database is locked', 'database is busy')
+
+stats = {'busy_retries': 0, 'busy_failures': 0, 'queued_writes': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        stats[name] += 1
+
+
+def is_busy_error(exc):
+    return (
+        (getattr(exc, 'sqlite_errorname', None) or '').startswith('SQLITE_BUSY')
+        or str(exc).lower().startswith(_BUSY_MESSAGES)
+    )
+
+
+class WriteQueue:
+    """Lets threads run their write statements one at a time, in arrival order."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+
+    @contextmanager
+    def turn(self):
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while ticket != self._serving:
+                self._condition.wait()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._serving += 1
+                self._condition.notify_all()
+
+
+_write_queues = {}
+_write_queues_lock = threading.Lock()
+
+
+def write_queue(name):
+    """The process-wide queue for database file ``name``."""
+    with _write_queues_lock:
+        return _write_queues.setdefault(str(name), WriteQueue())
+
+
+class CursorWrapper(base.SQLiteCursorWrapper):
+    # Set by DatabaseWrapper.create_cursor
+    retries = BUSY_RETRIES
+    backoff = BUSY_BACKOFF
+    queue = None
+
+    def execute(self, query, params=None):
+        return self._run(super().execute, query, params)
+
+    def executemany(self, query, param_list):
+        return self._run(super().executemany, query, param_list)
+
+    def _run(self, method, query, params):
+        # Inside a transaction a failed statement can't simply be repeated:
+        # the lock belongs to the transaction, and Django rolls it back.
+        outside_transaction = not self.connection.in_transaction
+        if self.queue is not None and outside_transaction and _WRITE_STATEMENT.match(query):
+            _count('queued_writes')
+            with self.queue.turn():
+                return self._retrying(method, query, params, outside_transaction)
+        return self._retrying(method, query, params, outside_transaction)
+
+    def _retrying(self, method, query, params, may_retry):
+        delay = self.backoff
+        attempt = 0
+        while True:
+            try:
+                return method(query, params)
+            except Database.OperationalError as exc:
+                if not (may_retry and is_busy_error(exc)) or attempt >= self.retries:
+                    if is_busy_error(exc):
+                        _count('busy_failures')
+                    raise
+            attempt += 1
+            _count('busy_retries')
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, BUSY_BACKOFF_MAX)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        options = self.settings_dict['OPTIONS']
+        self.pragmas = {**PRAGMAS, **options.get('pragmas', {})}
+        self.busy_retries = options.get('busy_retries', BUSY_RETRIES)
+        self.busy_backoff = options.get('busy_backoff', BUSY_BACKOFF)
+        self.write_queue = write_queue(self.settings_dict['NAME']) if options.get('write_queue') else None
+
+        kwargs = super().get_connection_params()
+        for name in ('pragmas', 'busy_retries', 'busy_backoff', 'write_queue'):
+            kwargs.pop(name, None)
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        in_memory = self.is_in_memory_db()
+        for name, value in self.pragmas.items():
+            if in_memory and name in FILE_ONLY_PRAGMAS:
+                continue
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def create_cursor(self, name=None):
+        cursor = self.connection.cursor(factory=CursorWrapper)
+        cursor.retries = self.busy_retries
+        cursor.backoff = self.busy_backoff
+        cursor.queue = self.write_queue
+        return cursor
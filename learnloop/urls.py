@@ -16,14 +16,22 @@ Including another URLconf
 """
 
 
+import re
+
 from django.contrib import admin
-from django.urls import path, include
+from django.http import Http404
+from django.urls import path, include, re_path
 from django.conf import settings
 from django.conf.urls.static import static
 from django.views.generic import RedirectView
 from django.contrib.auth import views as auth_views
 from users.views import register_view  
 
+
+def _not_found(request):
+    raise Http404
+
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', RedirectView.as_view(url='/loops/', permanent=True), name='home'),
@@ -38,5 +46,7 @@ urlpatterns = [
 ]
 
 if settings.DEBUG:
+    # Attachments only go out through the loop_attachment view, which checks access
+    urlpatterns += [re_path(r'^%sloop_attachments/' % re.escape(settings.MEDIA_URL.lstrip('/')), _not_found)]
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
\ No newline at end of file
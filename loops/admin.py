@@ -1,9 +1,22 @@
-
 from django.contrib import admin
+from .forms import LoopForm
 from .models import Loop
 
+class LoopAdminForm(LoopForm):
+    # LoopForm saves the lesson body through Loop.content, so LoopBody and the search index follow
+    class Meta(LoopForm.Meta):
+        widgets = {}
+
 class LoopAdmin(admin.ModelAdmin):
+    form = LoopAdminForm
     list_display = ['title', 'creator', 'category', 'difficulty', 'created_at']
     list_filter = ['category', 'difficulty', 'created_at']
+    fields = ['title', 'creator', 'category', 'difficulty', 'description', 'content', 'video_url',
+              'attachment', 'is_premium', 'price', 'is_purchased_by',
+              'views', 'likes_count', 'comments_count']
+    # Kept up to date by F() updates elsewhere; a full save doesn't write them
+    readonly_fields = ['views', 'likes_count', 'comments_count']
+    raw_id_fields = ['creator']
+    filter_horizontal = ['is_purchased_by']
 
-admin.site.register(Loop)
\ No newline at end of file
+admin.site.register(Loop, LoopAdmin)
@@ -0,0 +1,115 @@
+"""
+Helpers for the load benchmarks (``manage.py run_benchmarks``).
+
+A scenario is a callable taking ``(client, rng)`` that issues one request
+and returns the response. ``run_scenario`` drives it from several threads,
+each with its own test client and database connection, and collects
+latency, throughput and queries-per-request.
+"""
+import json
+import random
+import statistics
+import threading
+import time
+
+from django.db import connection
+from django.test import Client
+
+from learnloop.querybudget import QueryRecorder
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = (len(ordered) - 1) * pct / 100
+    lower = int(index)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (index - lower)
+
+
+def run_scenario(scenario, concurrency, requests, setup_client=None, seed=None):
+    """Run ``requests`` calls of ``scenario`` split across ``concurrency`` threads."""
+    latencies, queries, errors = [], [], []
+    lock = threading.Lock()
+    per_thread = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+
+    def worker(index, count):
+        rng = random.Random(None if seed is None else seed + index)
+        client = Client(HTTP_HOST='localhost')
+        try:
+            if setup_client:
+                setup_client(client, index)
+            for _ in range(count):
+                recorder = QueryRecorder()
+                started = time.perf_counter()
+                try:
+                    with recorder.capture():
+                        response = scenario(client, rng)
+                    failed = response.status_code >= 400
+                except Exception as exc:
+                    failed, response = repr(exc), None
+                elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+                    queries.append(len(recorder.queries))
+                    if failed:
+                        errors.append(failed if isinstance(failed, str) else response.status_code)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker, args=(i, count)) for i, count in enumerate(per_thread) if count]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    return {
+        'requests': len(latencies),
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'throughput': round(len(latencies) / wall, 2) if wall else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'queries_per_request': round(statistics.mean(queries), 2) if queries else 0.0,
+        'max_queries': max(queries, default=0),
+    }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compare scenario results against a baseline.
+
+    Returns a list of ``(scenario, metric, baseline_value, value)`` for every
+    metric that got worse by more than ``tolerance`` (queries: half a query
+    per request or more).
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if base[metric] and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append((name, metric, base[metric], result[metric]))
+        if base['throughput'] and result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append((name, 'throughput', base['throughput'], result['throughput']))
+        if result['queries_per_request'] >= base['queries_per_request'] + 0.5:
+            regressions.append((name, 'queries_per_request', base['queries_per_request'], result['queries_per_request']))
+        if result['errors'] > base['errors']:
+            regressions.append((name, 'errors', base['errors'], result['errors']))
+    return regressions
+
+
+def load_json(path):
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def dump_json(data, path):
+    with open(path, 'w') as handle:
+        json.dump(data, handle, indent=2, sort_keys=True)
+        handle.write('\n')
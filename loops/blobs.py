@@ -0,0 +1,306 @@
+"""
+Content-addressed, reference-counted attachment storage.
+
+``BlobStorage`` stores every attachment under its SHA-256
+(``loop_attachments/ab/cd/abcd….pdf``), so a file uploaded by many
+creators, or re-uploaded on every edit, is kept once; the name the creator
+uploaded is kept in ``Loop.attachment_name``. Each stored file has an
+``AttachmentBlob`` row counting the loops that point at it, kept up to
+date by ``Loop.save`` and the loop post_delete signal (``retain`` and
+``release``).
+
+Nothing is deleted when the count reaches zero: ``sweep()``
+(``manage.py sweep_attachments``) removes blobs that have been
+unreferenced for ``LOOP_BLOB_GRACE`` seconds, after checking no loop has
+picked them up again. Storing a file (new or a duplicate) restarts its
+blob's grace period, so the sweep can't delete it between the upload and
+the loop save that retains it. ``manage.py dedupe_attachments`` moves
+files saved before this storage existed into it.
+"""
+import hashlib
+import os
+import posixpath
+import re
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import models, transaction
+from django.db.models import Case, Count, F, Value, When
+from django.db.models.fields.files import FieldFile
+from django.utils import timezone
+
+BLOCK_SIZE = 64 * 1024
+
+
+def digest_name(directory, sha256, filename):
+    _, ext = os.path.splitext(filename or '')
+    # Keep short, plain extensions so downloads and front-end servers get the type right
+    ext = ext.lower() if len(ext) <= 10 and ext[1:].isalnum() else ''
+    return posixpath.join(directory, sha256[:2], sha256[2:4], f'{sha256}{ext}')
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class BlobStorage(FileSystemStorage):
+    """A FileSystemStorage that names files by their content and stores each content once."""
+
+    def get_available_name(self, name, max_length=None):
+        # _save picks the real (content-derived) name, and an existing file is the point
+        return name
+
+    def _save(self, name, content):
+        directory = posixpath.dirname(name)
+        if hasattr(content, 'temporary_file_path'):
+            source = content.temporary_file_path()
+            sha256 = getattr(content, 'sha256', None) or file_sha256(source)
+            blob = digest_name(directory, sha256, name)
+            if not self._claim(blob):
+                self._ensure_directory(blob)
+                file_move_safe(source, self.path(blob), allow_overwrite=True)
+                self._finish(blob)
+            return blob
+
+        # Hash while writing to a temporary name, then move it into place (or drop it as a duplicate)
+        self._ensure_directory(name)
+        tmp = self.path(posixpath.join(directory, f'.{uuid.uuid4().hex}.tmp'))
+        digest = hashlib.sha256()
+        try:
+            with open(tmp, 'wb') as f:
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    f.write(chunk)
+            blob = digest_name(directory, digest.hexdigest(), name)
+            if self._claim(blob):
+                os.remove(tmp)
+            else:
+                self._ensure_directory(blob)
+                os.replace(tmp, self.path(blob))
+                self._finish(blob)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return blob
+
+    def _claim(self, name):
+        """
+        Restart the grace period of an existing blob ``name`` so the sweep
+        leaves it for the loop about to reference it. False when there's
+        no such blob (or its file is gone) and the file must be written.
+        """
+        from .models import AttachmentBlob
+
+        # Waits for a sweep deleting this row to finish, then finds nothing
+        claimed = AttachmentBlob.objects.filter(name=name).update(
+            released_at=Case(When(ref_count=0, then=Value(timezone.now())), default=None),
+        )
+        return bool(claimed) and self.exists(name)
+
+    def _ensure_directory(self, name):
+        os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+
+    def _finish(self, name):
+        from .models import AttachmentBlob
+
+        if self.file_permissions_mode is not None:
+            os.chmod(self.path(name), self.file_permissions_mode)
+        # Unreferenced until the loop is saved, so a failed save is swept after the grace period
+        AttachmentBlob.objects.get_or_create(
+            name=name, defaults={'size': self.size(name), 'released_at': timezone.now()},
+        )
+
+
+_storage = BlobStorage()
+
+
+def attachment_storage():
+    """Storage for ``Loop.attachment`` (a callable, so migrations don't capture the instance)."""
+    return _storage
+
+
+class AttachmentFieldFile(FieldFile):
+    def save(self, name, content, save=True):
+        # The stored name is a hash; remember what the file was called
+        setattr(self.instance, self.field.name_field, os.path.basename(name)[:255])
+        super().save(name, content, save)
+
+
+class AttachmentField(models.FileField):
+    """A FileField that records the uploaded file name in ``name_field``."""
+    attr_class = AttachmentFieldFile
+
+    def __init__(self, *args, name_field='attachment_name', **kwargs):
+        self.name_field = name_field
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['name_field'] = self.name_field
+        return name, path, args, kwargs
+
+
+# --- Reference counting ---
+
+def retain(name):
+    """Count one more loop pointing at blob ``name``."""
+    from .models import AttachmentBlob
+
+    if not name:
+        return
+    updated = AttachmentBlob.objects.filter(name=name).update(ref_count=F('ref_count') + 1, released_at=None)
+    if not updated:
+        storage = attachment_storage()
+        size = storage.size(name) if storage.exists(name) else 0
+        blob, created = AttachmentBlob.objects.get_or_create(name=name, defaults={'ref_count': 1, 'size': size})
+        if not created:
+            # Created concurrently between the update and here
+            AttachmentBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1, released_at=None)
+
+
+def release(name):
+    """Count one fewer loop pointing at blob ``name``; at zero it becomes eligible for the sweep."""
+    from .models import AttachmentBlob
+
+    if not name:
+        return
+    AttachmentBlob.objects.filter(name=name, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+    AttachmentBlob.objects.filter(name=name, ref_count=0, released_at__isnull=True).update(released_at=timezone.now())
+
+
+def recount():
+    """Rebuild every blob's count from the loops. Returns the number of blobs counted."""
+    from .models import AttachmentBlob, Loop
+
+    counts = dict(
+        Loop.objects.exclude(attachment='').exclude(attachment__isnull=True)
+        .order_by().values_list('attachment').annotate(n=Count('pk'))
+    )
+    storage = attachment_storage()
+    for name in counts.keys() - set(AttachmentBlob.objects.values_list('name', flat=True)):
+        size = storage.size(name) if storage.exists(name) else 0
+        AttachmentBlob.objects.get_or_create(name=name, defaults={'size': size})
+
+    now = timezone.now()
+    for blob in AttachmentBlob.objects.all().iterator():
+        count = counts.get(blob.name, 0)
+        if blob.ref_count != count or (count == 0) != (blob.released_at is not None):
+            blob.ref_count = count
+            blob.released_at = (blob.released_at or now) if count == 0 else None
+            blob.save(update_fields=['ref_count', 'released_at'])
+    return len(counts)
+
+
+def sweep(grace=None):
+    """Delete blobs unreferenced for longer than ``grace``. Returns ``(files, bytes)`` removed."""
+    from . import previews
+    from .models import AttachmentBlob, Loop
+
+    if grace is None:
+        grace = timedelta(seconds=getattr(settings, 'LOOP_BLOB_GRACE', 24 * 60 * 60))
+    storage = attachment_storage()
+    removed = freed = 0
+    cutoff = timezone.now() - grace
+    candidates = AttachmentBlob.objects.filter(ref_count=0, released_at__lt=cutoff)
+    for blob in candidates.iterator():
+        if Loop.objects.filter(attachment=blob.name).exists():
+            # A count went wrong somewhere; trust the loops
+            recount()
+            continue
+        # Only delete the row if it's still unreferenced and unclaimed, so a concurrent
+        # retain() or upload wins; the file goes in the same transaction, which an
+        # upload's claim waits for
+        with transaction.atomic():
+            deleted, _ = AttachmentBlob.objects.filter(pk=blob.pk, ref_count=0, released_at__lt=cutoff).delete()
+            if deleted:
+                storage.delete(blob.name)
+        if deleted:
+            default_storage.delete(previews.preview_name(blob.name))
+            removed += 1
+            freed += blob.size
+
+    # Files with no row at all: a loop save that failed after storing, or leftovers from before blobs
+    referenced = set(AttachmentBlob.objects.values_list('name', flat=True))
+    referenced.update(Loop.objects.exclude(attachment='').values_list('attachment', flat=True))
+    for name, size in _stored_files(storage, cutoff.timestamp()):
+        if name not in referenced:
+            storage.delete(name)
+            removed += 1
+            freed += size
+    return removed, freed
+
+
+def _stored_files(storage, older_than):
+    """``(name, size)`` of files under the attachment directory last modified before ``older_than``."""
+    from .models import Loop
+
+    root = Loop._meta.get_field('attachment').upload_to.strip('/')
+    top = storage.path(root)
+    for directory, _, files in os.walk(top):
+        for filename in files:
+            path = os.path.join(directory, filename)
+            stat = os.stat(path)
+            if stat.st_mtime < older_than:
+                name = posixpath.join(root, os.path.relpath(path, top).replace(os.sep, '/'))
+                yield name, stat.st_size
+
+
+_BLOB_NAME = re.compile(r'/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}(\.[a-z0-9]+)?$')
+
+
+def adopt_existing(dry_run=False, progress=None):
+    """
+    Move attachments stored under their upload names into the content-addressed
+    layout, merging duplicates, then recount references. Returns
+    ``(files moved, duplicates merged, bytes freed)``.
+    """
+    from .models import Loop
+
+    storage = attachment_storage()
+    root = Loop._meta.get_field('attachment').upload_to.strip('/')
+    adopted = {}  # old name -> blob name
+    moved = merged = freed = 0
+
+    loops = Loop.objects.exclude(attachment='').exclude(attachment__isnull=True).only('pk', 'attachment', 'attachment_name')
+    for loop in loops.iterator():
+        old = loop.attachment.name
+        if _BLOB_NAME.search(old):
+            continue
+        if old not in adopted:
+            if not storage.exists(old):
+                if progress:
+                    progress(f"loop {loop.pk}: {old} is missing, skipped")
+                continue
+            path = storage.path(old)
+            blob = digest_name(root, file_sha256(path), old)
+            if storage.exists(blob):
+                merged += 1
+                freed += os.path.getsize(path)
+                if not dry_run:
+                    os.remove(path)
+            else:
+                moved += 1
+                if not dry_run:
+                    storage._ensure_directory(blob)
+                    os.replace(path, storage.path(blob))
+            adopted[old] = blob
+            if progress:
+                progress(f"loop {loop.pk}: {old} -> {blob}")
+        if not dry_run:
+            Loop.objects.filter(pk=loop.pk).update(
+                attachment=adopted[old], attachment_name=loop.attachment_name or os.path.basename(old)[:255],
+            )
+
+    if not dry_run:
+        recount()
+    return moved, merged, freed
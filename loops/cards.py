@@ -0,0 +1,99 @@
+"""
+Cached loop cards.
+
+A card's HTML is cached per loop under a key that includes
+``Loop.card_version``, which is bumped whenever anything the card shows
+changes (an edit, a like, a comment), so stale cards are never looked up
+again and simply expire. A whole page of cards is fetched with one
+``cache.get_many`` and the misses are stored with one ``set_many``.
+
+The cached HTML is the same for everybody. The parts that depend on the
+viewer (the Access/Buy button) or change on every hit (the view count) are
+left as markers in the fragment and filled in per request.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+
+# Bump when the card templates change so old fragments aren't served
+FRAGMENT_VERSION = 2
+CACHE_KEY = 'loopcard:{variant}:{version}:{pk}:{card_version}'
+CACHE_TIMEOUT = getattr(settings, 'LOOP_CARD_CACHE_TIMEOUT', 24 * 60 * 60)
+
+TEMPLATES = {
+    'card': 'loops/_loop_card.html',
+    'compact': 'loops/_loop_card_compact.html',
+}
+
+# Columns the listings read: the card templates' fields plus what the pages
+# sort and paginate on. Everything else (attachment, video, ...) stays deferred.
+CARD_COLUMNS = (
+    'title', 'description', 'category', 'difficulty', 'is_premium', 'price',
+    'created_at', 'views', 'likes_count', 'comments_count', 'trending_score', 'card_version',
+    'preview', 'preview_width', 'preview_height', 'creator__username',
+)
+COMPACT_COLUMNS = ('title', 'difficulty', 'card_version')
+
+ACTIONS_MARKER = '<!--loop-card-actions-->'
+VIEWS_MARKER = '<!--loop-card-views-->'
+
+
+def for_cards(queryset):
+    """Narrow a Loop queryset to the columns a card needs."""
+    return queryset.select_related('creator').only(*CARD_COLUMNS)
+
+
+def cache_key(loop, variant='card'):
+    return CACHE_KEY.format(variant=variant, version=FRAGMENT_VERSION, pk=loop.pk, card_version=loop.card_version)
+
+
+def _actions(loop, purchased_loop_ids):
+    if not loop.is_premium:
+        return format_html(
+            '<a href="{}" class="btn btn-outline-primary btn-sm">View Loop</a>',
+            reverse('loop_detail', args=[loop.pk]),
+        )
+    if loop.pk in purchased_loop_ids:
+        return format_html(
+            '<a href="{}" class="btn btn-success btn-sm">Access</a>',
+            reverse('loop_detail', args=[loop.pk]),
+        )
+    return format_html(
+        '<a href="{}" class="btn btn-warning btn-sm">Buy Ksh {}</a>',
+        reverse('payments:initiate', args=[loop.pk]), loop.price,
+    )
+
+
+def _fill(html, loop, purchased_loop_ids):
+    if ACTIONS_MARKER in html:
+        html = html.replace(ACTIONS_MARKER, _actions(loop, purchased_loop_ids))
+    if VIEWS_MARKER in html:
+        html = html.replace(VIEWS_MARKER, str(loop.views))
+    return mark_safe(html)
+
+
+def render_cards(loops, purchased_loop_ids=frozenset(), variant='card'):
+    """Return the rendered cards for ``loops``, in order."""
+    loops = list(loops)
+    keys = [cache_key(loop, variant) for loop in loops]
+    cached = cache.get_many(keys)
+
+    missing = {}
+    cards = []
+    for loop, key in zip(loops, keys):
+        html = cached.get(key)
+        if html is None:
+            html = render_to_string(TEMPLATES[variant], {
+                'loop': loop,
+                'actions_marker': mark_safe(ACTIONS_MARKER),
+                'views_marker': mark_safe(VIEWS_MARKER),
+            })
+            missing[key] = html
+        cards.append(_fill(html, loop, purchased_loop_ids))
+
+    if missing:
+        cache.set_many(missing, CACHE_TIMEOUT)
+    return cards
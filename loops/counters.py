@@ -0,0 +1,131 @@
+"""
+Denormalized like/comment counters on Loop.
+
+``Loop.likes_count`` and ``Loop.comments_count`` are adjusted in the same
+transaction as the Like/Comment row they count: single saves go through
+``Like.save``/``Comment.save``, deletes (including querysets and cascades)
+through the post_delete signal, and ``bulk_create`` through
+``CountedQuerySet``. ``manage.py repair_loop_counters`` finds and fixes drift.
+Every counter change also bumps ``Loop.card_version`` so cached cards
+showing the old count are not served again, and new rows add to the
+loop's trending score.
+"""
+from collections import Counter
+
+from django.db import models, transaction
+from django.db.models import Count, F
+
+from . import trending
+
+# Related model name -> counter column on Loop
+COUNTER_FIELDS = {
+    'like': 'likes_count',
+    'comment': 'comments_count',
+}
+
+
+def counter_field(model):
+    return COUNTER_FIELDS[model._meta.model_name]
+
+
+def _changes(field, value, model=None, added=0):
+    changes = {field: value, 'card_version': F('card_version') + 1}
+    if added > 0:
+        changes.update(trending.score_change(model._meta.model_name, added))
+    return changes
+
+
+def adjust(model, loop_id, delta):
+    """Add ``delta`` to the counter that tracks ``model`` rows on one loop."""
+    from .models import Loop
+
+    field = counter_field(model)
+    loops = Loop.objects.filter(pk=loop_id)
+    if delta < 0:
+        # Never go below zero, even if the counter had drifted
+        loops = loops.filter(**{f'{field}__gte': -delta})
+    loops.update(**_changes(field, F(field) + delta, model, delta))
+
+
+def actual_counts(model, loop_ids=None):
+    """Return ``{loop_id: count}`` computed from the ``model`` table."""
+    rows = model.objects.order_by()
+    if loop_ids is not None:
+        rows = rows.filter(loop_id__in=loop_ids)
+    return dict(rows.values_list('loop_id').annotate(total=Count('pk')))
+
+
+def find_drift(model, batch_size=1000):
+    """Yield ``(loop_id, stored, actual)`` for every loop whose counter is wrong."""
+    from .models import Loop
+
+    field = counter_field(model)
+    last_pk = 0
+    while True:
+        batch = list(
+            Loop.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', field)[:batch_size]
+        )
+        if not batch:
+            return
+        counts = actual_counts(model, [pk for pk, _ in batch])
+        for pk, stored in batch:
+            actual = counts.get(pk, 0)
+            if stored != actual:
+                yield pk, stored, actual
+        last_pk = batch[-1][0]
+
+
+def recount(model, loop_ids):
+    """Recompute the ``model`` counter for the given loops from scratch."""
+    from .models import Loop
+
+    field = counter_field(model)
+    loop_ids = list(loop_ids)
+    with transaction.atomic():
+        counts = actual_counts(model, loop_ids)
+        # Group loops by their new value so each value is one UPDATE
+        by_value = {}
+        for loop_id in loop_ids:
+            by_value.setdefault(counts.get(loop_id, 0), []).append(loop_id)
+        for value, ids in by_value.items():
+            Loop.objects.filter(pk__in=ids).update(**_changes(field, value))
+
+
+class CountedQuerySet(models.QuerySet):
+    """QuerySet for Like/Comment that keeps the Loop counters right on bulk_create."""
+
+    def bulk_create(self, objs, *args, **kwargs):
+        from .models import Loop
+
+        objs = list(objs)
+        with transaction.atomic(using=self.db):
+            created = super().bulk_create(objs, *args, **kwargs)
+            loop_ids = {obj.loop_id for obj in objs}
+            if kwargs.get('ignore_conflicts') or kwargs.get('update_conflicts'):
+                # We can't tell which rows were actually inserted
+                recount(self.model, loop_ids)
+            else:
+                per_loop = Counter(obj.loop_id for obj in objs)
+                by_delta = {}
+                for loop_id, delta in per_loop.items():
+                    by_delta.setdefault(delta, []).append(loop_id)
+                field = counter_field(self.model)
+                for delta, ids in by_delta.items():
+                    Loop.objects.filter(pk__in=ids).update(**_changes(field, F(field) + delta, self.model, delta))
+        return created
+
+
+class CountedModel(models.Model):
+    """Base for rows that are counted on their Loop."""
+
+    objects = CountedQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+            if adding:
+                adjust(type(self), self.loop_id, 1)
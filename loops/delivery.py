@@ -0,0 +1,144 @@
+"""
+Serving loop attachments after an access check.
+
+Attachments are never linked by their media URL; the ``loop_attachment`` view
+checks the viewer's entitlement and then hands the file over with
+``attachment_response()``. With ``LOOP_ATTACHMENT_SENDFILE`` set, the
+response only carries an ``X-Accel-Redirect`` (nginx) or ``X-Sendfile``
+(Apache, lighttpd) header and the front-end server does the transfer,
+ranges included. Otherwise Django streams the file itself in blocks,
+answering conditional requests with 304 and a single ``Range`` with 206,
+so resumed downloads work and nothing is read into memory at once.
+
+For nginx, map the prefix to the media root as an internal location::
+
+    location /protected-media/ { internal; alias /path/to/media/; }
+
+and don't expose ``MEDIA_URL/loop_attachments/`` publicly.
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+
+BLOCK_SIZE = 64 * 1024
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, size):
+    """
+    Return ``(start, end)`` (inclusive) for a single-range ``Range`` header,
+    None to send the whole file, or ``'unsatisfiable'``.
+    """
+    match = _RANGE.match((header or '').strip())
+    if not match or size == 0:
+        # Missing, malformed or multiple ranges: a full response is always allowed
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return 'unsatisfiable'
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size:
+        return 'unsatisfiable'
+    if end < start:
+        return None
+    return start, end
+
+
+def _if_range_matches(request, etag, last_modified):
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(BLOCK_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+
+def _sendfile_response(fieldfile, mode):
+    response = HttpResponse()
+    if mode == 'x-accel-redirect':
+        prefix = getattr(settings, 'LOOP_ATTACHMENT_ACCEL_PREFIX', '/protected-media/')
+        response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(fieldfile.name)
+    else:
+        response['X-Sendfile'] = fieldfile.path
+    # Let the front-end server pick the type from the file it sends
+    del response['Content-Type']
+    return response
+
+
+def attachment_response(request, fieldfile, filename=None):
+    """Response delivering ``fieldfile`` (a FieldFile) as a download."""
+    filename = filename or os.path.basename(fieldfile.name)
+    mode = getattr(settings, 'LOOP_ATTACHMENT_SENDFILE', None)
+
+    if mode:
+        response = _sendfile_response(fieldfile, mode)
+    else:
+        response = _stream(request, fieldfile, filename)
+
+    if response.status_code in (200, 206):
+        response['Content-Disposition'] = content_disposition_header(True, filename)
+    # Premium files must never land in a shared cache
+    patch_cache_control(response, private=True)
+    return response
+
+
+def _stream(request, fieldfile, filename):
+    path = fieldfile.path
+    stat = os.stat(path)
+    size = stat.st_size
+    last_modified = int(stat.st_mtime)
+    etag = '"%x-%x"' % (stat.st_mtime_ns, size)
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    byte_range = None
+    if request.method == 'GET' and _if_range_matches(request, etag, last_modified):
+        byte_range = parse_range(request.headers.get('Range'), size)
+
+    if byte_range == 'unsatisfiable':
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+    elif byte_range is not None:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            _read_range(path, start, end - start + 1), status=206, content_type=content_type,
+        )
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+    else:
+        # FileResponse uses the server's wsgi.file_wrapper (sendfile) when there is one
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+        response.block_size = BLOCK_SIZE
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
@@ -0,0 +1,105 @@
+"""
+Premium access checks.
+
+Whether a user may open a premium loop is answered from one set: the ids
+of the loops they have purchased (``Loop.is_purchased_by``). That set is
+loaded with a single query, cached per user, and invalidated whenever a
+purchase is granted or the relation changes, so checking a whole page of
+loops costs at most one query.
+
+Purchases are usually granted by the payment worker, whose cache
+invalidation a web process with a local cache never sees. A cached set is
+therefore trusted when it says yes; ``has_access`` double-checks a no
+against the database.
+"""
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from learnloop.db_router import primary
+
+from . import trending
+
+CACHE_KEY = 'entitlements:user:{}'
+CACHE_TIMEOUT = getattr(settings, 'LOOP_ENTITLEMENT_CACHE_TIMEOUT', 60 * 60)
+
+
+def _purchases():
+    from .models import Loop
+    return Loop.is_purchased_by.through.objects
+
+
+def purchased_loop_ids(user, fresh=False):
+    """
+    Return the frozenset of loop ids ``user`` has bought. With ``fresh``,
+    skip the cache unless the set was already read from the database
+    during this request.
+    """
+    if not user.is_authenticated:
+        return frozenset()
+
+    # Memoize on the user object for the rest of the request
+    ids = getattr(user, '_purchased_loop_ids', None)
+    if ids is not None and (not fresh or user._purchased_loop_ids_fresh):
+        return ids
+
+    key = CACHE_KEY.format(user.pk)
+    ids = None if fresh else cache.get(key)
+    from_db = ids is None
+    if from_db:
+        # Always the primary: a replica that hasn't caught up with a purchase
+        # would put the old set back in the cache for CACHE_TIMEOUT
+        with primary():
+            ids = frozenset(_purchases().filter(user_id=user.pk).values_list('loop_id', flat=True))
+        cache.set(key, ids, CACHE_TIMEOUT)
+
+    user._purchased_loop_ids = ids
+    user._purchased_loop_ids_fresh = from_db
+    return ids
+
+
+def has_access(user, loop):
+    if not loop.is_premium:
+        return True
+    if loop.pk in purchased_loop_ids(user):
+        return True
+    return loop.pk in purchased_loop_ids(user, fresh=True)
+
+
+def grant(user_id, loop_id):
+    """Record a purchase and drop the buyer's cached entitlements."""
+    _, created = _purchases().get_or_create(user_id=user_id, loop_id=loop_id)
+    if created:
+        trending.record('purchase', [loop_id])
+    invalidate(user_id)
+
+
+def grant_many(pairs):
+    """Record ``(user_id, loop_id)`` purchases in one insert; existing ones are skipped."""
+    pairs = set(pairs)
+    if not pairs:
+        return
+    Purchase = _purchases().model
+    existing = set(
+        _purchases().filter(user_id__in={pair[0] for pair in pairs}, loop_id__in={pair[1] for pair in pairs})
+        .values_list('user_id', 'loop_id')
+    )
+    new = pairs - existing
+    Purchase.objects.bulk_create(
+        [Purchase(user_id=user_id, loop_id=loop_id) for user_id, loop_id in new],
+        ignore_conflicts=True,
+    )
+    # One UPDATE per distinct number of new purchases
+    by_count = {}
+    for loop_id, count in Counter(loop_id for _, loop_id in new).items():
+        by_count.setdefault(count, []).append(loop_id)
+    for count, loop_ids in by_count.items():
+        trending.record('purchase', loop_ids, count)
+    user_ids = {user_id for user_id, _ in pairs}
+    transaction.on_commit(lambda: invalidate(*user_ids))
+
+
+def invalidate(*user_ids):
+    cache.delete_many([CACHE_KEY.format(user_id) for user_id in user_ids])
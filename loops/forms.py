@@ -1,7 +1,16 @@
 from django import forms
-from .models import Loop, Comment
+from .models import ChunkedUpload, Loop, Comment
+from . import uploads
 
 class LoopForm(forms.ModelForm):
+    # Set by the chunked uploader (loops.uploads) instead of posting the file itself
+    attachment_upload = forms.UUIDField(required=False, widget=forms.HiddenInput)
+    # Stored in LoopBody rather than a Loop column
+    content = forms.CharField(
+        widget=forms.Textarea(attrs={'rows': 10, 'class': 'form-control', 'placeholder': 'Write your micro-lesson here. Keep it concise and focused.'}),
+        help_text='Try to keep your micro-lesson under 500 words for best readability.',
+    )
+
     class Meta:
         model = Loop
         fields = ['title', 'category', 'difficulty', 'description', 'content', 
@@ -9,26 +18,58 @@ class LoopForm(forms.ModelForm):
         widgets = {
             'title': forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Enter a catchy title for your loop'}),
             'description': forms.Textarea(attrs={'rows': 3, 'class': 'form-control', 'placeholder': 'Briefly describe what this loop is about'}),
-            'content': forms.Textarea(attrs={'rows': 10, 'class': 'form-control', 'placeholder': 'Write your micro-lesson here. Keep it concise and focused.'}),
             'category': forms.Select(attrs={'class': 'form-select'}),
             'difficulty': forms.Select(attrs={'class': 'form-select'}),
             'video_url': forms.URLInput(attrs={'class': 'form-control', 'placeholder': 'https://youtube.com/... (optional)'}),
             'price': forms.NumberInput(attrs={'class': 'form-control', 'min': '0', 'step': '0.01'}),
         }
         help_texts = {
-            'content': 'Try to keep your micro-lesson under 500 words for best readability.',
             'video_url': 'Add a video to supplement your lesson (optional).',
             'price': 'Set price in Ksh. Free loops are accessible to everyone.',
         }
 
+    def __init__(self, *args, user=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user = user
+        self.chunked_upload = None
+        if self.instance.pk is not None:
+            self.initial.setdefault('content', self.instance.content)
+
+    def clean_attachment_upload(self):
+        upload_id = self.cleaned_data.get('attachment_upload')
+        if not upload_id:
+            return None
+        upload = ChunkedUpload.objects.filter(
+            pk=upload_id, user_id=getattr(self.user, 'pk', None), completed_at__isnull=False,
+        ).first()
+        if upload is None:
+            raise forms.ValidationError('The attachment upload is missing or unfinished; please upload it again.')
+        return upload
+
     def clean(self):
         cleaned_data = super().clean()
+        upload = cleaned_data.get('attachment_upload')
+        if upload and not cleaned_data.get('attachment'):
+            # Saving the loop moves the assembled file into storage
+            self.chunked_upload = upload
+            cleaned_data['attachment'] = uploads.as_file(upload)
+
         is_premium = cleaned_data.get('is_premium')
         price = cleaned_data.get('price')
 
         if is_premium and (price is None or price <= 0):
             self.add_error('price', 'Price must be set for premium loops.')
 
+    def save(self, commit=True):
+        self.instance.content = self.cleaned_data['content']
+        return super().save(commit)
+
+    def finish_upload(self):
+        """Drop the chunked upload once the saved loop has taken its file."""
+        if self.chunked_upload is not None:
+            uploads.discard(self.chunked_upload)
+            self.chunked_upload = None
+
 
 class CommentForm(forms.ModelForm):
     class Meta:
@@ -0,0 +1,76 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db.models import F
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from loops import benchmarking
+from loops.models import Loop
+from loops.view_counter import view_counter
+
+
+def _legacy_increment_views(self):
+    # The old read-modify-write, kept here only to benchmark against
+    self.views += 1
+    self.save(update_fields=['views'])
+
+
+def _direct_increment_views(self):
+    Loop.objects.filter(pk=self.pk).update(views=F('views') + 1)
+    self.views += 1
+
+
+class Command(BaseCommand):
+    help = "Benchmark loop_detail throughput with N concurrent readers, before and after buffered view counting."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=8, help="Concurrent reader threads")
+        parser.add_argument('--requests', type=int, default=100, help="Requests per reader")
+        parser.add_argument(
+            '--mode', choices=['save', 'direct', 'buffered', 'all'], default='all',
+            help="save = old read-modify-write, direct = F() update per view, buffered = write-behind counter",
+        )
+
+    def handle(self, *args, **options):
+        loop = Loop.objects.filter(is_premium=False).first()
+        created = loop is None
+        if created:
+            user, _ = User.objects.get_or_create(username='bench-user')
+            loop = Loop.objects.create(
+                title='Benchmark loop', description='Benchmark', content='Benchmark content', creator=user,
+            )
+
+        modes = ['save', 'direct', 'buffered'] if options['mode'] == 'all' else [options['mode']]
+        try:
+            for mode in modes:
+                self._run_mode(mode, loop, options['readers'], options['requests'])
+        finally:
+            if created:
+                loop.delete()
+
+    def _run_mode(self, mode, loop, readers, per_reader):
+        original = Loop.increment_views
+        if mode == 'save':
+            Loop.increment_views = _legacy_increment_views
+        elif mode == 'direct':
+            Loop.increment_views = _direct_increment_views
+
+        url = reverse('loop_detail', args=[loop.pk])
+        start_views = Loop.objects.get(pk=loop.pk).views
+
+        try:
+            # Without the page cache, so every request goes through increment_views
+            with override_settings(LOOP_VIEWS_BUFFERED=(mode == 'buffered'), LOOP_PAGE_CACHE_ENABLED=False):
+                result = benchmarking.run_scenario(
+                    lambda client, rng: client.get(url), concurrency=readers, requests=readers * per_reader,
+                )
+                view_counter.flush()
+        finally:
+            Loop.increment_views = original
+
+        counted = Loop.objects.get(pk=loop.pk).views - start_views
+        self.stdout.write(
+            f"{mode:>8}: {result['requests']} requests, {readers} readers, "
+            f"{result['throughput']:.1f} req/s, p95 {result['p95_ms']:.1f}ms, "
+            f"{counted}/{result['requests']} views recorded, {result['errors']} errors"
+        )
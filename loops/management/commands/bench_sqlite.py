@@ -0,0 +1,127 @@
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connection, connections
+from django.db.models import F
+
+from loops import benchmarking, cards
+from loops.models import Like, Loop
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a mixed read/write workload against the database from several threads and report "
+        "sustained throughput, latency and lock contention. Seed data first with seed_catalog; "
+        "the run adds views and toggles likes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--duration', type=float, default=10, help="Seconds to run for")
+        parser.add_argument('--write-ratio', type=float, default=0.2, help="Share of operations that write")
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        loop_ids = list(Loop.objects.values_list('pk', flat=True)[:5000])
+        users = list(User.objects.order_by('pk').values_list('pk', flat=True)[:options['threads']])
+        if not loop_ids or len(users) < options['threads']:
+            raise CommandError("Not enough loops or users to benchmark against; run seed_catalog first.")
+
+        backend = self._backend_stats()
+        before = dict(backend) if backend is not None else None
+        latencies = {'read': [], 'write': []}
+        errors = []
+        lock = threading.Lock()
+        deadline = time.monotonic() + options['duration']
+
+        def read(rng):
+            if rng.random() < 0.5:
+                list(cards.for_cards(Loop.objects.all()).order_by('-created_at', '-pk')[:12])
+            else:
+                Loop.objects.select_related('creator', 'body').get(pk=rng.choice(loop_ids)).content
+
+        def write(rng, user_id):
+            loop_id = rng.choice(loop_ids)
+            if rng.random() < 0.7:
+                # What increment_views does when views aren't buffered
+                Loop.objects.filter(pk=loop_id).update(views=F('views') + 1)
+            else:
+                like = Like.objects.filter(user_id=user_id, loop_id=loop_id).first()
+                if like:
+                    like.delete()
+                else:
+                    Like.objects.create(user_id=user_id, loop_id=loop_id)
+
+        def worker(index):
+            rng = random.Random(None if options['seed'] is None else options['seed'] + index)
+            user_id = users[index]
+            try:
+                while time.monotonic() < deadline:
+                    kind = 'write' if rng.random() < options['write_ratio'] else 'read'
+                    started = time.perf_counter()
+                    try:
+                        if kind == 'write':
+                            write(rng, user_id)
+                        else:
+                            read(rng)
+                    except DatabaseError as exc:
+                        with lock:
+                            errors.append(f"{kind}: {exc}")
+                        continue
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        latencies[kind].append(elapsed)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+
+        self._print_settings()
+        total = sum(len(values) for values in latencies.values())
+        self.stdout.write(f"{options['threads']} threads, {wall:.1f}s, write ratio {options['write_ratio']:.0%}")
+        self.stdout.write(f"{'total':<6} {total / wall:>9.1f} ops/s")
+        for kind, values in latencies.items():
+            self.stdout.write(
+                f"{kind:<6} {len(values) / wall:>9.1f} ops/s  "
+                f"p50 {benchmarking.percentile(values, 50) * 1000:>7.1f}ms  "
+                f"p95 {benchmarking.percentile(values, 95) * 1000:>7.1f}ms  "
+                f"p99 {benchmarking.percentile(values, 99) * 1000:>7.1f}ms"
+            )
+        if backend is not None:
+            self.stdout.write(
+                "busy retries {busy_retries}, busy failures {busy_failures}, queued writes {queued_writes}".format(
+                    **{name: backend[name] - before[name] for name in backend}
+                )
+            )
+        if errors:
+            self.stdout.write(self.style.ERROR(f"{len(errors)} errors, e.g. {errors[0]}"))
+        else:
+            self.stdout.write(self.style.SUCCESS("No errors."))
+
+    def _backend_stats(self):
+        try:
+            from learnloop.sqlite_backend import base
+        except ImportError:
+            return None
+        return base.stats if isinstance(connections[DEFAULT_DB_ALIAS], base.DatabaseWrapper) else None
+
+    def _print_settings(self):
+        self.stdout.write(f"Engine: {settings.DATABASES['default']['ENGINE']}")
+        if connection.vendor != 'sqlite':
+            return
+        with connection.cursor() as cursor:
+            values = []
+            for pragma in ('journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'busy_timeout'):
+                cursor.execute(f'PRAGMA {pragma}')
+                values.append(f"{pragma}={cursor.fetchone()[0]}")
+        self.stdout.write(', '.join(values))
@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from loops import uploads
+
+
+class Command(BaseCommand):
+    help = "Delete chunked attachment uploads that were abandoned or never attached to a loop."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than', type=int, default=None,
+            help="Seconds since an upload was last touched (default: LOOP_UPLOAD_EXPIRY)",
+        )
+
+    def handle(self, *args, **options):
+        older_than = options['older_than']
+        removed = uploads.clean(timedelta(seconds=older_than) if older_than is not None else None)
+        self.stdout.write(self.style.SUCCESS(f"Removed {removed} stale uploads."))
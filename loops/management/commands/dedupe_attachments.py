@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from loops import blobs
+
+
+class Command(BaseCommand):
+    help = (
+        "Move attachments saved under their upload names into content-addressed storage, "
+        "merging identical files, and rebuild reference counts."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report what would change without touching anything")
+
+    def handle(self, *args, **options):
+        progress = self.stdout.write if options['verbosity'] > 1 else None
+        moved, merged, freed = blobs.adopt_existing(dry_run=options['dry_run'], progress=progress)
+        prefix = "Would have moved" if options['dry_run'] else "Moved"
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix} {moved} files and merged {merged} duplicates, freeing {freed} bytes."
+        ))
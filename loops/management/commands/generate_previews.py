@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import F, Q
+
+from loops import previews
+from loops.blobs import attachment_storage
+from loops.models import Loop
+
+
+class Command(BaseCommand):
+    help = "Render previews for loops whose attachment has none yet (or changed since)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads', type=int, default=getattr(settings, 'LOOP_PREVIEW_WORKERS', 2),
+            help="Previews rendered in parallel",
+        )
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--all', action='store_true', help="Re-render every preview, e.g. after changing LOOP_PREVIEW_SIZE")
+
+    def handle(self, *args, **options):
+        if options['all']:
+            Loop.objects.filter(is_premium=False).exclude(preview_source='').update(preview_source='')
+        # Premium loops should have no preview; the rest one made from their attachment
+        stale = (
+            Q(is_premium=True) & ~Q(preview_source='')
+            | Q(is_premium=False) & ~Q(preview_source=F('attachment')) & ~Q(attachment__isnull=True, preview_source='')
+        )
+        pending = list(Loop.objects.filter(stale).order_by('pk').values_list('pk', 'attachment', 'is_premium'))
+        storage = attachment_storage()
+
+        def prepare(row):
+            source = previews.source_for(row[1], row[2])
+            return previews.prepare(source, storage.path(source) if source else None)
+
+        changed = 0
+        # Rendering happens on the pool; the database writes stay on this thread
+        with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+            for start in range(0, len(pending), options['batch_size']):
+                batch = pending[start:start + options['batch_size']]
+                for (pk, attachment, is_premium), changes in zip(batch, pool.map(prepare, batch)):
+                    changed += previews.apply(pk, attachment or '', is_premium, changes)
+        self.stdout.write(self.style.SUCCESS(f"Checked {len(pending)} loops, updated {changed} previews."))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from loops import search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the FTS5 search index for loops (SQLite only)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not search.is_supported():
+            self.stdout.write("Full-text search index is only used on SQLite; nothing to do.")
+            return
+
+        indexed = search.rebuild_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} loops."))
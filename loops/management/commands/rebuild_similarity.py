@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from loops import similarity
+
+
+class Command(BaseCommand):
+    help = "Recompute the precomputed similar loops for the whole catalog (run nightly)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help="Loops read from the database at a time")
+        parser.add_argument('--block-size', type=int, default=1000, help="Rows scored against the catalog at a time")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        count = similarity.rebuild(batch_size=options['batch_size'], block_size=options['block_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {count} loops in {time.perf_counter() - started:.1f}s; snapshot at {similarity.snapshot_path()}."
+        ))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from loops import trending
+
+
+class Command(BaseCommand):
+    help = "Move the trending epoch forward and rescale all trending scores (run daily)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help="Recompute scores from like/comment/purchase history instead of rescaling",
+        )
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            count = trending.rebuild()
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt trending scores for {count} loops."))
+            return
+
+        factor = trending.renormalize()
+        self.stdout.write(self.style.SUCCESS(f"Trending scores rescaled by {factor:.6g}."))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from loops import counters
+from loops.models import Comment, Like
+
+
+class Command(BaseCommand):
+    help = "Verify Loop.likes_count/comments_count against the Like and Comment tables and fix any drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help="Only report drift, don't fix it")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        total_drift = 0
+        for model in (Like, Comment):
+            field = counters.counter_field(model)
+            drifted = list(counters.find_drift(model, batch_size=options['batch_size']))
+            total_drift += len(drifted)
+
+            for loop_id, stored, actual in drifted[:20]:
+                self.stdout.write(f"Loop {loop_id}: {field} is {stored}, should be {actual}")
+            if len(drifted) > 20:
+                self.stdout.write(f"... and {len(drifted) - 20} more")
+
+            if drifted and not options['check']:
+                loop_ids = [loop_id for loop_id, _, _ in drifted]
+                for i in range(0, len(loop_ids), options['batch_size']):
+                    counters.recount(model, loop_ids[i:i + options['batch_size']])
+                self.stdout.write(self.style.SUCCESS(f"Repaired {field} on {len(drifted)} loops."))
+            else:
+                self.stdout.write(f"{field}: {len(drifted)} loops drifted.")
+
+        if options['check'] and total_drift:
+            raise CommandError(f"{total_drift} loop counters have drifted.")
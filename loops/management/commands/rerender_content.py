@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from loops import rendering
+
+
+class Command(BaseCommand):
+    help = "Re-render stored lesson, comment and video embed HTML made with an older renderer."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--all', action='store_true', help="Re-render every row, not just stale ones")
+
+    def handle(self, *args, **options):
+        loops, comments = rendering.rerender(batch_size=options['batch_size'], everything=options['all'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Re-rendered {loops} loops and {comments} comments (renderer version {rendering.RENDERER_VERSION})."
+        ))
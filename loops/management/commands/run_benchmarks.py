@@ -0,0 +1,168 @@
+import json
+import os
+import platform
+from collections import deque
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from loops import benchmarking
+from loops.models import Loop
+from loops.view_counter import view_counter
+from payments.models import Payment
+
+SCENARIOS = [
+    'loops_list', 'loops_list_filtered', 'loops_list_search', 'loops_list_sorted',
+    'loop_detail', 'like_loop', 'mpesa_callback',
+]
+
+DEFAULT_DIR = os.path.join(settings.BASE_DIR, 'benchmarks')
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive the main views concurrently and report throughput, p50/p95/p99 latency and "
+        "queries per request. Seed data first with seed_catalog."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--requests', type=int, default=200, help="Requests per scenario")
+        parser.add_argument('--scenario', action='append', choices=SCENARIOS, help="Run only these scenarios")
+        parser.add_argument('--output', default=os.path.join(DEFAULT_DIR, 'results.json'))
+        parser.add_argument('--baseline', default=os.path.join(DEFAULT_DIR, 'baseline.json'))
+        parser.add_argument('--save-baseline', action='store_true', help="Store these results as the new baseline")
+        parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed slowdown before flagging, e.g. 0.2 = 20%%")
+        parser.add_argument('--fail-on-regression', action='store_true')
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        loop_ids = list(Loop.objects.values_list('pk', flat=True)[:5000])
+        users = list(User.objects.order_by('pk').values_list('pk', flat=True)[:options['concurrency'] * 4])
+        if not loop_ids or not users:
+            raise CommandError("No loops or users to benchmark against; run seed_catalog first.")
+
+        scenarios = self._build_scenarios(loop_ids, users)
+        results = {}
+        with override_settings(ALLOWED_HOSTS=['localhost']):
+            for name in options['scenario'] or SCENARIOS:
+                scenario, setup_client = scenarios[name]
+                results[name] = benchmarking.run_scenario(
+                    scenario, options['concurrency'], options['requests'],
+                    setup_client=setup_client, seed=options['seed'],
+                )
+                self._print_result(name, results[name])
+        view_counter.flush()
+
+        report = {
+            'meta': {
+                'created_at': timezone.now().isoformat(),
+                'python': platform.python_version(),
+                'database': settings.DATABASES['default']['ENGINE'],
+                'loops': Loop.objects.count(),
+                'concurrency': options['concurrency'],
+                'requests': options['requests'],
+            },
+            'scenarios': results,
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(options['output'])), exist_ok=True)
+        benchmarking.dump_json(report, options['output'])
+        self.stdout.write(f"Results written to {options['output']}")
+
+        if options['save_baseline']:
+            benchmarking.dump_json(report, options['baseline'])
+            self.stdout.write(f"Baseline saved to {options['baseline']}")
+            return
+
+        if not os.path.exists(options['baseline']):
+            self.stdout.write("No baseline to compare against (use --save-baseline).")
+            return
+
+        baseline = benchmarking.load_json(options['baseline'])['scenarios']
+        regressions = benchmarking.compare(results, baseline, tolerance=options['tolerance'])
+        for name, metric, before, after in regressions:
+            self.stdout.write(self.style.WARNING(f"REGRESSION {name}.{metric}: {before} -> {after}"))
+        if not regressions:
+            self.stdout.write(self.style.SUCCESS("No regressions against baseline."))
+        elif options['fail_on_regression']:
+            raise CommandError(f"{len(regressions)} benchmark regressions.")
+
+    def _print_result(self, name, result):
+        self.stdout.write(
+            f"{name:<22} {result['throughput']:>8.1f} req/s  "
+            f"p50 {result['p50_ms']:>7.1f}ms  p95 {result['p95_ms']:>7.1f}ms  p99 {result['p99_ms']:>7.1f}ms  "
+            f"{result['queries_per_request']:>5.1f} q/req  {result['errors']} errors"
+        )
+
+    def _build_scenarios(self, loop_ids, users):
+        categories = [value for value, _ in Loop.CATEGORY_CHOICES]
+        difficulties = [value for value, _ in Loop.DIFFICULTY_CHOICES]
+        search_terms = ['algebra', 'python', 'notes', 'exam', 'graph', 'chem']
+        sorts = ['-views', '-likes_count', 'created_at']
+        pending = deque(
+            Payment.objects.filter(status='Pending', checkout_request_id__isnull=False)
+            .values_list('checkout_request_id', flat=True)[:10000]
+        )
+
+        def login(client, index):
+            client.force_login(User.objects.get(pk=users[index % len(users)]))
+
+        def loops_list(client, rng):
+            return client.get(reverse('loops_list'))
+
+        def loops_list_filtered(client, rng):
+            return client.get(reverse('loops_list'), {
+                'category': rng.choice(categories), 'difficulty': rng.choice(difficulties),
+            })
+
+        def loops_list_search(client, rng):
+            return client.get(reverse('loops_list'), {'q': rng.choice(search_terms)})
+
+        def loops_list_sorted(client, rng):
+            return client.get(reverse('loops_list'), {'sort': rng.choice(sorts)})
+
+        def loop_detail(client, rng):
+            return client.get(reverse('loop_detail', args=[rng.choice(loop_ids)]))
+
+        def like_loop(client, rng):
+            return client.post(
+                reverse('like_loop', args=[rng.choice(loop_ids)]),
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+            )
+
+        def mpesa_callback(client, rng):
+            try:
+                checkout_id = pending.popleft()
+            except IndexError:
+                checkout_id = 'ws_CO_unknown'
+            success = rng.random() < 0.8
+            callback = {
+                'MerchantRequestID': 'bench',
+                'CheckoutRequestID': checkout_id,
+                'ResultCode': 0 if success else 1032,
+                'ResultDesc': 'ok' if success else 'Request cancelled by user',
+            }
+            if success:
+                callback['CallbackMetadata'] = {'Item': [
+                    {'Name': 'Amount', 'Value': 1},
+                    {'Name': 'MpesaReceiptNumber', 'Value': f'BENCH{rng.randint(0, 10 ** 9)}'},
+                ]}
+            return client.post(
+                reverse('payments:mpesa_callback'),
+                data=json.dumps({'Body': {'stkCallback': callback}}),
+                content_type='application/json',
+            )
+
+        return {
+            'loops_list': (loops_list, None),
+            'loops_list_filtered': (loops_list_filtered, None),
+            'loops_list_search': (loops_list_search, None),
+            'loops_list_sorted': (loops_list_sorted, login),
+            'loop_detail': (loop_detail, login),
+            'like_loop': (like_loop, login),
+            'mpesa_callback': (mpesa_callback, None),
+        }
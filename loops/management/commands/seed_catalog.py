@@ -0,0 +1,139 @@
+import random
+import time
+import uuid
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from loops import rendering, search
+from loops.models import Loop, LoopBody, Like, Comment
+from payments.models import Payment
+
+WORDS = (
+    "algebra calculus vectors matrices probability statistics physics chemistry biology genetics "
+    "python django databases networks algorithms sorting recursion graphs marketing accounting "
+    "finance economics painting history poetry grammar swahili french anatomy pharmacology "
+    "contracts torts circuits mechanics thermodynamics revision exam notes summary practice"
+).split()
+
+
+def _sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+class Command(BaseCommand):
+    help = "Seed a synthetic catalog (users, loops, likes, comments, payments) for load testing."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--loops', type=int, default=1000)
+        parser.add_argument('--likes', type=int, default=5, help="Average likes per loop")
+        parser.add_argument('--comments', type=int, default=3, help="Average comments per loop")
+        parser.add_argument('--premium-ratio', type=float, default=0.3)
+        parser.add_argument('--payments', type=int, default=2, help="Average payments per premium loop")
+        parser.add_argument('--content-words', type=int, default=300, help="Words of lesson content per loop")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=None, help="Random seed for repeatable catalogs")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+        run = uuid.uuid4().hex[:6]
+        started = time.perf_counter()
+
+        with transaction.atomic():
+            users = self._seed_users(options['users'], run, batch_size)
+            loops = self._seed_loops(rng, users, options, batch_size)
+            likes = self._seed_likes(rng, users, loops, options['likes'], batch_size)
+            comments = self._seed_comments(rng, users, loops, options['comments'], batch_size)
+            payments = self._seed_payments(rng, users, loops, options['payments'], run, batch_size)
+
+        # bulk_create skips the model signals that keep the search index in sync
+        if search.is_supported():
+            search.rebuild_index()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {len(users)} users, {len(loops)} loops, {likes} likes, {comments} comments "
+            f"and {payments} payments in {time.perf_counter() - started:.1f}s."
+        ))
+
+    def _seed_users(self, count, run, batch_size):
+        # Hashing is slow; every seeded user gets the same password ("password")
+        password = make_password('password')
+        users = [
+            User(username=f'seed_{run}_{i}', email=f'seed_{run}_{i}@example.com', password=password)
+            for i in range(count)
+        ]
+        User.objects.bulk_create(users, batch_size=batch_size)
+        return list(User.objects.filter(username__startswith=f'seed_{run}_'))
+
+    def _seed_loops(self, rng, users, options, batch_size):
+        categories = [value for value, _ in Loop.CATEGORY_CHOICES]
+        difficulties = [value for value, _ in Loop.DIFFICULTY_CHOICES]
+        loops = []
+        for i in range(options['loops']):
+            is_premium = rng.random() < options['premium_ratio']
+            loops.append(Loop(
+                title=f"{_sentence(rng, 4)[:-1]} #{i}",
+                description=_sentence(rng, 25),
+                content=' '.join(_sentence(rng, 12) for _ in range(max(1, options['content_words'] // 12))),
+                creator=rng.choice(users),
+                # Cycle through every category/difficulty pair
+                category=categories[i % len(categories)],
+                difficulty=difficulties[(i // len(categories)) % len(difficulties)],
+                is_premium=is_premium,
+                price=rng.choice([20, 50, 100, 200]) if is_premium else 0,
+                views=int(rng.paretovariate(1.2) * 10),
+                render_version=rendering.RENDERER_VERSION,
+            ))
+        loops = Loop.objects.bulk_create(loops, batch_size=batch_size)
+        # bulk_create skips save(), which is what normally writes the bodies
+        LoopBody.objects.bulk_create(
+            [LoopBody.for_loop(loop.pk, loop.content) for loop in loops], batch_size=batch_size,
+        )
+        return loops
+
+    def _seed_likes(self, rng, users, loops, average, batch_size):
+        likes = []
+        for loop in loops:
+            count = min(len(users), int(rng.expovariate(1 / average))) if average else 0
+            likes.extend(Like(user=user, loop=loop) for user in rng.sample(users, count))
+        Like.objects.bulk_create(likes, batch_size=batch_size)
+        return len(likes)
+
+    def _seed_comments(self, rng, users, loops, average, batch_size):
+        comments = []
+        for loop in loops:
+            count = int(rng.expovariate(1 / average)) if average else 0
+            for _ in range(count):
+                content = _sentence(rng, 15)
+                comments.append(Comment(
+                    user=rng.choice(users), loop=loop, content=content,
+                    rendered_html=rendering.render_text(content), render_version=rendering.RENDERER_VERSION,
+                ))
+        Comment.objects.bulk_create(comments, batch_size=batch_size)
+        return len(comments)
+
+    def _seed_payments(self, rng, users, loops, average, run, batch_size):
+        payments, purchases = [], []
+        Purchase = Loop.is_purchased_by.through
+        for loop in loops:
+            if not loop.is_premium or not average:
+                continue
+            buyers = rng.sample(users, min(len(users), int(rng.expovariate(1 / average))))
+            for buyer in buyers:
+                status = rng.choices(['Success', 'Pending', 'Failed'], weights=[6, 3, 1])[0]
+                payments.append(Payment(
+                    user=buyer, loop=loop, phone_number=f'2547{rng.randint(10000000, 99999999)}',
+                    amount=loop.price, status=status,
+                    checkout_request_id=f'ws_CO_{run}_{len(payments)}',
+                    merchant_request_id=f'{run}-{len(payments)}',
+                    receipt_number=f'R{run.upper()}{len(payments)}' if status == 'Success' else None,
+                ))
+                if status == 'Success':
+                    purchases.append(Purchase(loop_id=loop.pk, user_id=buyer.pk))
+        Payment.objects.bulk_create(payments, batch_size=batch_size)
+        Purchase.objects.bulk_create(purchases, batch_size=batch_size, ignore_conflicts=True)
+        return len(payments)
@@ -0,0 +1,29 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from loops import blobs
+
+
+class Command(BaseCommand):
+    help = "Delete attachment files no loop has referenced for the grace period; use --every to keep running."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace', type=int, default=getattr(settings, 'LOOP_BLOB_GRACE', 24 * 60 * 60),
+            help="Seconds a file must have been unreferenced before it is deleted",
+        )
+        parser.add_argument('--recount', action='store_true', help="Rebuild reference counts from the loops first")
+        parser.add_argument('--every', type=int, default=None, help="Repeat every N seconds instead of exiting")
+
+    def handle(self, *args, **options):
+        while True:
+            if options['recount']:
+                blobs.recount()
+            removed, freed = blobs.sweep(timedelta(seconds=options['grace']))
+            self.stdout.write(self.style.SUCCESS(f"Removed {removed} attachment files ({freed} bytes)."))
+            if not options['every']:
+                return
+            time.sleep(options['every'])
@@ -0,0 +1,45 @@
+# Generated by Django 6.0 on 2026-10-18 09:12
+
+from django.db import migrations
+
+FTS_TABLE = 'loops_loop_fts'
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        "title, description, content, category, "
+        "tokenize = 'unicode61 remove_diacritics 2')"
+    )
+    Loop = apps.get_model('loops', 'Loop')
+    labels = dict(Loop._meta.get_field('category').choices)
+    rows = [
+        (pk, title, description, content, f"{category} {labels.get(category, category)}")
+        for pk, title, description, content, category in Loop.objects.values_list(
+            'pk', 'title', 'description', 'content', 'category'
+        ).iterator()
+    ]
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {FTS_TABLE} (rowid, title, description, content, category) VALUES (%s, %s, %s, %s, %s)",
+            rows,
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loops', '0004_loop_is_purchased_by_alter_loop_price'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
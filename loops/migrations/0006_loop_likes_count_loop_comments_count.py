@@ -0,0 +1,41 @@
+# Generated by Django 6.0 on 2026-10-18 10:40
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_counters(apps, schema_editor):
+    Loop = apps.get_model('loops', 'Loop')
+    Like = apps.get_model('loops', 'Like')
+    Comment = apps.get_model('loops', 'Comment')
+
+    def count_of(model):
+        rows = (
+            model.objects.filter(loop=OuterRef('pk')).order_by()
+            .values('loop').annotate(total=Count('pk')).values('total')
+        )
+        return Coalesce(Subquery(rows), 0)
+
+    Loop.objects.update(likes_count=count_of(Like), comments_count=count_of(Comment))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loops', '0005_loop_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loop',
+            name='comments_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='loop',
+            name='likes_count',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
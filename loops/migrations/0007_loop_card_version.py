@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 13:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loops', '0006_loop_likes_count_loop_comments_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loop',
+            name='card_version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
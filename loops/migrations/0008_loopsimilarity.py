@@ -0,0 +1,27 @@
+# Generated by Django 6.0 on 2026-10-18 14:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loops', '0007_loop_card_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoopSimilarity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('loop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similarities', to='loops.loop')),
+                ('similar', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='loops.loop')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['loop', '-score'], name='loops_similarity_top_idx')],
+                'unique_together': {('loop', 'similar')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 6.0 on 2026-10-18 15:30
+
+import time
+
+from django.db import migrations, models
+
+
+def create_epoch(apps, schema_editor):
+    TrendingEpoch = apps.get_model('loops', 'TrendingEpoch')
+    TrendingEpoch.objects.get_or_create(pk=1, defaults={'epoch': time.time()})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loops', '0008_loopsimilarity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrendingEpoch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('epoch', models.FloatField(help_text='Unix timestamp')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='loop',
+            name='trending_score',
+            field=models.FloatField(db_index=True, default=0),
+        ),
+        migrations.RunPython(create_epoch, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0 on 2026-10-18 21:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loops', '0009_loop_trending_score'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['loop', '-created_at', '-id'], name='loops_comment_recent_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 6.0 on 2026-10-18 22:40
+
+import loops.blobs
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loops', '0011_chunkedupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loop',
+            name='attachment_name',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='loop',
+            name='attachment',
+            field=loops.blobs.AttachmentField(blank=True, max_length=255, name_field='attachment_name', null=True, storage=loops.blobs.attachment_storage, upload_to='loop_attachments/'),
+        ),
+        migrations.CreateModel(
+            name='AttachmentBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.PositiveBigIntegerField(default=0)),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('released_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ref_count', 'released_at'], name='loops_blob_sweep_idx')],
+            },
+        ),
+    ]
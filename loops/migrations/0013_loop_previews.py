@@ -0,0 +1,33 @@
+# Generated by Django 6.0 on 2026-10-18 23:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loops', '0012_attachment_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loop',
+            name='preview',
+            field=models.ImageField(blank=True, max_length=255, upload_to='loop_previews/'),
+        ),
+        migrations.AddField(
+            model_name='loop',
+            name='preview_height',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='loop',
+            name='preview_source',
+            field=models.CharField(blank=True, help_text='Attachment the preview was made from', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='loop',
+            name='preview_width',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 6.0 on 2026-10-18 23:40
+
+import zlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+
+def move_content_to_bodies(apps, schema_editor):
+    Loop = apps.get_model('loops', 'Loop')
+    LoopBody = apps.get_model('loops', 'LoopBody')
+    last_pk = 0
+    while True:
+        batch = list(
+            Loop.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'content')[:BATCH_SIZE]
+        )
+        if not batch:
+            return
+        bodies = []
+        for pk, content in batch:
+            raw = (content or '').encode('utf-8')
+            bodies.append(LoopBody(loop_id=pk, data=zlib.compress(raw, 6), size=len(raw)))
+        LoopBody.objects.bulk_create(bodies)
+        last_pk = batch[-1][0]
+
+
+def restore_content(apps, schema_editor):
+    Loop = apps.get_model('loops', 'Loop')
+    LoopBody = apps.get_model('loops', 'LoopBody')
+    for body in LoopBody.objects.iterator(chunk_size=BATCH_SIZE):
+        content = zlib.decompress(bytes(body.data)).decode('utf-8') if body.data else ''
+        Loop.objects.filter(pk=body.loop_id).update(content=content)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loops', '0013_loop_previews'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoopBody',
+            fields=[
+                ('loop', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='body', serialize=False, to='loops.loop')),
+                ('data', models.BinaryField()),
+                ('size', models.PositiveIntegerField(default=0, help_text='Uncompressed length in bytes')),
+            ],
+        ),
+        migrations.RunPython(move_content_to_bodies, restore_content),
+        # Reversing re-adds the column before restore_content fills it
+        migrations.AlterField(
+            model_name='loop',
+            name='content',
+            field=models.TextField(default=''),
+        ),
+        migrations.RemoveField(
+            model_name='loop',
+            name='content',
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 6.0 on 2026-10-19 00:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loops', '0014_loop_body'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='render_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='rendered_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='loop',
+            name='render_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='loop',
+            name='video_embed_url',
+            field=models.CharField(blank=True, editable=False, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='loopbody',
+            name='html',
+            field=models.BinaryField(default=b''),
+        ),
+    ]
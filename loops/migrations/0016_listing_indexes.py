@@ -0,0 +1,35 @@
+# Generated by Django 6.0 on 2026-10-19 00:45
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loops', '0015_rendered_html'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='loop',
+            index=models.Index(fields=['-created_at', '-id'], name='loops_loop_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='loop',
+            index=models.Index(fields=['category', '-created_at', '-id'], name='loops_loop_category_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='loop',
+            index=models.Index(fields=['difficulty', '-created_at', '-id'], name='loops_loop_difficulty_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='loop',
+            index=models.Index(fields=['creator', '-created_at', '-id'], name='loops_loop_creator_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='loop',
+            index=models.Index(fields=['-views', '-id'], name='loops_loop_views_idx'),
+        ),
+    ]
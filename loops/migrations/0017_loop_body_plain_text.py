@@ -0,0 +1,50 @@
+# Generated by Django 6.0 on 2026-10-19 09:20
+
+import zlib
+
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+FTS_TABLE = 'loops_loop_fts'
+
+
+def _has_search_index(schema_editor):
+    return FTS_TABLE in schema_editor.connection.introspection.table_names()
+
+
+def decompress_unindexed_bodies(apps, schema_editor):
+    # Without the FTS table only the icontains fallback can search bodies
+    if _has_search_index(schema_editor):
+        return
+    LoopBody = apps.get_model('loops', 'LoopBody')
+    for body in LoopBody.objects.exclude(data=b'').only('pk', 'data').iterator(chunk_size=BATCH_SIZE):
+        text = zlib.decompress(bytes(body.data)).decode('utf-8')
+        LoopBody.objects.filter(pk=body.pk).update(plain_text=text, data=b'')
+
+
+def compress_plain_bodies(apps, schema_editor):
+    LoopBody = apps.get_model('loops', 'LoopBody')
+    for body in LoopBody.objects.filter(data=b'').only('pk', 'plain_text').iterator(chunk_size=BATCH_SIZE):
+        data = zlib.compress(body.plain_text.encode('utf-8'), 6)
+        LoopBody.objects.filter(pk=body.pk).update(data=data, plain_text='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loops', '0016_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loopbody',
+            name='plain_text',
+            field=models.TextField(blank=True, help_text="The body, when it isn't compressed into data"),
+        ),
+        migrations.AlterField(
+            model_name='loopbody',
+            name='data',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+        migrations.RunPython(decompress_unindexed_bodies, compress_plain_bodies),
+    ]
@@ -1,7 +1,15 @@
-from django.db import models
+import uuid
+import zlib
+
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.safestring import mark_safe
+
+from . import blobs, rendering
+from .blobs import AttachmentField, attachment_storage
+from .counters import CountedModel
 
 class Loop(models.Model):
     CATEGORY_CHOICES = [
@@ -26,7 +34,7 @@ class Loop(models.Model):
     
     title = models.CharField(max_length=200)
     description = models.TextField()
-    content = models.TextField()
+    # The lesson body lives in LoopBody; see the content property
     creator = models.ForeignKey(User, on_delete=models.CASCADE, related_name='created_loops')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -37,7 +45,16 @@ class Loop(models.Model):
     
     # Media fields
     video_url = models.URLField(blank=True, null=True, help_text="Optional YouTube/Vimeo link")
-    attachment = models.FileField(upload_to='loop_attachments/', blank=True, null=True)
+    # Stored by content hash (see loops.blobs); attachment_name is the name it was uploaded as
+    attachment = AttachmentField(
+        upload_to='loop_attachments/', storage=attachment_storage, max_length=255, blank=True, null=True,
+    )
+    attachment_name = models.CharField(max_length=255, blank=True)
+    # Rendered in the background from the attachment (see loops.previews)
+    preview = models.ImageField(upload_to='loop_previews/', max_length=255, blank=True)
+    preview_width = models.PositiveSmallIntegerField(null=True, blank=True)
+    preview_height = models.PositiveSmallIntegerField(null=True, blank=True)
+    preview_source = models.CharField(max_length=255, blank=True, help_text="Attachment the preview was made from")
     
     # Premium content
     is_premium = models.BooleanField(default=False)
@@ -45,22 +62,229 @@ class Loop(models.Model):
     is_purchased_by = models.ManyToManyField(User, blank=True, related_name='purchased_loops')
     # Stats
     views = models.PositiveIntegerField(default=0)
+    likes_count = models.PositiveIntegerField(default=0, db_index=True)
+    comments_count = models.PositiveIntegerField(default=0)
+    # Time-decayed popularity, on the scale of the current TrendingEpoch (see loops.trending)
+    trending_score = models.FloatField(default=0, db_index=True)
+    # Bumped whenever something shown on the loop's card changes (see loops.cards)
+    card_version = models.PositiveIntegerField(default=1)
+    # Rendered at save time (see loops.rendering), along with LoopBody.html
+    video_embed_url = models.CharField(max_length=200, blank=True, editable=False)
+    render_version = models.PositiveSmallIntegerField(default=0, editable=False)
     
     class Meta:
         ordering = ['-created_at']
+        # Keyset pages of the listings (see loops.pagination.SORT_ORDERINGS);
+        # likes_count and trending_score sorts use their own column indexes
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='loops_loop_recent_idx'),
+            models.Index(fields=['category', '-created_at', '-id'], name='loops_loop_category_idx'),
+            models.Index(fields=['difficulty', '-created_at', '-id'], name='loops_loop_difficulty_idx'),
+            models.Index(fields=['creator', '-created_at', '-id'], name='loops_loop_creator_idx'),
+            models.Index(fields=['-views', '-id'], name='loops_loop_views_idx'),
+        ]
     
+    # Lesson body: loaded from LoopBody on first access, written back by save()
+    _content = None
+    _content_changed = False
+
     def __str__(self):
         return self.title
+
+    @property
+    def content(self):
+        if self._content is None:
+            try:
+                self._content = self.body.text
+            except LoopBody.DoesNotExist:
+                self._content = ''
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value or ''
+        self._content_changed = True
+
+    @property
+    def content_html(self):
+        if self.render_version == rendering.RENDERER_VERSION and not self._content_changed:
+            try:
+                return mark_safe(self.body.html_text)
+            except LoopBody.DoesNotExist:
+                pass
+        return mark_safe(rendering.render_text(self.content))
+
+    @property
+    def embed_url(self):
+        if self.render_version == rendering.RENDERER_VERSION:
+            return self.video_embed_url
+        return rendering.embed_url(self.video_url)
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        if not self._content_changed:
+            self._content = None
+        if (fields is None or 'attachment' in fields) and 'attachment' not in self.get_deferred_fields():
+            self._stored_attachment = self.attachment.name or ''
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'attachment' in field_names:
+            # What the row points at, so save() can move the blob reference counts
+            instance._stored_attachment = values[field_names.index('attachment')] or ''
+        return instance
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        bumps_card = not self._state.adding and (update_fields is None or CARD_FIELDS & set(update_fields))
+        if bumps_card:
+            # In SQL, so concurrent bumps from likes, comments and previews all count
+            self.card_version = models.F('card_version') + 1
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'card_version'}
+
+        if update_fields is None:
+            # A full save leaves deferred fields alone (see below)
+            saves_attachment = 'attachment' not in self.get_deferred_fields()
+        else:
+            saves_attachment = 'attachment' in update_fields
+        if saves_attachment and not self._state.adding and not hasattr(self, '_stored_attachment'):
+            # Assigned without being loaded first: find what the row points at
+            stored = Loop.objects.filter(pk=self.pk).values_list('attachment', flat=True).first()
+            self._stored_attachment = stored or ''
+        if saves_attachment and not self.attachment:
+            self.attachment_name = ''
+        if update_fields is not None and 'attachment' in update_fields:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'attachment_name'}
+
+        if update_fields is None or 'video_url' in update_fields:
+            self.video_embed_url = rendering.embed_url(self.video_url)
+            if update_fields is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'video_embed_url'}
+        if update_fields is None and self.render_version != rendering.RENDERER_VERSION:
+            if not self._state.adding and not self._content_changed:
+                # Re-render the stored body along with everything else
+                self.content = self.content
+            self.render_version = rendering.RENDERER_VERSION
+
+        saves_content = self._content_changed and (update_fields is None or 'content' in update_fields)
+        if update_fields is not None and 'content' in update_fields:
+            # Not a column; the row itself only needs its timestamp bumped
+            kwargs['update_fields'] = ({*kwargs['update_fields']} - {'content'}) | {'updated_at'}
+
+        if update_fields is None and not self._state.adding:
+            # A full save (an edited form, say) must not write back counters
+            # this instance loaded before any likes, comments or views since
+            # (and, as Django does for a full save, leave deferred fields alone)
+            kwargs['update_fields'] = {
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in self.get_deferred_fields()
+            } - STAT_FIELDS
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if bumps_card:
+                self.card_version = Loop.objects.values_list('card_version', flat=True).get(pk=self.pk)
+            if saves_attachment:
+                self._move_attachment_reference()
+            if saves_content:
+                LoopBody.store(self.pk, self._content)
+                self._content_changed = False
+
+    def _move_attachment_reference(self):
+        previous = getattr(self, '_stored_attachment', '')
+        current = self.attachment.name or ''
+        if previous != current:
+            blobs.retain(current)
+            blobs.release(previous)
+        self._stored_attachment = current
     
     def get_absolute_url(self):
         return reverse('loop_detail', kwargs={'pk': self.pk})
     
     def increment_views(self):
-        self.views += 1
-        self.save(update_fields=['views'])
+        from .view_counter import record_view
+        record_view(self)
+
+
+class LoopBody(models.Model):
+    """
+    A loop's lesson body, kept out of the hot ``loops_loop`` rows.
+
+    Bodies are zlib-compressed in ``data`` where the FTS index (see
+    loops.search) can search them. Without it they're kept as plain text,
+    so the ``icontains`` fallback search still matches lesson bodies.
+    """
+    loop = models.OneToOneField(Loop, on_delete=models.CASCADE, primary_key=True, related_name='body')
+    data = models.BinaryField(blank=True, default=b'')
+    plain_text = models.TextField(blank=True, help_text="The body, when it isn't compressed into data")
+    size = models.PositiveIntegerField(default=0, help_text="Uncompressed length in bytes")
+    # The body rendered by loops.rendering, compressed the same way
+    html = models.BinaryField(default=b'')
+
+    COMPRESSION_LEVEL = 6
+
+    def __str__(self):
+        return f"Body of loop {self.loop_id} ({self.size} bytes)"
+
+    @classmethod
+    def pack(cls, text):
+        raw = (text or '').encode('utf-8')
+        return zlib.compress(raw, cls.COMPRESSION_LEVEL), len(raw)
+
+    @staticmethod
+    def unpack(data):
+        return zlib.decompress(bytes(data)).decode('utf-8') if data else ''
+
+    @classmethod
+    def text_from(cls, data, plain_text):
+        """The body from its stored ``data`` and ``plain_text`` columns, whichever holds it."""
+        return cls.unpack(data) if data else (plain_text or '')
+
+    @staticmethod
+    def compresses():
+        from . import search
+        return search.fts_available()
+
+    @property
+    def text(self):
+        return self.text_from(self.data, self.plain_text)
+
+    @property
+    def html_text(self):
+        return self.unpack(self.html)
+
+    @classmethod
+    def _columns(cls, text):
+        data, size = cls.pack(text)
+        html, _ = cls.pack(rendering.render_text(text))
+        if not cls.compresses():
+            data, plain_text = b'', text or ''
+        else:
+            plain_text = ''
+        return {'data': data, 'plain_text': plain_text, 'size': size, 'html': html}
+
+    @classmethod
+    def for_loop(cls, loop_id, text):
+        return cls(loop_id=loop_id, **cls._columns(text))
 
+    @classmethod
+    def store(cls, loop_id, text):
+        cls.objects.update_or_create(loop_id=loop_id, defaults=cls._columns(text))
 
-class Like(models.Model):
+
+# Fields rendered on a loop card; saving any of them invalidates the cached card
+CARD_FIELDS = {
+    'title', 'description', 'category', 'difficulty', 'creator', 'creator_id',
+    'is_premium', 'price', 'likes_count', 'comments_count',
+}
+
+# Columns only ever changed with F() updates; a full save() leaves them alone
+STAT_FIELDS = {'views', 'likes_count', 'comments_count', 'trending_score'}
+
+
+class Like(CountedModel):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     loop = models.ForeignKey(Loop, on_delete=models.CASCADE, related_name='likes')
     created_at = models.DateTimeField(auto_now_add=True)
@@ -73,15 +297,100 @@ class Like(models.Model):
         return f"{self.user.username} liked {self.loop.title}"
 
 
-class Comment(models.Model):
+class Comment(CountedModel):
     loop = models.ForeignKey(Loop, on_delete=models.CASCADE, related_name='comments')
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
+    # content rendered by loops.rendering when saved
+    rendered_html = models.TextField(blank=True, editable=False)
+    render_version = models.PositiveSmallIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # Newest-first keyset pages of one loop's comments
+            models.Index(fields=['loop', '-created_at', '-id'], name='loops_comment_recent_idx'),
+        ]
     
     def __str__(self):
-        return f"Comment by {self.user.username} on {self.loop.title}"
\ No newline at end of file
+        return f"Comment by {self.user.username} on {self.loop.title}"
+
+    @property
+    def content_html(self):
+        if self.render_version == rendering.RENDERER_VERSION:
+            return mark_safe(self.rendered_html)
+        return mark_safe(rendering.render_text(self.content))
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'content' in update_fields:
+            self.rendered_html = rendering.render_text(self.content)
+            self.render_version = rendering.RENDERER_VERSION
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'rendered_html', 'render_version'}
+        super().save(*args, **kwargs)
+
+
+class TrendingEpoch(models.Model):
+    """Single row holding the reference time trending scores are amplified from."""
+    epoch = models.FloatField(help_text="Unix timestamp")
+
+    def __str__(self):
+        return f"Trending epoch {self.epoch}"
+
+
+class LoopSimilarity(models.Model):
+    """Precomputed nearest neighbours of a loop (see loops.similarity)."""
+    loop = models.ForeignKey(Loop, on_delete=models.CASCADE, related_name='similarities')
+    similar = models.ForeignKey(Loop, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+
+    class Meta:
+        unique_together = ['loop', 'similar']
+        indexes = [
+            models.Index(fields=['loop', '-score'], name='loops_similarity_top_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.loop_id} ~ {self.similar_id} ({self.score:.2f})"
+
+
+class ChunkedUpload(models.Model):
+    """An attachment being uploaded in chunks (see loops.uploads)."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chunked_uploads')
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0, help_text="Bytes received so far")
+    # Expected SHA-256 from the client (optional), replaced by the actual one on completion
+    sha256 = models.CharField(max_length=64, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size})"
+
+    @property
+    def is_complete(self):
+        return self.completed_at is not None
+
+
+class AttachmentBlob(models.Model):
+    """A stored attachment file and how many loops point at it (see loops.blobs)."""
+    name = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # When the count last dropped to zero; the sweep deletes the file after a grace period
+    released_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ref_count', 'released_at'], name='loops_blob_sweep_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.ref_count} refs)"
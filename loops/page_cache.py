@@ -0,0 +1,174 @@
+"""
+Whole-page cache for anonymous visitors.
+
+``@cache_anonymous_page`` stores the rendered page for anonymous GETs,
+keyed on the path and the normalized query string (sorted, blanks and
+tracking parameters dropped). Each entry remembers the catalog version it
+was rendered at; ``bump_catalog()`` (called from signals whenever a loop
+changes) makes every entry stale at once. Likes and comments only
+``bump_loop()`` their loop, which makes that loop's detail page stale;
+the counts shown on listing pages catch up within
+``LOOP_PAGE_CACHE_FRESH`` seconds.
+
+A stale entry is still served while one request, holding a short lock,
+renders the replacement, so a catalog change or an expired entry doesn't
+send every concurrent visitor to the database. Responses carry an ETag and
+a Last-Modified (the catalog version, which starts from the latest
+``Loop.updated_at``), so browsers revalidating get a 304.
+
+The catalog version lives in the cache; with a per-process cache each
+process only sees its own bumps, so keep ``LOOP_PAGE_CACHE_FRESH`` short
+unless a shared cache is configured.
+"""
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db.models import Max
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+VERSION_KEY = 'pagecache:catalog'
+LOOP_VERSION_KEY = 'pagecache:loop:{}'
+ENTRY_KEY = 'pagecache:page:{}'
+LOCK_KEY = 'pagecache:lock:{}'
+
+# Query parameters that never change what the page shows
+IGNORED_PARAMS = {'fbclid', 'gclid'}
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def catalog_version():
+    """Timestamp of the last catalog change, as a float."""
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        from .models import Loop
+
+        latest = Loop.objects.aggregate(latest=Max('updated_at'))['latest']
+        version = latest.timestamp() if latest else 0.0
+        cache.add(VERSION_KEY, version, None)
+    return version
+
+
+def bump_catalog():
+    cache.set(VERSION_KEY, time.time(), None)
+
+
+def loop_version(loop_id):
+    """Timestamp of the last change to one loop's likes or comments (0.0 if none recently)."""
+    return cache.get(LOOP_VERSION_KEY.format(loop_id), 0.0)
+
+
+def bump_loop(loop_id):
+    # Only needs to outlive the pages it invalidates
+    timeout = _setting('LOOP_PAGE_CACHE_FRESH', 30) + _setting('LOOP_PAGE_CACHE_STALE', 300)
+    cache.set(LOOP_VERSION_KEY.format(loop_id), time.time(), timeout)
+
+
+def normalized_query(query_dict):
+    items = sorted(
+        (key, value)
+        for key, values in query_dict.lists()
+        for value in values
+        if value and key not in IGNORED_PARAMS and not key.startswith('utm_')
+    )
+    return '&'.join(f'{key}={value}' for key, value in items)
+
+
+def page_key(request):
+    digest = hashlib.md5(f'{request.path}?{normalized_query(request.GET)}'.encode()).hexdigest()
+    return ENTRY_KEY.format(digest)
+
+
+def _cacheable_request(request):
+    if request.method not in ('GET', 'HEAD') or request.user.is_authenticated:
+        return False
+    # Pending flash messages are rendered into the page; len() doesn't consume them
+    return not len(get_messages(request))
+
+
+def _cacheable_response(response):
+    return (
+        response.status_code == 200
+        and not response.streaming
+        and not response.cookies
+        and not response.has_header('Set-Cookie')
+    )
+
+
+def _finish(request, response, entry, status):
+    response['ETag'] = entry['etag']
+    response['Last-Modified'] = http_date(int(entry['version']))
+    response['X-Page-Cache'] = status
+    # Browsers must revalidate, and never reuse an anonymous page once logged in
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ('Cookie',))
+    return get_conditional_response(
+        request, etag=entry['etag'], last_modified=int(entry['version']), response=response,
+    )
+
+
+def cache_anonymous_page(view_func=None, on_hit=None, loop_kwarg=None):
+    """
+    Cache a view's page for anonymous visitors. ``on_hit(request, *args,
+    **kwargs)`` runs when a cached page is served instead of the view, e.g.
+    to still count a view. Pages of a single loop name the URL kwarg holding
+    its id in ``loop_kwarg``, so ``bump_loop()`` makes them stale too.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if not _setting('LOOP_PAGE_CACHE_ENABLED', True) or not _cacheable_request(request):
+                return view(request, *args, **kwargs)
+
+            version = catalog_version()
+            if loop_kwarg is not None:
+                version = max(version, loop_version(kwargs[loop_kwarg]))
+            key = page_key(request)
+            lock_key = LOCK_KEY.format(key)
+            locked = False
+
+            entry = cache.get(key)
+            if entry is not None:
+                age = time.time() - entry['created']
+                fresh = entry['version'] == version and age < _setting('LOOP_PAGE_CACHE_FRESH', 30)
+                if not fresh:
+                    # Only one request re-renders; everyone else keeps getting the stale copy
+                    locked = cache.add(lock_key, 1, _setting('LOOP_PAGE_CACHE_LOCK_TIMEOUT', 30))
+                if fresh or not locked:
+                    if on_hit:
+                        on_hit(request, *args, **kwargs)
+                    response = HttpResponse(entry['content'], content_type=entry['content_type'])
+                    return _finish(request, response, entry, 'HIT' if fresh else 'STALE')
+
+            try:
+                response = view(request, *args, **kwargs)
+                if hasattr(response, 'render') and callable(response.render):
+                    response = response.render()
+                if not _cacheable_response(response):
+                    return response
+                entry = {
+                    'content': response.content,
+                    'content_type': response['Content-Type'],
+                    'version': version,
+                    'created': time.time(),
+                    'etag': '"%s"' % hashlib.md5(response.content).hexdigest(),
+                }
+                fresh_for = _setting('LOOP_PAGE_CACHE_FRESH', 30)
+                cache.set(key, entry, fresh_for + _setting('LOOP_PAGE_CACHE_STALE', 300))
+            finally:
+                if locked:
+                    cache.delete(lock_key)
+            return _finish(request, response, entry, 'MISS')
+        return wrapped
+
+    if view_func is not None:
+        return decorator(view_func)
+    return decorator
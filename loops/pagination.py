@@ -0,0 +1,180 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are fetched with ``WHERE (sort_key, pk) < (last_key, last_pk)``
+instead of ``OFFSET``, so page 500 costs the same as page 1. Cursors are
+opaque URL-safe tokens holding the boundary row's sort values and the
+ordering they belong to; a cursor from another sort gives the first page.
+"""
+import base64
+import binascii
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+
+# ?sort= value -> ordering used for keyset pagination (always ends in pk)
+SORT_ORDERINGS = {
+    '-created_at': ('-created_at', '-pk'),
+    'created_at': ('created_at', 'pk'),
+    '-views': ('-views', '-pk'),
+    '-likes_count': ('-likes_count', '-pk'),
+    'trending': ('-trending_score', '-pk'),
+}
+
+COUNT_CACHE_TIMEOUT = 5 * 60
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values, direction, ordering):
+    payload = {'v': values, 'd': direction, 'o': ','.join(ordering)}
+    payload = json.dumps(payload, separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, ordering):
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        values, direction = payload['v'], payload['d']
+        same_ordering = payload.get('o') == ','.join(ordering)
+    except (binascii.Error, ValueError, KeyError, TypeError, AttributeError, UnicodeDecodeError):
+        raise InvalidCursor(token)
+    if direction not in ('next', 'prev') or not isinstance(values, list) or not same_ordering:
+        raise InvalidCursor(token)
+    return values, direction
+
+
+class CursorPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    @property
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+
+class CursorPaginator:
+    def __init__(self, queryset, ordering, per_page=12):
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+        self.per_page = per_page
+        self.fields = [field.lstrip('-') for field in self.ordering]
+        self.descending = [field.startswith('-') for field in self.ordering]
+
+    def get_page(self, cursor=None):
+        """Return the page after/before ``cursor``; an unusable cursor gives the first page."""
+        values, direction = None, 'next'
+        if cursor:
+            try:
+                values, direction = decode_cursor(cursor, self.ordering)
+                values = self._to_python(values)
+            except InvalidCursor:
+                values, direction = None, 'next'
+
+        backwards = direction == 'prev'
+        queryset = self.queryset.order_by(*(self._reversed() if backwards else self.ordering))
+        if values is not None:
+            queryset = queryset.filter(self._boundary(values, backwards))
+
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+
+        if not rows:
+            return CursorPage(rows)
+
+        if backwards:
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, values is not None
+
+        return CursorPage(
+            rows,
+            next_cursor=encode_cursor(self._values_of(rows[-1]), 'next', self.ordering) if has_next else None,
+            previous_cursor=encode_cursor(self._values_of(rows[0]), 'prev', self.ordering) if has_previous else None,
+        )
+
+    def _reversed(self):
+        return tuple(field[1:] if field.startswith('-') else f'-{field}' for field in self.ordering)
+
+    def _values_of(self, obj):
+        values = []
+        for field in self.fields:
+            value = getattr(obj, field)
+            values.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+        return values
+
+    def _to_python(self, values):
+        if len(values) != len(self.fields):
+            raise InvalidCursor(values)
+        model = self.queryset.model
+        converted = []
+        for field, value in zip(self.fields, values):
+            if field == 'pk':
+                field = model._meta.pk.name
+            try:
+                model_field = model._meta.get_field(field)
+            except FieldDoesNotExist:
+                # Annotations (e.g. search_rank) have no model field
+                converted.append(value)
+                continue
+            try:
+                converted.append(model_field.to_python(value))
+            except ValidationError:
+                raise InvalidCursor(values)
+        return converted
+
+    def _boundary(self, values, backwards):
+        """Build ``(a, b, c) > (x, y, z)`` as nested ORs, honouring each field's direction."""
+        condition = Q()
+        for i, (field, value) in enumerate(zip(self.fields, values)):
+            descending = self.descending[i] != backwards
+            lookup = 'lt' if descending else 'gt'
+            step = Q(**{f'{field}__{lookup}': value})
+            for prior_field, prior_value in zip(self.fields[:i], values[:i]):
+                step &= Q(**{prior_field: prior_value})
+            condition |= step
+        return condition
+
+
+def estimated_count(queryset, timeout=COUNT_CACHE_TIMEOUT):
+    """
+    Count ``queryset`` at most once every ``timeout`` seconds.
+
+    The number can be a few minutes stale, which is fine for "about N loops"
+    labels and keeps deep pages from re-counting the whole filtered set.
+    """
+    sql, params = queryset.order_by().query.sql_with_params()
+    key = 'count:' + hashlib.md5(f'{sql}|{params!r}'.encode()).hexdigest()
+    total = cache.get(key)
+    if total is None:
+        total = queryset.order_by().count()
+        cache.set(key, total, timeout)
+    return total
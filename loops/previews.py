@@ -0,0 +1,192 @@
+"""
+Preview images for loop attachments.
+
+After a loop is saved with a new attachment, ``schedule()`` queues it on a
+small worker pool that renders a preview off the request path: image
+attachments are thumbnailed with Pillow, PDFs get their first page
+(``pdftoppm``) and videos a frame (``ffmpeg``) when those tools are
+installed. Previews are saved as WebP (JPEG if Pillow lacks WebP) under
+``loop_previews/``, named after the attachment blob they were made from,
+so identical attachments share one preview. Premium loops get no preview:
+``loop_previews/`` is public, and the attachment is only for buyers.
+
+The preview's name and size are stored on the loop itself, so listing
+cards show it without any extra work per request. ``manage.py
+generate_previews`` fills in loops saved before this existed.
+"""
+import io
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from PIL import Image, ImageOps, features
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_DIR = 'loop_previews'
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff'}
+VIDEO_EXTENSIONS = {'.mp4', '.mov', '.m4v', '.webm', '.mkv', '.avi'}
+# External renderers get this long before the attachment is treated as unpreviewable
+TOOL_TIMEOUT = 60
+
+
+def max_size():
+    return getattr(settings, 'LOOP_PREVIEW_SIZE', (640, 360))
+
+
+def _format():
+    return ('WEBP', '.webp') if features.check('webp') else ('JPEG', '.jpg')
+
+
+def _thumbnail(image):
+    """Encode ``image`` as a preview; returns ``(bytes, width, height)``."""
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail(max_size(), Image.Resampling.LANCZOS)
+    if image.mode not in ('RGB', 'L'):
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image.convert('RGBA'), mask=image.convert('RGBA').getchannel('A'))
+        image = background
+    fmt, _ = _format()
+    out = io.BytesIO()
+    if fmt == 'WEBP':
+        image.save(out, fmt, quality=80, method=4)
+    else:
+        image.save(out, fmt, quality=80, optimize=True)
+    return out.getvalue(), image.width, image.height
+
+
+def _render_with(command, output):
+    """Run an external renderer writing ``output``; returns the opened image or None."""
+    if shutil.which(command[0]) is None:
+        return None
+    try:
+        subprocess.run(command, check=True, capture_output=True, timeout=TOOL_TIMEOUT)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as e:
+        logger.info("%s couldn't render a preview: %s", command[0], e)
+        return None
+    if not os.path.exists(output):
+        return None
+    with Image.open(output) as image:
+        return image.copy()
+
+
+def render(path):
+    """Render a preview of the file at ``path``; returns ``(bytes, width, height)`` or None."""
+    ext = os.path.splitext(path)[1].lower()
+    width = max_size()[0]
+    if ext in IMAGE_EXTENSIONS:
+        try:
+            with Image.open(path) as image:
+                image.draft('RGB', max_size())
+                return _thumbnail(image)
+        except (OSError, Image.DecompressionBombError) as e:
+            logger.info("Not a usable image %s: %s", path, e)
+            return None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, 'preview.png')
+        if ext == '.pdf':
+            image = _render_with(
+                ['pdftoppm', '-f', '1', '-l', '1', '-singlefile', '-png', '-scale-to', str(width),
+                 path, output[:-len('.png')]],
+                output,
+            )
+        elif ext in VIDEO_EXTENSIONS:
+            image = _render_with(
+                ['ffmpeg', '-nostdin', '-loglevel', 'error', '-ss', '1', '-i', path,
+                 '-frames:v', '1', '-vf', f'scale={width}:-2', '-y', output],
+                output,
+            )
+        else:
+            return None
+        return _thumbnail(image) if image is not None else None
+
+
+def preview_name(attachment_name):
+    blob = os.path.splitext(os.path.basename(attachment_name))[0]
+    return f'{PREVIEW_DIR}/{blob}{_format()[1]}'
+
+
+def source_for(attachment, is_premium):
+    """The attachment a loop's preview should be made from ('' for none)."""
+    return '' if is_premium else (attachment or '')
+
+
+def prepare(source, path):
+    """
+    Render (or reuse) the preview for attachment blob ``source`` stored at
+    ``path``; returns the field changes for the loop. No database access,
+    so it can run on any thread.
+    """
+    changes = {'preview': '', 'preview_width': None, 'preview_height': None}
+    if not source:
+        return changes
+    name = preview_name(source)
+    if default_storage.exists(name):
+        with default_storage.open(name) as f, Image.open(f) as image:
+            changes.update(preview=name, preview_width=image.width, preview_height=image.height)
+        return changes
+    rendered = render(path)
+    if rendered is not None:
+        data, width, height = rendered
+        name = default_storage.save(name, ContentFile(data))
+        changes.update(preview=name, preview_width=width, preview_height=height)
+    return changes
+
+
+def apply(loop_id, attachment, is_premium, changes):
+    """Store ``changes`` unless the loop's attachment or premium flag has moved on since."""
+    from . import page_cache
+    from .models import Loop
+
+    updated = Loop.objects.filter(pk=loop_id, attachment=attachment, is_premium=is_premium).update(
+        preview_source=source_for(attachment, is_premium), card_version=F('card_version') + 1, **changes,
+    )
+    if updated:
+        page_cache.bump_catalog()
+    return bool(updated)
+
+
+def generate(loop_id):
+    """Bring one loop's preview in line with its attachment. Returns True if it changed."""
+    from .models import Loop
+
+    loop = Loop.objects.filter(pk=loop_id).only('pk', 'attachment', 'is_premium', 'preview_source').first()
+    if loop is None:
+        return False
+    attachment = loop.attachment.name or ''
+    source = source_for(attachment, loop.is_premium)
+    if source == loop.preview_source:
+        return False
+    changes = prepare(source, loop.attachment.path if source else None)
+    return apply(loop_id, attachment, loop.is_premium, changes)
+
+
+_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'LOOP_PREVIEW_WORKERS', 2), thread_name_prefix='previews')
+
+
+def _generate_in_background(loop_id):
+    close_old_connections()
+    try:
+        generate(loop_id)
+    except Exception:
+        logger.exception("Generating the preview for loop %s failed", loop_id)
+    finally:
+        from django.db import connection
+        connection.close()
+
+
+def schedule(loop_id):
+    """Generate ``loop_id``'s preview once the current transaction commits."""
+    if getattr(settings, 'LOOP_PREVIEW_ASYNC', True):
+        transaction.on_commit(lambda: _executor.submit(_generate_in_background, loop_id))
+    else:
+        transaction.on_commit(lambda: generate(loop_id))
@@ -0,0 +1,96 @@
+"""
+HTML rendered from what creators and commenters type.
+
+Lesson bodies and comments are turned into escaped paragraphs, and a
+loop's video link into its player URL, once when they're saved rather
+than by template filters on every page view. Each rendered row records
+the ``RENDERER_VERSION`` it was made with; bump it whenever the output of
+this module changes and run ``manage.py rerender_content`` to bring the
+stored HTML up to date. Until then, stale rows are rendered on the fly,
+so pages are correct either way.
+"""
+from urllib.parse import parse_qs, urlparse
+
+from django.utils.html import linebreaks
+
+RENDERER_VERSION = 1
+
+
+def render_text(text):
+    """Escaped plain text with blank lines as paragraphs and newlines as ``<br>``."""
+    return linebreaks(text or '', autoescape=True)
+
+
+def embed_url(url):
+    """Turn a YouTube/Vimeo link into its embeddable player URL ('' for anything else)."""
+    if not url:
+        return ''
+
+    parsed = urlparse(url)
+    host = (parsed.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+
+    if host in ('youtube.com', 'm.youtube.com'):
+        if parsed.path.startswith('/embed/'):
+            return url
+        video_id = parse_qs(parsed.query).get('v', [''])[0]
+        if video_id:
+            return f"https://www.youtube.com/embed/{video_id}"
+
+    if host == 'youtu.be':
+        video_id = parsed.path.lstrip('/')
+        if video_id:
+            return f"https://www.youtube.com/embed/{video_id}"
+
+    if host == 'vimeo.com':
+        video_id = parsed.path.strip('/').split('/')[0]
+        if video_id.isdigit():
+            return f"https://player.vimeo.com/video/{video_id}"
+
+    if host == 'player.vimeo.com':
+        return url
+
+    # Anything else is not embedded
+    return ''
+
+
+def rerender(batch_size=500, everything=False):
+    """
+    Re-render stored HTML made with an older renderer (every row with
+    ``everything``). Returns ``(loops, comments)`` re-rendered.
+    """
+    from .models import Comment, Loop, LoopBody
+
+    loops = comments = 0
+    stale_loops = Loop.objects.all() if everything else Loop.objects.exclude(render_version=RENDERER_VERSION)
+    last_pk = 0
+    while True:
+        batch = list(
+            stale_loops.filter(pk__gt=last_pk).order_by('pk')
+            .values_list('pk', 'video_url', 'body__data', 'body__plain_text')[:batch_size]
+        )
+        if not batch:
+            break
+        for pk, video_url, data, plain_text in batch:
+            if data is not None:
+                html = render_text(LoopBody.text_from(data, plain_text))
+                LoopBody.objects.filter(loop_id=pk).update(html=LoopBody.pack(html)[0])
+            # update() rather than save(): nothing on the cached cards changes
+            Loop.objects.filter(pk=pk).update(video_embed_url=embed_url(video_url), render_version=RENDERER_VERSION)
+        loops += len(batch)
+        last_pk = batch[-1][0]
+
+    stale_comments = Comment.objects.all() if everything else Comment.objects.exclude(render_version=RENDERER_VERSION)
+    last_pk = 0
+    while True:
+        batch = list(stale_comments.filter(pk__gt=last_pk).order_by('pk').only('pk', 'content')[:batch_size])
+        if not batch:
+            break
+        for comment in batch:
+            comment.rendered_html = render_text(comment.content)
+            comment.render_version = RENDERER_VERSION
+        Comment.objects.bulk_update(batch, ['rendered_html', 'render_version'])
+        comments += len(batch)
+        last_pk = batch[-1].pk
+    return loops, comments
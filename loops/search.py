@@ -0,0 +1,144 @@
+"""
+Full-text search over loops.
+
+On SQLite the catalog is mirrored into an FTS5 table (``loops_loop_fts``)
+which is kept in sync from the Loop signals and can be rebuilt with
+``manage.py rebuild_search_index``. Results are ranked with BM25 and every
+search term is treated as a prefix. Without the FTS table (on other
+database backends, say) searches fall back to plain ``icontains``
+filtering, and lesson bodies are stored uncompressed (see ``LoopBody``) so
+the fallback still matches them.
+"""
+import re
+
+from django.db import connections, router
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'loops_loop_fts'
+
+# Loop columns copied into the index; the body (content) lives in LoopBody
+INDEXED_FIELDS = {'title', 'description', 'category'}
+
+# BM25 column weights: title, description, content, category
+BM25_WEIGHTS = (10.0, 4.0, 1.0, 2.0)
+
+CREATE_FTS_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    "title, description, content, category, "
+    "tokenize = 'unicode61 remove_diacritics 2')"
+)
+
+
+def _connection():
+    from .models import Loop
+    return connections[router.db_for_write(Loop)]
+
+
+# Database aliases where the FTS table is known to exist
+_fts_ready = set()
+
+
+def is_supported():
+    return _connection().vendor == 'sqlite'
+
+
+def fts_available(connection=None):
+    connection = connection or _connection()
+    if connection.vendor != 'sqlite':
+        return False
+    if connection.alias not in _fts_ready:
+        if FTS_TABLE not in connection.introspection.table_names(include_views=False):
+            return False
+        _fts_ready.add(connection.alias)
+    return True
+
+
+def build_match_query(text):
+    """Turn free text into an FTS5 query where every word is a prefix match."""
+    terms = re.findall(r'\w+', text or '', flags=re.UNICODE)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def _category_text(loop):
+    return f"{loop.category} {loop.get_category_display()}"
+
+
+def index_loop(loop):
+    """Insert or refresh one loop in the search index."""
+    connection = _connection()
+    if not fts_available(connection):
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [loop.pk])
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, title, description, content, category) "
+            "VALUES (%s, %s, %s, %s, %s)",
+            [loop.pk, loop.title, loop.description, loop.content, _category_text(loop)],
+        )
+
+
+def remove_loop(loop_id):
+    connection = _connection()
+    if not fts_available(connection):
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [loop_id])
+
+
+def rebuild_index(batch_size=1000):
+    """Recreate the search index from scratch. Returns the number of loops indexed."""
+    from .models import Loop
+
+    connection = _connection()
+    indexed = 0
+    with connection.cursor() as cursor:
+        cursor.execute(CREATE_FTS_SQL)
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+
+        last_pk = 0
+        while True:
+            batch = list(
+                Loop.objects.filter(pk__gt=last_pk).order_by('pk').select_related('body')
+                .only('pk', 'title', 'description', 'category', 'body__data', 'body__plain_text')[:batch_size]
+            )
+            if not batch:
+                break
+            cursor.executemany(
+                f"INSERT INTO {FTS_TABLE} (rowid, title, description, content, category) "
+                "VALUES (%s, %s, %s, %s, %s)",
+                [(loop.pk, loop.title, loop.description, loop.content, _category_text(loop)) for loop in batch],
+            )
+            indexed += len(batch)
+            last_pk = batch[-1].pk
+
+        # Merge index segments so lookups stay fast
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    return indexed
+
+
+def search_loops(queryset, text):
+    """
+    Filter ``queryset`` down to loops matching ``text``.
+
+    With FTS5 the result is annotated with ``search_rank`` (lower is more
+    relevant) so callers can order by it.
+    """
+    match = build_match_query(text)
+    if not match or not fts_available():
+        return queryset.filter(
+            Q(title__icontains=text) |
+            Q(description__icontains=text) |
+            Q(body__plain_text__icontains=text) |
+            Q(category__icontains=text)
+        )
+
+    weights = ', '.join(str(weight) for weight in BM25_WEIGHTS)
+    table = queryset.model._meta.db_table
+    # Join the FTS table directly: a correlated subquery per row would rerun
+    # the MATCH for every candidate and get slower as the catalog grows.
+    return queryset.extra(
+        tables=[FTS_TABLE],
+        where=[f"{FTS_TABLE}.rowid = {table}.id", f"{FTS_TABLE} MATCH %s"],
+        params=[match],
+    ).annotate(search_rank=RawSQL(f"bm25({FTS_TABLE}, {weights})", ()))
@@ -0,0 +1,98 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import blobs, counters, entitlements, page_cache, previews, search, similarity
+from .models import Comment, Like, Loop
+
+
+@receiver(post_save, sender=Loop)
+def index_loop_for_search(sender, instance, update_fields=None, **kwargs):
+    # Counter and card_version updates don't change anything searchable
+    if update_fields and not search.INDEXED_FIELDS & set(update_fields) and not instance._content_changed:
+        return
+    search.index_loop(instance)
+
+
+@receiver(post_save, sender=Loop)
+def update_similar_loops(sender, instance, update_fields=None, **kwargs):
+    # A changed body isn't in update_fields: it's saved to LoopBody, not a column
+    if update_fields and not {'title', 'description'} & set(update_fields) and not instance._content_changed:
+        return
+    similarity.schedule_update(instance.pk)
+
+
+@receiver(post_save, sender=Loop)
+def update_preview(sender, instance, update_fields=None, **kwargs):
+    if update_fields and not {'attachment', 'is_premium'} & set(update_fields):
+        return
+    if previews.source_for(instance.attachment.name, instance.is_premium) != instance.preview_source:
+        previews.schedule(instance.pk)
+
+
+@receiver(post_delete, sender=Loop)
+def remove_loop_from_search(sender, instance, **kwargs):
+    search.remove_loop(instance.pk)
+
+
+@receiver(post_delete, sender=Loop)
+def release_attachment(sender, instance, **kwargs):
+    # The file itself goes in the next sweep_attachments run
+    blobs.release(instance.attachment.name)
+
+
+# Having these receivers means Django loads every cascaded like and comment
+# instead of fast-deleting them. Rows that go with their loop are skipped, so
+# a deleted loop costs no counter updates; a deleted user still costs one
+# UPDATE per like or comment they left on other loops.
+
+@receiver(pre_delete, sender=Loop)
+def note_loop_deletion(sender, instance, origin=None, **kwargs):
+    # pre_delete runs for every collected object before anything is deleted
+    if origin is not None:
+        if not hasattr(origin, '_deleting_loop_ids'):
+            origin._deleting_loop_ids = set()
+        origin._deleting_loop_ids.add(instance.pk)
+
+
+@receiver(post_delete, sender=Like)
+@receiver(post_delete, sender=Comment)
+def decrement_loop_counter(sender, instance, origin=None, **kwargs):
+    if instance.loop_id in getattr(origin, '_deleting_loop_ids', ()):
+        return
+    # Runs inside the delete's transaction, for querysets and cascades too
+    counters.adjust(sender, instance.loop_id, -1)
+
+
+@receiver(post_delete, sender=Loop)
+def forget_loop_deletion(sender, instance, origin=None, **kwargs):
+    getattr(origin, '_deleting_loop_ids', set()).discard(instance.pk)
+
+
+@receiver(post_save, sender=Loop)
+@receiver(post_delete, sender=Loop)
+def invalidate_anonymous_pages(sender, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= {'views'}:
+        return
+    page_cache.bump_catalog()
+
+
+@receiver(post_save, sender=Like)
+@receiver(post_delete, sender=Like)
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_loop_page(sender, instance, **kwargs):
+    # Listings show the counts too, but can lag behind until their pages go stale
+    page_cache.bump_loop(instance.loop_id)
+
+
+@receiver(m2m_changed, sender=Loop.is_purchased_by.through)
+def invalidate_entitlements(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # user.purchased_loops changed
+        entitlements.invalidate(instance.pk)
+    elif action == 'pre_clear':
+        entitlements.invalidate(*instance.is_purchased_by.values_list('pk', flat=True))
+    elif pk_set:
+        entitlements.invalidate(*pk_set)
@@ -0,0 +1,323 @@
+"""
+Content-based "similar loops".
+
+Each loop's title, description and content (weighted 3:2:1) are turned
+into a TF-IDF vector over hashed terms, so no vocabulary has to be kept in
+step between runs. ``rebuild()`` vectorizes the whole catalog into a
+sparse matrix, takes every loop's top-K neighbours by cosine similarity
+(block by block, so memory stays bounded) and stores them in
+``LoopSimilarity``; the detail page then needs a single indexed lookup.
+
+The matrix and IDF weights are saved to ``LOOP_SIMILARITY_PATH``. When a
+loop is created or edited, ``update_loop()`` scores it against that
+snapshot, replaces its own neighbours and slots it into the lists of the
+loops it resembles. New loops only become candidates for *other* new
+loops at the next rebuild, so run ``manage.py rebuild_similarity`` nightly.
+"""
+import logging
+import os
+import re
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+
+N_FEATURES = 2 ** 18
+FIELD_WEIGHTS = (('title', 3.0), ('description', 2.0), ('content', 1.0))
+# Keep only a document's strongest terms; the tail adds noise and cost
+TERMS_PER_LOOP = 100
+MIN_DF = 2
+MAX_DF_RATIO = 0.5
+
+_TOKEN = re.compile(r'[a-z0-9]{2,}')
+STOP_WORDS = frozenset("""
+    about after all also an and any are as at be been but by can do for from has have how if in
+    into is it its just more most no not of on or our so such than that the their them then there
+    these they this to up use was we were what when which who will with you your
+""".split())
+
+_hash_cache = {}
+
+
+def top_k():
+    return getattr(settings, 'LOOP_SIMILARITY_TOP_K', 10)
+
+
+def _feature(token):
+    feature = _hash_cache.get(token)
+    if feature is None:
+        feature = _hash_cache[token] = zlib.crc32(token.encode()) & (N_FEATURES - 1)
+    return feature
+
+
+def term_weights(title, description, content):
+    """Return ``{feature: weighted term count}`` for one loop."""
+    counts = {}
+    for (_, weight), text in zip(FIELD_WEIGHTS, (title, description, content)):
+        for token in _TOKEN.findall((text or '').lower()):
+            if token not in STOP_WORDS:
+                feature = _feature(token)
+                counts[feature] = counts.get(feature, 0.0) + weight
+    return counts
+
+
+def _tf_matrix(rows):
+    """Sublinear term-frequency matrix for ``(title, description, content)`` rows."""
+    indptr, indices, data = [0], [], []
+    for title, description, content in rows:
+        counts = term_weights(title, description, content)
+        indices.extend(counts.keys())
+        data.extend(counts.values())
+        indptr.append(len(indices))
+    matrix = sparse.csr_matrix(
+        (np.asarray(data, dtype=np.float32), np.asarray(indices, dtype=np.int32), np.asarray(indptr)),
+        shape=(len(indptr) - 1, N_FEATURES),
+    )
+    np.log1p(matrix.data, out=matrix.data)
+    return matrix
+
+
+def _finish_vectors(tf, idf):
+    """Apply IDF, keep each row's strongest terms and L2-normalize."""
+    matrix = sparse.csr_matrix(tf.multiply(idf.reshape(1, -1)), dtype=np.float32)
+    matrix.eliminate_zeros()
+    for i in range(matrix.shape[0]):
+        start, end = matrix.indptr[i], matrix.indptr[i + 1]
+        if end - start > TERMS_PER_LOOP:
+            row = matrix.data[start:end]
+            row[np.argpartition(row, -TERMS_PER_LOOP)[:-TERMS_PER_LOOP]] = 0
+    matrix.eliminate_zeros()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.csr_matrix(sparse.diags(1 / norms) @ matrix, dtype=np.float32)
+
+
+def compute_idf(tf):
+    n = tf.shape[0]
+    df = np.bincount(tf.indices, minlength=N_FEATURES)
+    idf = (np.log((1 + n) / (1 + df)) + 1).astype(np.float32)
+    # Terms that are too rare to link loops, or too common to tell them apart
+    idf[df < MIN_DF] = 0
+    if n >= 20:
+        idf[df > MAX_DF_RATIO * n] = 0
+    return idf
+
+
+def neighbours(matrix, k, block_size=1000):
+    """Yield ``(row, [(other_row, score), ...])`` with each row's top ``k`` others."""
+    transposed = matrix.T.tocsc()
+    for start in range(0, matrix.shape[0], block_size):
+        scores = (matrix[start:start + block_size] @ transposed).tocsr()
+        for offset in range(scores.shape[0]):
+            row = start + offset
+            lo, hi = scores.indptr[offset], scores.indptr[offset + 1]
+            cols, values = scores.indices[lo:hi], scores.data[lo:hi]
+            keep = (cols != row) & (values > 0)
+            cols, values = cols[keep], values[keep]
+            if len(values) > k:
+                best = np.argpartition(values, -k)[-k:]
+                cols, values = cols[best], values[best]
+            order = np.argsort(-values)
+            yield row, list(zip(cols[order].tolist(), values[order].tolist()))
+
+
+# --- Snapshot ---
+
+def snapshot_path():
+    return str(getattr(settings, 'LOOP_SIMILARITY_PATH', os.path.join(settings.BASE_DIR, 'var', 'similarity.npz')))
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def save_snapshot(ids, matrix, idf):
+    path = snapshot_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.tmp.npz'
+    np.savez(
+        tmp, ids=np.asarray(ids, dtype=np.int64), idf=idf,
+        data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+    )
+    os.replace(tmp, path)
+
+
+def load_snapshot():
+    """Return ``(ids, matrix, idf, position)`` from disk, or None; reloaded when the file changes."""
+    global _snapshot
+    path = snapshot_path()
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot[0] != mtime:
+            with np.load(path) as data:
+                ids = data['ids']
+                matrix = sparse.csr_matrix(
+                    (data['data'], data['indices'], data['indptr']), shape=(len(ids), N_FEATURES),
+                )
+                idf = data['idf']
+            position = {loop_id: i for i, loop_id in enumerate(ids.tolist())}
+            _snapshot = (mtime, (ids, matrix, idf, position))
+        return _snapshot[1]
+
+
+# --- Building and updating ---
+
+def _loop_rows(batch_size):
+    from .models import Loop, LoopBody
+
+    last_pk = 0
+    while True:
+        batch = list(
+            Loop.objects.filter(pk__gt=last_pk).order_by('pk')
+            .values_list('pk', 'title', 'description', 'body__data', 'body__plain_text')[:batch_size]
+        )
+        if not batch:
+            return
+        for pk, title, description, data, plain_text in batch:
+            yield pk, title, description, LoopBody.text_from(data, plain_text)
+        last_pk = batch[-1][0]
+
+
+def rebuild(batch_size=2000, block_size=1000):
+    """Recompute every loop's neighbours. Returns the number of loops indexed."""
+    from .models import LoopSimilarity
+
+    ids, parts = [], []
+    rows = []
+    for pk, title, description, content in _loop_rows(batch_size):
+        ids.append(pk)
+        rows.append((title, description, content))
+        if len(rows) >= batch_size:
+            parts.append(_tf_matrix(rows))
+            rows = []
+    if rows:
+        parts.append(_tf_matrix(rows))
+    if not ids:
+        LoopSimilarity.objects.all().delete()
+        return 0
+
+    tf = sparse.vstack(parts, format='csr')
+    idf = compute_idf(tf)
+    matrix = _finish_vectors(tf, idf)
+
+    with transaction.atomic():
+        LoopSimilarity.objects.all().delete()
+        pending = []
+        for row, similar in neighbours(matrix, top_k(), block_size=block_size):
+            pending.extend(
+                LoopSimilarity(loop_id=ids[row], similar_id=ids[other], score=score)
+                for other, score in similar
+            )
+            if len(pending) >= 5000:
+                LoopSimilarity.objects.bulk_create(pending)
+                pending = []
+        LoopSimilarity.objects.bulk_create(pending)
+
+    save_snapshot(ids, matrix, idf)
+    return len(ids)
+
+
+def update_loop(loop_id):
+    """Refresh one loop's neighbours against the saved snapshot. Returns False without one."""
+    from .models import Loop, LoopBody, LoopSimilarity
+
+    snapshot = load_snapshot()
+    if snapshot is None:
+        return False
+    ids, matrix, idf, position = snapshot
+
+    row = (
+        Loop.objects.filter(pk=loop_id)
+        .values_list('title', 'description', 'body__data', 'body__plain_text').first()
+    )
+    if row is None:
+        return True
+    row = (row[0], row[1], LoopBody.text_from(row[2], row[3]))
+    vector = _finish_vectors(_tf_matrix([row]), idf)
+    scores = np.asarray((matrix @ vector.T).todense()).ravel()
+    if loop_id in position:
+        scores[position[loop_id]] = 0
+
+    k = top_k()
+    best = np.argpartition(scores, -k)[-k:] if len(scores) > k else np.arange(len(scores))
+    best = [i for i in best[np.argsort(-scores[best])] if scores[i] > 0]
+    similar = [(int(ids[i]), float(scores[i])) for i in best]
+    existing = set(Loop.objects.filter(pk__in=[pk for pk, _ in similar]).values_list('pk', flat=True))
+    similar = [(pk, score) for pk, score in similar if pk in existing]
+
+    with transaction.atomic():
+        LoopSimilarity.objects.filter(loop_id=loop_id).delete()
+        LoopSimilarity.objects.bulk_create(
+            LoopSimilarity(loop_id=loop_id, similar_id=pk, score=score) for pk, score in similar
+        )
+        _insert_reverse(loop_id, similar, k)
+    return True
+
+
+def _insert_reverse(loop_id, similar, k):
+    """Add ``loop_id`` to the neighbour lists of the loops it is similar to, where it ranks."""
+    from .models import LoopSimilarity
+
+    lists = {}
+    for entry in LoopSimilarity.objects.filter(loop_id__in=[pk for pk, _ in similar]).order_by('-score'):
+        lists.setdefault(entry.loop_id, []).append(entry)
+
+    to_create, to_delete, to_update = [], [], []
+    for other, score in similar:
+        entries = lists.get(other, [])
+        current = next((entry for entry in entries if entry.similar_id == loop_id), None)
+        if current is not None:
+            current.score = score
+            to_update.append(current)
+        elif len(entries) < k:
+            to_create.append(LoopSimilarity(loop_id=other, similar_id=loop_id, score=score))
+        elif score > entries[-1].score:
+            to_delete.append(entries[-1].pk)
+            to_create.append(LoopSimilarity(loop_id=other, similar_id=loop_id, score=score))
+
+    LoopSimilarity.objects.filter(pk__in=to_delete).delete()
+    LoopSimilarity.objects.bulk_create(to_create)
+    LoopSimilarity.objects.bulk_update(to_update, ['score'])
+
+
+def similar_loops(loop, limit=4):
+    """The loops most similar to ``loop``, best first (one query)."""
+    from .cards import COMPACT_COLUMNS
+    from .models import LoopSimilarity
+
+    entries = (
+        LoopSimilarity.objects.filter(loop=loop).select_related('similar').order_by('-score')
+        .only('similar', *(f'similar__{name}' for name in COMPACT_COLUMNS))[:limit]
+    )
+    return [entry.similar for entry in entries]
+
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='similarity')
+
+
+def _update_in_background(loop_id):
+    close_old_connections()
+    try:
+        update_loop(loop_id)
+    except Exception:
+        logger.exception("Updating similar loops for loop %s failed", loop_id)
+    finally:
+        from django.db import connection
+        connection.close()
+
+
+def schedule_update(loop_id):
+    """Refresh ``loop_id``'s neighbours once the current transaction commits."""
+    if getattr(settings, 'LOOP_SIMILARITY_ASYNC', True):
+        transaction.on_commit(lambda: _executor.submit(_update_in_background, loop_id))
+    else:
+        transaction.on_commit(lambda: update_loop(loop_id))
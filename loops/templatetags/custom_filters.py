@@ -0,0 +1,11 @@
+from django import template
+
+from loops import rendering
+
+register = template.Library()
+
+
+@register.filter
+def safe_embed_url(url):
+    """Turn a YouTube/Vimeo link into its embeddable player URL."""
+    return rendering.embed_url(url)
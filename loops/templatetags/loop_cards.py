@@ -0,0 +1,11 @@
+from django import template
+
+from loops.cards import render_cards
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def loop_cards(context, loops, variant='card'):
+    """Render ``loops`` as cached cards: ``{% loop_cards loops as cards %}``."""
+    return render_cards(loops, context.get('purchased_loop_ids', frozenset()), variant)
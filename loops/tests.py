@@ -1,3 +1,1359 @@
-from django.test import TestCase
+import hashlib
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.core.files.base import ContentFile
+from django.db import OperationalError, connection, connections
+from django.db.models import F, QuerySet
+from django.utils import timezone
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+
+from learnloop import db_router
+from learnloop.querybudget import QueryBudgetTestMixin
+from . import blobs, cards, entitlements, page_cache, previews, rendering, search, similarity, trending, uploads
+from .cards import render_cards
+from .forms import LoopForm
+from .models import AttachmentBlob, ChunkedUpload, Loop, LoopBody, Like, Comment, TrendingEpoch
+from .pagination import SORT_ORDERINGS, CursorPaginator, encode_cursor, estimated_count
+from .view_counter import ViewCounter
+
+
+@override_settings(QUERY_BUDGET_ENABLED=True, LOOP_VIEWS_BUFFERED=False, LOOP_PAGE_CACHE_ENABLED=False)
+class QueryBudgetTests(QueryBudgetTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(username=f'user{i}', password='pass') for i in range(4)]
+        cls.loops = [
+            Loop.objects.create(
+                title=f'Loop {i}', description='Description', content='Content',
+                creator=cls.users[i % 4], category='Math', is_premium=i % 3 == 0, price=50,
+            )
+            for i in range(15)
+        ]
+        loop = cls.loops[-1]
+        for user in cls.users:
+            Like.objects.create(user=user, loop=loop)
+            Comment.objects.create(user=user, loop=loop, content='Nice loop')
+            loop.is_purchased_by.add(user)
+
+    def test_loops_list(self):
+        self.assertWithinQueryBudget(self.client.get(reverse('loops_list')))
+        self.client.login(username='user0', password='pass')
+        self.assertWithinQueryBudget(self.client.get(reverse('loops_list'), {'sort': '-likes_count'}))
+
+    def test_category(self):
+        self.assertWithinQueryBudget(self.client.get(reverse('category', args=['Math'])))
+
+    def test_my_loops(self):
+        self.client.login(username='user0', password='pass')
+        self.assertWithinQueryBudget(self.client.get(reverse('my_loops')))
+
+    def test_loop_detail(self):
+        self.client.login(username='user0', password='pass')
+        self.assertWithinQueryBudget(self.client.get(reverse('loop_detail', args=[self.loops[-1].pk])))
+
+    def test_loop_comments(self):
+        self.client.login(username='user0', password='pass')
+        self.assertWithinQueryBudget(self.client.get(reverse('loop_comments', args=[self.loops[-1].pk])))
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False, LOOP_PAGE_CACHE_ENABLED=False, LOOP_SIMILARITY_ASYNC=False)
+class QueryPlanTests(TestCase):
+    """
+    Every SELECT the hot pages run must be answered from an index: no full
+    table scans and no temporary B-tree sorts (SQLite's EXPLAIN QUERY PLAN).
+    """
+    # Tables small and bounded enough that scanning them is fine
+    SCAN_ALLOWED = {'django_content_type', 'auth_permission'}
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command(
+            'seed_catalog', users=20, loops=300, likes=3, comments=3, payments=2, content_words=24, seed=1,
+            stdout=io.StringIO(),
+        )
+        cls.user = User.objects.filter(created_loops__isnull=False).first()
+        cls.user.set_password('pass')
+        cls.user.save()
+        cls.loop = Loop.objects.filter(comments_count__gt=0).first()
+
+    def setUp(self):
+        cache.clear()
+
+    def assertIndexed(self, captured):
+        problems = []
+        with connection.cursor() as cursor:
+            for query in captured:
+                sql = query['sql']
+                if not sql.lstrip().upper().startswith('SELECT'):
+                    continue
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                for row in cursor.fetchall():
+                    detail = row[-1]
+                    full_scan = (
+                        detail.startswith('SCAN ') and ' USING ' not in detail
+                        and detail.split()[1] not in self.SCAN_ALLOWED
+                    )
+                    if full_scan or 'USE TEMP B-TREE' in detail:
+                        problems.append(f'{detail}\n    in {sql}')
+        self.assertFalse(problems, 'Unindexed query plans:\n' + '\n'.join(problems))
+
+    def get_all(self, url, variants, login=False):
+        if login:
+            self.client.login(username=self.user.username, password='pass')
+        for params in variants:
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 200)
+                cursor = getattr(response.context['loops'], 'next_cursor', None) if response.context else None
+                if cursor:
+                    self.client.get(url, {**params, 'cursor': cursor})
+            with self.subTest(url=url, params=params):
+                self.assertIndexed(ctx.captured_queries)
+
+    def test_loops_list(self):
+        sorts = [{}, {'sort': 'created_at'}, {'sort': '-views'}, {'sort': '-likes_count'}, {'sort': 'trending'}]
+        filters = [{'category': 'Math'}, {'difficulty': 'Advanced'}, {'category': 'Math', 'difficulty': 'Advanced'}]
+        self.get_all(reverse('loops_list'), sorts + filters)
+        self.get_all(reverse('loops_list'), [{}], login=True)
+
+    def test_category_and_my_loops(self):
+        self.get_all(reverse('category', args=['Science']), [{}])
+        self.get_all(reverse('my_loops'), [{}], login=True)
+
+    def test_loop_detail_and_comments(self):
+        self.client.login(username=self.user.username, password='pass')
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('loop_detail', args=[self.loop.pk]))
+            self.client.get(reverse('loop_comments', args=[self.loop.pk]))
+        self.assertIndexed(ctx.captured_queries)
+
+    def test_payments(self):
+        from payments import callbacks, reconciliation
+        from payments.models import Payment
+
+        payment = Payment.objects.filter(user=self.user).first() or Payment.objects.create(
+            user=self.user, loop=self.loop, phone_number='254700000000', amount=50,
+        )
+        self.client.login(username=self.user.username, password='pass')
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('payments:pending', args=[payment.pk]))
+            self.client.get(reverse('payments:status', args=[payment.pk]))
+            reconciliation.stale_page(0, timezone.now(), 50)
+            callbacks.process_batch()
+        self.assertIndexed(ctx.captured_queries)
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False, LOOP_PAGE_CACHE_ENABLED=False, LOOP_SIMILARITY_ASYNC=False,
+                   DATABASE_READ_REPLICA='replica')
+class ReplicaRoutingTests(TransactionTestCase):
+    # Outside TestCase's transaction, which would keep every read on the primary
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='reader', password='pass')
+        self.loop = Loop.objects.create(title='Replicated', description='D', content='C', creator=self.user)
+
+    def get(self, *args, **kwargs):
+        """GET and return ``(response, tables read on the primary, tables read on the replica)``."""
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.get(*args, **kwargs)
+
+        def tables(ctx):
+            return {
+                table for query in ctx.captured_queries if query['sql'].startswith('SELECT')
+                for table in ('loops_loop', 'loops_like', 'loops_comment', 'loops_loop_is_purchased_by')
+                if f'FROM "{table}"' in query['sql']
+            }
+        return response, tables(primary), tables(replica)
+
+    def test_catalog_pages_read_from_the_replica(self):
+        for url in (reverse('loops_list'), reverse('category', args=['General'])):
+            response, primary, replica = self.get(url)
+            self.assertContains(response, 'Replicated')
+            self.assertEqual(primary, set())
+            self.assertIn('loops_loop', replica)
+
+    def test_viewer_specific_detail_reads_use_the_primary(self):
+        self.client.login(username='reader', password='pass')
+        response, primary, replica = self.get(reverse('loop_detail', args=[self.loop.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('loops_loop', replica)
+        self.assertIn('loops_like', primary)
+        self.assertNotIn('loops_like', replica)
+
+    def test_purchases_on_catalog_pages_come_from_the_primary(self):
+        # The set is cached for an hour, so a lagging replica must not fill it
+        self.loop.is_premium = True
+        self.loop.save()
+        self.loop.is_purchased_by.add(self.user)
+        self.client.login(username='reader', password='pass')
+        for url in (reverse('loops_list'), reverse('category', args=['General'])):
+            cache.delete(entitlements.CACHE_KEY.format(self.user.pk))
+            response, primary, replica = self.get(url)
+            self.assertEqual(response.context['purchased_loop_ids'], {self.loop.pk})
+            self.assertIn('loops_loop_is_purchased_by', primary)
+            self.assertNotIn('loops_loop_is_purchased_by', replica)
+
+    def test_writing_pins_the_client_to_the_primary(self):
+        self.client.login(username='reader', password='pass')
+        response = self.client.post(reverse('add_comment', args=[self.loop.pk]), {'content': 'Hello'})
+        self.assertIn(db_router.PIN_COOKIE, response.cookies)
+        self.assertEqual(response.cookies[db_router.PIN_COOKIE]['max-age'], 10)
+
+        response, primary, replica = self.get(reverse('loop_detail', args=[self.loop.pk]))
+        self.assertContains(response, 'Hello')
+        self.assertIn('loops_comment', primary)
+        self.assertEqual(replica, set())
+
+    def test_routing(self):
+        router = db_router.PrimaryReplicaRouter()
+        self.assertEqual(router.db_for_read(Loop), 'default')
+        with db_router._reading_from('replica'):
+            self.assertEqual(router.db_for_read(Loop), 'replica')
+            self.assertEqual(router.db_for_write(Loop), 'default')
+            with db_router.primary():
+                self.assertEqual(router.db_for_read(Loop), 'default')
+            with override_settings(DATABASE_READ_REPLICA=None):
+                self.assertEqual(router.db_for_read(Loop), 'default')
+
+
+class SQLiteBackendTests(TestCase):
+    def make_wrapper(self, **options):
+        from learnloop.sqlite_backend import base
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'db.sqlite3')
+        wrapper = base.DatabaseWrapper({**connection.settings_dict, 'NAME': path, 'OPTIONS': options}, alias='scratch')
+        self.addCleanup(wrapper.close)
+        with wrapper.cursor() as cursor:
+            cursor.execute('CREATE TABLE t (x integer)')
+        return wrapper, path
+
+    def test_connections_get_the_pragmas(self):
+        wrapper, _ = self.make_wrapper(pragmas={'cache_size': -1024})
+        with wrapper.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], -1024)
+
+    def test_locked_writes_are_retried(self):
+        from learnloop.sqlite_backend import base
+
+        wrapper, path = self.make_wrapper(timeout=0, busy_retries=20, busy_backoff=0.01, write_queue=True)
+        other = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.addCleanup(other.close)
+        other.execute('BEGIN IMMEDIATE')
+        release = threading.Timer(0.2, other.execute, args=['COMMIT'])
+        release.start()
+        self.addCleanup(release.cancel)
+
+        retries, queued = base.stats['busy_retries'], base.stats['queued_writes']
+        with wrapper.cursor() as cursor:
+            cursor.execute('INSERT INTO t (x) VALUES (%s)', [1])
+        self.assertGreater(base.stats['busy_retries'], retries)
+        self.assertEqual(base.stats['queued_writes'], queued + 1)
+        self.assertEqual(other.execute('SELECT x FROM t').fetchall(), [(1,)])
+
+    def test_gives_up_after_the_retries(self):
+        wrapper, path = self.make_wrapper(timeout=0, busy_retries=1, busy_backoff=0.001)
+        other = sqlite3.connect(path, isolation_level=None)
+        self.addCleanup(other.close)
+        other.execute('BEGIN IMMEDIATE')
+        with self.assertRaisesMessage(OperationalError, 'database is locked'):
+            with wrapper.cursor() as cursor:
+                cursor.execute('INSERT INTO t (x) VALUES (%s)', [1])
+        other.execute('ROLLBACK')
+
+
+@override_settings(LOOP_SIMILARITY_ASYNC=False)
+class ViewCounterTests(TransactionTestCase):
+    # The interval flush writes from the counter's own thread, outside any test transaction
+
+    def setUp(self):
+        user = User.objects.create_user(username='user', password='pass')
+        self.loops = [
+            Loop.objects.create(title=f'Loop {i}', description='D', content='C', creator=user) for i in range(3)
+        ]
+
+    def make_counter(self, **kwargs):
+        counter = ViewCounter(**{'flush_interval': 60, 'flush_threshold': 1000, **kwargs})
+        self.addCleanup(counter.stop)
+        return counter
+
+    def views(self):
+        return list(Loop.objects.order_by('pk').values_list('views', flat=True))
+
+    def test_threshold_flush_groups_updates_by_increment(self):
+        counter = self.make_counter(flush_threshold=4)
+        first, second, third = self.loops
+        for loop in (first, second, first):
+            counter.record(loop.pk)
+        self.assertEqual(counter.pending(first.pk), 2)
+        self.assertEqual(self.views(), [0, 0, 0])
+
+        with CaptureQueriesContext(connection) as ctx:
+            counter.record(third.pk)
+        updates = [query['sql'] for query in ctx.captured_queries if query['sql'].startswith('UPDATE')]
+        # +2 for the first loop, +1 for the other two together
+        self.assertEqual(len(updates), 2)
+        self.assertTrue(all('"views" = ("loops_loop"."views" + %s)' % n in sql for n, sql in zip((2, 1), updates)))
+        self.assertEqual(self.views(), [2, 1, 1])
+        self.assertEqual(counter.pending(), 0)
+
+    def test_interval_flush(self):
+        counter = self.make_counter(flush_interval=0.05)
+        counter.record(self.loops[0].pk, 3)
+        counter.record(self.loops[1].pk)
+        # Don't read the table while the thread may be writing it: the shared
+        # in-memory test database reports "table is locked" instead of waiting
+        for _ in range(100):
+            if counter.pending() == 0:
+                break
+            time.sleep(0.05)
+        self.assertEqual(counter.pending(), 0)
+        counter.stop()
+        counter._thread.join(timeout=5)
+        self.assertEqual(self.views(), [3, 1, 0])
+
+    def test_views_are_requeued_when_the_update_fails(self):
+        counter = self.make_counter()
+        counter.record(self.loops[0].pk, 2)
+        with mock.patch.object(QuerySet, 'update', side_effect=OperationalError('database is locked')), \
+                self.assertLogs('loops.view_counter', 'ERROR'):
+            self.assertEqual(counter.flush(), 0)
+        self.assertEqual(counter.pending(self.loops[0].pk), 2)
+
+        counter.record(self.loops[0].pk)
+        self.assertEqual(counter.flush(), 3)
+        self.assertEqual(self.views(), [3, 0, 0])
+
+    def test_stop_flushes_pending_views(self):
+        counter = self.make_counter()
+        counter.record(self.loops[2].pk, 5)
+        counter.stop()
+        self.assertEqual(self.views(), [0, 0, 5])
+        counter._thread.join(timeout=1)
+        self.assertFalse(counter._thread.is_alive())
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False, LOOP_PAGE_CACHE_ENABLED=False, LOOP_SIMILARITY_ASYNC=False)
+class SearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='pass')
+
+    def create(self, title, description='Notes', content='Body', **kwargs):
+        return Loop.objects.create(
+            title=title, description=description, content=content, creator=self.user, **kwargs,
+        )
+
+    def search(self, text):
+        results = search.search_loops(Loop.objects.all(), text)
+        if 'search_rank' in results.query.annotations:
+            results = results.order_by('search_rank', '-pk')
+        return [loop.title for loop in results]
+
+    def test_index_follows_creates_edits_and_deletes(self):
+        loop = self.create('Photosynthesis', content='Chlorophyll absorbs light')
+        self.assertEqual(self.search('chlorophyll'), ['Photosynthesis'])
+
+        loop.content = 'Stomata exchange gases'
+        loop.title = 'Leaves'
+        loop.save()
+        self.assertEqual(self.search('chlorophyll'), [])
+        self.assertEqual(self.search('stomata'), ['Leaves'])
+        self.assertEqual(self.search('photosynthesis'), [])
+
+        loop.delete()
+        self.assertEqual(self.search('stomata'), [])
+
+    def test_stat_saves_leave_the_index_alone(self):
+        loop = self.create('Photosynthesis')
+        loop.likes_count = 3
+        with CaptureQueriesContext(connection) as ctx:
+            loop.save(update_fields=['likes_count'])
+        self.assertFalse([query for query in ctx.captured_queries if search.FTS_TABLE in query['sql']])
+
+        loop.content = 'Chlorophyll absorbs light'
+        loop.save(update_fields=['content'])
+        self.assertEqual(self.search('chlorophyll'), ['Photosynthesis'])
+
+    def test_terms_match_as_prefixes(self):
+        self.create('Thermodynamics', category='Science')
+        self.create('Thermal imaging')
+        self.assertEqual(sorted(self.search('therm')), ['Thermal imaging', 'Thermodynamics'])
+        self.assertEqual(self.search('thermo scien'), ['Thermodynamics'])
+        self.assertEqual(self.search('"); DROP TABLE'), [])
+
+    def test_results_are_ranked_by_bm25(self):
+        self.create('Cooking basics', content='A pinch of algebra')
+        self.create('Algebra', description='Algebra for beginners')
+        self.create('Numbers', description='Some algebra')
+        self.assertEqual(self.search('algebra'), ['Algebra', 'Numbers', 'Cooking basics'])
+
+        response = self.client.get(reverse('loops_list'), {'q': 'algebra'})
+        self.assertEqual([loop.title for loop in response.context['loops']], ['Algebra', 'Numbers', 'Cooking basics'])
+
+    def test_falls_back_to_icontains_without_the_fts_table(self):
+        self.create('Organic chemistry', description='Carbon compounds')
+        self.create('Statistics', category='Math')
+        with mock.patch.object(search, 'fts_available', return_value=False):
+            self.assertEqual(self.search('chemis'), ['Organic chemistry'])
+            self.assertEqual(self.search('carbon'), ['Organic chemistry'])
+            self.assertEqual(self.search('math'), ['Statistics'])
+            response = self.client.get(reverse('loops_list'), {'q': 'carbon'})
+            self.assertEqual([loop.title for loop in response.context['loops']], ['Organic chemistry'])
+
+    def test_rebuild_command(self):
+        self.create('Geometry', content='Triangles and circles')
+        self.create('Trigonometry', content='Triangles and angles')
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {search.FTS_TABLE}')
+        self.assertEqual(self.search('triangles'), [])
+
+        out = io.StringIO()
+        call_command('rebuild_search_index', batch_size=1, stdout=out)
+        self.assertIn('Indexed 2 loops.', out.getvalue())
+        self.assertEqual(sorted(self.search('triangles')), ['Geometry', 'Trigonometry'])
+
+
+@override_settings(LOOP_SIMILARITY_ASYNC=False)
+class CursorPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username='user', password='pass')
+        self.loops = [
+            Loop.objects.create(title=f'Loop {i}', description='D', content='C', creator=user) for i in range(11)
+        ]
+        # Plenty of ties on every sort key, so only the pk tiebreak keeps pages apart
+        now = timezone.now()
+        for i, loop in enumerate(self.loops):
+            Loop.objects.filter(pk=loop.pk).update(
+                created_at=now - timedelta(hours=i // 4), views=i % 3, likes_count=i // 5, trending_score=i % 2,
+            )
+        self.queryset = Loop.objects.all()
+
+    def walk(self, ordering, per_page=3):
+        """Page forward to the end, then back to the start; return both lists of pages."""
+        paginator = CursorPaginator(self.queryset, ordering, per_page=per_page)
+        page = paginator.get_page()
+        forward = [[loop.pk for loop in page]]
+        while page.has_next:
+            page = paginator.get_page(page.next_cursor)
+            forward.append([loop.pk for loop in page])
+        backward = [[loop.pk for loop in page]]
+        while page.has_previous:
+            page = paginator.get_page(page.previous_cursor)
+            backward.append([loop.pk for loop in page])
+        return forward, backward
+
+    def test_round_trips_on_every_sort(self):
+        for sort, ordering in SORT_ORDERINGS.items():
+            with self.subTest(sort=sort):
+                forward, backward = self.walk(ordering)
+                expected = list(self.queryset.order_by(*ordering).values_list('pk', flat=True))
+                self.assertEqual([pk for page in forward for pk in page], expected)
+                self.assertEqual([len(page) for page in forward], [3, 3, 3, 2])
+                self.assertEqual(backward, forward[::-1])
+
+    def test_unusable_cursors_give_the_first_page(self):
+        ordering = SORT_ORDERINGS['-views']
+        paginator = CursorPaginator(self.queryset, ordering, per_page=3)
+        first = [loop.pk for loop in paginator.get_page()]
+        likes_cursor = CursorPaginator(self.queryset, SORT_ORDERINGS['-likes_count'], per_page=3).get_page().next_cursor
+        for cursor in (
+            'garbage', '!!!', likes_cursor,
+            encode_cursor([1, 2, 3], 'next', ordering),
+            encode_cursor(['many', 1], 'next', ordering),
+            encode_cursor([1, 1], 'sideways', ordering),
+        ):
+            with self.subTest(cursor=cursor):
+                page = paginator.get_page(cursor)
+                self.assertEqual([loop.pk for loop in page], first)
+                self.assertFalse(page.has_previous)
+
+    def test_estimated_count_is_cached(self):
+        queryset = Loop.objects.filter(views=0)
+        with self.assertNumQueries(1):
+            self.assertEqual(estimated_count(queryset), 4)
+        Loop.objects.filter(pk=self.loops[1].pk).update(views=0)
+        with self.assertNumQueries(0):
+            self.assertEqual(estimated_count(queryset), 4)
+        # Each filter is counted separately
+        self.assertEqual(estimated_count(Loop.objects.filter(views=1)), 3)
+        cache.clear()
+        self.assertEqual(estimated_count(queryset), 5)
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False, LOOP_SIMILARITY_ASYNC=False)
+class LoopCounterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='pass')
+        self.other = User.objects.create_user(username='other', password='pass')
+        self.loop = Loop.objects.create(title='Counted', description='D', content='C', creator=self.user)
+
+    def counts(self, loop=None):
+        return Loop.objects.values_list('likes_count', 'comments_count').get(pk=(loop or self.loop).pk)
+
+    def test_full_save_keeps_concurrent_counts(self):
+        stale = Loop.objects.get(pk=self.loop.pk)
+        Like.objects.create(user=self.other, loop=self.loop)
+        Comment.objects.create(user=self.other, loop=self.loop, content='Hi')
+        self.loop.increment_views()
+        version = Loop.objects.get(pk=self.loop.pk).card_version
+
+        stale.title = 'Edited'
+        stale.save()
+
+        loop = Loop.objects.get(pk=self.loop.pk)
+        self.assertEqual((loop.title, loop.views), ('Edited', 1))
+        self.assertEqual(self.counts(), (1, 1))
+        self.assertEqual(loop.card_version, version + 1)
+        self.assertEqual(stale.card_version, loop.card_version)
+
+    def test_full_save_of_a_deferred_instance(self):
+        Loop.objects.filter(pk=self.loop.pk).update(description='Kept')
+        loop = Loop.objects.only('title', 'card_version').get(pk=self.loop.pk)
+        loop.title = 'Edited'
+        with CaptureQueriesContext(connection) as ctx:
+            loop.save()
+        update = next(query['sql'] for query in ctx.captured_queries if query['sql'].startswith('UPDATE'))
+        self.assertNotIn('"description"', update)
+        self.assertEqual(Loop.objects.values_list('title', 'description').get(pk=loop.pk), ('Edited', 'Kept'))
+
+    def test_single_create_and_delete(self):
+        like = Like.objects.create(user=self.other, loop=self.loop)
+        Comment.objects.create(user=self.other, loop=self.loop, content='Hi')
+        self.assertEqual(self.counts(), (1, 1))
+        like.delete()
+        self.assertEqual(self.counts(), (0, 1))
+
+    def test_bulk_create(self):
+        second = Loop.objects.create(title='Second', description='D', content='C', creator=self.user)
+        Like.objects.bulk_create([Like(user=self.user, loop=self.loop), Like(user=self.other, loop=self.loop),
+                                  Like(user=self.user, loop=second)])
+        Comment.objects.bulk_create([Comment(user=self.user, loop=self.loop, content=str(i)) for i in range(3)])
+        self.assertEqual(self.counts(), (2, 3))
+        self.assertEqual(self.counts(second), (1, 0))
+
+    def test_bulk_create_ignoring_conflicts_recounts(self):
+        Like.objects.create(user=self.user, loop=self.loop)
+        Like.objects.bulk_create(
+            [Like(user=self.user, loop=self.loop), Like(user=self.other, loop=self.loop)], ignore_conflicts=True,
+        )
+        self.assertEqual(self.counts(), (2, 0))
+
+    def test_queryset_delete(self):
+        for user in (self.user, self.other):
+            Like.objects.create(user=user, loop=self.loop)
+            Comment.objects.create(user=user, loop=self.loop, content='Hi')
+        Like.objects.filter(loop=self.loop).delete()
+        Comment.objects.filter(user=self.other).delete()
+        self.assertEqual(self.counts(), (0, 1))
+
+    def test_cascade_deletes(self):
+        Like.objects.create(user=self.other, loop=self.loop)
+        Comment.objects.create(user=self.other, loop=self.loop, content='Hi')
+        Comment.objects.create(user=self.user, loop=self.loop, content='Hi')
+        doomed = Loop.objects.create(title='Doomed', description='D', content='C', creator=self.other)
+        Like.objects.create(user=self.user, loop=doomed)
+
+        # Deleting the user removes their loop (and its likes) and their rows on other loops
+        self.other.delete()
+        self.assertEqual(self.counts(), (0, 1))
+        self.assertFalse(Loop.objects.filter(pk=doomed.pk).exists())
+
+        # The loop's own likes and comments don't update the row being deleted
+        with CaptureQueriesContext(connection) as ctx:
+            self.loop.delete()
+        self.assertFalse(Comment.objects.exists())
+        self.assertFalse([query for query in ctx.captured_queries if 'comments_count' in query['sql']])
+
+    def test_repair_command(self):
+        Like.objects.create(user=self.other, loop=self.loop)
+        Loop.objects.filter(pk=self.loop.pk).update(likes_count=5, comments_count=2)
+
+        out = io.StringIO()
+        with self.assertRaisesMessage(CommandError, '2 loop counters have drifted'):
+            call_command('repair_loop_counters', '--check', stdout=out)
+        self.assertIn(f'Loop {self.loop.pk}: likes_count is 5, should be 1', out.getvalue())
+        self.assertEqual(self.counts(), (5, 2))
+
+        call_command('repair_loop_counters', stdout=io.StringIO())
+        self.assertEqual(self.counts(), (1, 0))
+        call_command('repair_loop_counters', '--check', stdout=io.StringIO())
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False)
+class LoopCardCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='pass')
+        self.loop = Loop.objects.create(
+            title='Cached', description='Description', content='Content', creator=self.user,
+            is_premium=True, price=50,
+        )
+
+    def get_card(self):
+        return render_cards([Loop.objects.select_related('creator').get(pk=self.loop.pk)])[0]
+
+    def test_card_is_cached_until_version_changes(self):
+        self.get_card()
+        self.assertIn(cards.cache_key(self.loop), cache)
+
+        Like.objects.create(user=self.user, loop=self.loop)
+        self.assertIn('1 likes', self.get_card())
+
+        self.loop.refresh_from_db()
+        self.loop.title = 'Renamed'
+        self.loop.save()
+        self.assertIn('Renamed', self.get_card())
+
+    def test_view_count_does_not_invalidate(self):
+        self.get_card()
+        version = Loop.objects.get(pk=self.loop.pk).card_version
+
+        self.loop.increment_views()
+
+        loop = Loop.objects.get(pk=self.loop.pk)
+        self.assertEqual(loop.card_version, version)
+        self.assertIn('1 views', render_cards([loop])[0])
+
+    def test_viewer_specific_actions_stay_out_of_the_cache(self):
+        self.get_card()
+        self.assertIn('Buy Ksh 50', self.get_card())
+
+        loop = Loop.objects.get(pk=self.loop.pk)
+        self.assertIn('Access', render_cards([loop], purchased_loop_ids={loop.pk})[0])
+        fragment = cache.get(cards.cache_key(loop))
+        self.assertIn(cards.ACTIONS_MARKER, fragment)
+        self.assertNotIn('Buy Ksh', fragment)
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False, LOOP_PAGE_CACHE_ENABLED=False, LOOP_SIMILARITY_ASYNC=False)
+class EntitlementTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        creator = User.objects.create_user(username='creator', password='pass')
+        self.loops = [
+            Loop.objects.create(title=f'Premium {i}', description='D', content='C', creator=creator,
+                                is_premium=True, price=50)
+            for i in range(3)
+        ]
+        self.free = Loop.objects.create(title='Free', description='D', content='C', creator=creator)
+        self.loops[0].is_purchased_by.add(self.user)
+
+    def buyer(self):
+        # A new object each time: the set is also memoized on the user for the request
+        return User.objects.get(pk=self.user.pk)
+
+    def cached(self):
+        return cache.get(entitlements.CACHE_KEY.format(self.user.pk))
+
+    def test_a_page_of_loops_costs_one_query(self):
+        user = self.buyer()
+        with self.assertNumQueries(1):
+            access = [entitlements.has_access(user, loop) for loop in [*self.loops, self.free]]
+        self.assertEqual(access, [True, False, False, True])
+
+        self.client.login(username='buyer', password='pass')
+        response = self.client.get(reverse('loops_list'))
+        self.assertEqual(response.context['purchased_loop_ids'], {self.loops[0].pk})
+        self.assertContains(response, 'Buy Ksh 50', count=2)
+
+    def test_cache_hit_and_miss(self):
+        first, second, third = self.buyer(), self.buyer(), self.buyer()
+        with self.assertNumQueries(1):
+            entitlements.purchased_loop_ids(first)
+        self.assertEqual(self.cached(), {self.loops[0].pk})
+        with self.assertNumQueries(0):
+            self.assertEqual(entitlements.purchased_loop_ids(second), {self.loops[0].pk})
+
+        # A cached no is double-checked against the database
+        Loop.is_purchased_by.through.objects.create(user=self.user, loop=self.loops[1])
+        cache.set(entitlements.CACHE_KEY.format(self.user.pk), frozenset({self.loops[0].pk}))
+        with self.assertNumQueries(1):
+            self.assertTrue(entitlements.has_access(third, self.loops[1]))
+        self.assertEqual(self.cached(), {self.loops[0].pk, self.loops[1].pk})
+
+    def test_relation_changes_invalidate(self):
+        user = self.buyer()
+        changes = [
+            lambda: self.loops[1].is_purchased_by.add(self.user),
+            lambda: user.purchased_loops.remove(self.loops[0]),
+            lambda: self.loops[1].is_purchased_by.clear(),
+            lambda: user.purchased_loops.add(self.loops[2]),
+        ]
+        for change, expected in zip(changes, [{0, 1}, {1}, set(), {2}]):
+            entitlements.purchased_loop_ids(self.buyer())
+            self.assertIsNotNone(self.cached())
+            change()
+            self.assertIsNone(self.cached())
+            self.assertEqual(
+                entitlements.purchased_loop_ids(self.buyer()), {self.loops[i].pk for i in expected},
+            )
+
+    def test_grant_many_invalidates_after_commit(self):
+        other = User.objects.create_user(username='other', password='pass')
+        entitlements.purchased_loop_ids(self.buyer())
+        with self.captureOnCommitCallbacks(execute=True):
+            entitlements.grant_many([(self.user.pk, self.loops[0].pk), (self.user.pk, self.loops[1].pk),
+                                     (other.pk, self.loops[1].pk)])
+            self.assertIsNotNone(self.cached())
+        self.assertIsNone(self.cached())
+        self.assertEqual(entitlements.purchased_loop_ids(self.buyer()), {self.loops[0].pk, self.loops[1].pk})
+        self.assertEqual(self.loops[1].is_purchased_by.count(), 2)
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False)
+class AnonymousPageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='pass')
+        self.loop = Loop.objects.create(
+            title='Cached', description='Description', content='Content', creator=self.user,
+        )
+
+    def test_anonymous_pages_are_cached(self):
+        url = reverse('loops_list')
+        self.assertEqual(self.client.get(url)['X-Page-Cache'], 'MISS')
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'utm_source': 'mail', 'q': ''})
+        self.assertEqual(response['X-Page-Cache'], 'HIT')
+        self.assertNotIn('csrfmiddlewaretoken', response.content.decode())
+
+    def test_conditional_get(self):
+        url = reverse('category', args=['General'])
+        response = self.client.get(url)
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(
+            self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304,
+        )
+
+    def test_catalog_change_serves_stale_while_one_request_rerenders(self):
+        url = reverse('loops_list')
+        self.client.get(url)
+        self.loop.title = 'Renamed'
+        self.loop.save()
+
+        # Another request holds the re-render lock
+        lock_key = page_cache.LOCK_KEY.format(page_cache.page_key(RequestFactory().get(url)))
+        cache.add(lock_key, 1)
+        self.assertEqual(self.client.get(url)['X-Page-Cache'], 'STALE')
+
+        cache.delete(lock_key)
+        self.assertEqual(self.client.get(url)['X-Page-Cache'], 'MISS')
+        self.assertEqual(self.client.get(url)['X-Page-Cache'], 'HIT')
+
+    def test_likes_and_comments_only_invalidate_their_loop(self):
+        other = Loop.objects.create(title='Other', description='D', content='C', creator=self.user)
+        urls = [reverse('loops_list'), reverse('loop_detail', args=[self.loop.pk]),
+                reverse('loop_detail', args=[other.pk])]
+        for url in urls:
+            self.client.get(url)
+
+        Like.objects.create(user=self.user, loop=self.loop)
+        self.assertEqual([self.client.get(url)['X-Page-Cache'] for url in urls], ['HIT', 'MISS', 'HIT'])
+        Comment.objects.create(user=self.user, loop=other, content='Nice')
+        self.assertEqual([self.client.get(url)['X-Page-Cache'] for url in urls], ['HIT', 'HIT', 'MISS'])
+
+    def test_cached_detail_hits_still_count_views(self):
+        url = reverse('loop_detail', args=[self.loop.pk])
+        self.client.get(url)
+        self.assertEqual(self.client.get(url)['X-Page-Cache'], 'HIT')
+
+        self.loop.refresh_from_db()
+        self.assertEqual(self.loop.views, 2)
+
+    def test_logged_in_users_bypass_the_cache(self):
+        url = reverse('loops_list')
+        self.client.get(url)
+        self.client.login(username='user', password='pass')
+
+        self.assertFalse(self.client.get(url).has_header('X-Page-Cache'))
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False, LOOP_PAGE_CACHE_ENABLED=False, LOOP_COMMENTS_PER_PAGE=3)
+class CommentTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='pass')
+        self.loop = Loop.objects.create(
+            title='Discussed', description='Description', content='Content', creator=self.user,
+        )
+        for i in range(7):
+            Comment.objects.create(user=self.user, loop=self.loop, content=f'Comment {i}')
+
+    def test_detail_shows_only_the_newest_page(self):
+        content = self.client.get(reverse('loop_detail', args=[self.loop.pk])).content.decode()
+        self.assertIn('Comment 6', content)
+        self.assertIn('Comment 4', content)
+        self.assertNotIn('Comment 3', content)
+        self.assertIn('Load older comments', content)
+
+    def test_older_pages_one_query_each(self):
+        url = reverse('loop_comments', args=[self.loop.pk])
+        page = self.client.get(url).json()
+        seen = []
+        while page['next_cursor']:
+            with self.assertNumQueries(1):
+                page = self.client.get(url, {'cursor': page['next_cursor']}).json()
+            seen.append(page['html'])
+        html = ''.join(seen)
+        self.assertEqual(len(seen), 2)
+        self.assertLess(html.index('Comment 3'), html.index('Comment 0'))
+        self.assertNotIn('Comment 4', html)
+
+    def test_ajax_post_returns_the_rendered_comment(self):
+        self.client.login(username='user', password='pass')
+        response = self.client.post(
+            reverse('add_comment', args=[self.loop.pk]), {'content': 'Fresh take'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertIn('Fresh take', response.json()['html'])
+        self.assertEqual(response.json()['comments_count'], 8)
+
+        response = self.client.post(
+            reverse('add_comment', args=[self.loop.pk]), {'content': ''},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('content', response.json()['errors'])
+
+    def test_plain_post_redirects_to_the_loop(self):
+        self.client.login(username='user', password='pass')
+        response = self.client.post(reverse('add_comment', args=[self.loop.pk]), {'content': 'No JS'})
+        self.assertRedirects(response, reverse('loop_detail', args=[self.loop.pk]))
+        self.assertTrue(Comment.objects.filter(content='No JS').exists())
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False, LOOP_PAGE_CACHE_ENABLED=False, LOOP_ATTACHMENT_SENDFILE=None)
+class AttachmentDeliveryTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+
+        self.creator = User.objects.create_user(username='creator', password='pass')
+        self.buyer = User.objects.create_user(username='buyer', password='pass')
+        self.data = bytes(range(256)) * 400
+        self.loop = Loop.objects.create(
+            title='Premium', description='Description', content='Content', creator=self.creator,
+            is_premium=True, price=50,
+        )
+        self.loop.attachment.save('notes.pdf', ContentFile(self.data))
+        self.loop.is_purchased_by.add(self.buyer)
+        self.url = reverse('loop_attachment', args=[self.loop.pk])
+
+    def test_premium_attachment_needs_access(self):
+        self.assertRedirects(self.client.get(self.url), f"{reverse('login')}?next={self.url}", fetch_redirect_response=False)
+
+        User.objects.create_user(username='other', password='pass')
+        self.client.login(username='other', password='pass')
+        self.assertRedirects(self.client.get(self.url), reverse('loop_detail', args=[self.loop.pk]))
+
+        self.client.login(username='creator', password='pass')
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    def test_full_and_ranged_downloads(self):
+        self.client.login(username='buyer', password='pass')
+        response = self.client.get(self.url)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('attachment; filename="notes.pdf"', response['Content-Disposition'])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=1000-', HTTP_IF_RANGE=response['ETag'])
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 1000-{len(self.data) - 1}/{len(self.data)}')
+        self.assertEqual(b''.join(response.streaming_content), self.data[1000:])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-10')
+        self.assertEqual(b''.join(response.streaming_content), self.data[-10:])
+
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.data)}-')
+        self.assertEqual(response.status_code, 416)
+
+        # A changed file restarts the download instead of splicing two versions
+        response = self.client.get(self.url, HTTP_RANGE='bytes=1000-', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_conditional_get(self):
+        self.client.login(username='buyer', password='pass')
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    @override_settings(LOOP_ATTACHMENT_SENDFILE='x-accel-redirect', LOOP_ATTACHMENT_ACCEL_PREFIX='/protected/')
+    def test_front_end_server_handoff(self):
+        self.client.login(username='buyer', password='pass')
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected/{self.loop.attachment.name}')
+        self.assertEqual(response.content, b'')
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False, LOOP_SIMILARITY_ASYNC=False, LOOP_UPLOAD_CHUNK_SIZE=1000)
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.enterContext(override_settings(
+            MEDIA_ROOT=os.path.join(root.name, 'media'), LOOP_UPLOAD_DIR=os.path.join(root.name, 'uploads'),
+        ))
+        self.user = User.objects.create_user(username='creator', password='pass')
+        self.client.login(username='creator', password='pass')
+        self.data = os.urandom(2500)
+
+    def start(self, **extra):
+        response = self.client.post(reverse('start_upload'), dict({'filename': 'slides.pdf', 'size': len(self.data)}, **extra))
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def put(self, url, offset, length=1000):
+        return self.client.put(
+            url, self.data[offset:offset + length], content_type='application/octet-stream',
+            HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def test_resumed_upload_is_attached_to_the_loop(self):
+        state = self.start()
+        self.assertEqual(self.put(state['url'], 0).json()['offset'], 1000)
+
+        # Replaying a chunk, or skipping ahead, is answered with where the upload really is
+        response = self.put(state['url'], 0)
+        self.assertEqual((response.status_code, response.json()['offset']), (409, 1000))
+        self.assertEqual(self.put(state['url'], 2000).status_code, 409)
+
+        # The next chunk lands on a process that never saw the first one
+        uploads._hashes.clear()
+        self.assertEqual(self.client.get(state['url']).json()['offset'], 1000)
+        self.put(state['url'], 1000)
+        self.assertTrue(self.put(state['url'], 2000).json()['complete'])
+
+        upload = ChunkedUpload.objects.get(pk=state['id'])
+        self.assertEqual(upload.sha256, hashlib.sha256(self.data).hexdigest())
+
+        response = self.client.post(reverse('create_loop'), {
+            'title': 'With slides', 'category': 'General', 'difficulty': 'Beginner',
+            'description': 'Description', 'content': 'Content', 'price': 0,
+            'attachment_upload': state['id'],
+        })
+        loop = Loop.objects.get(title='With slides')
+        self.assertRedirects(response, reverse('loop_detail', args=[loop.pk]), fetch_redirect_response=False)
+        with loop.attachment.open('rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(ChunkedUpload.objects.exists())
+        self.assertFalse(os.path.exists(uploads.part_path(upload)))
+
+    def test_checksum_mismatch_restarts_the_upload(self):
+        state = self.start(sha256='0' * 64)
+        for offset in (0, 1000):
+            self.put(state['url'], offset)
+        self.assertEqual(self.put(state['url'], 2000).status_code, 422)
+        self.assertEqual(self.client.get(state['url']).json()['offset'], 0)
+
+    def test_unfinished_or_foreign_uploads_are_rejected(self):
+        state = self.start()
+        self.put(state['url'], 0)
+        form = LoopForm({
+            'title': 'T', 'category': 'General', 'difficulty': 'Beginner',
+            'description': 'D', 'content': 'C', 'price': 0, 'attachment_upload': state['id'],
+        }, user=self.user)
+        self.assertIn('attachment_upload', form.errors)
+
+        User.objects.create_user(username='other', password='pass')
+        self.client.login(username='other', password='pass')
+        self.assertEqual(self.client.get(state['url']).status_code, 404)
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False, LOOP_SIMILARITY_ASYNC=False)
+class AttachmentBlobTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.media = media.name
+        self.user = User.objects.create_user(username='creator', password='pass')
+
+    def make_loop(self, filename=None, data=None):
+        loop = Loop.objects.create(title='T', description='D', content='C', creator=self.user)
+        if filename:
+            loop.attachment.save(filename, ContentFile(data))
+        return loop
+
+    def test_identical_uploads_are_stored_once(self):
+        first = self.make_loop('notes.pdf', b'same bytes')
+        second = self.make_loop('copy of notes.PDF', b'same bytes')
+
+        self.assertEqual(first.attachment.name, second.attachment.name)
+        self.assertTrue(first.attachment.name.endswith(hashlib.sha256(b'same bytes').hexdigest() + '.pdf'))
+        self.assertEqual((first.attachment_name, second.attachment_name), ('notes.pdf', 'copy of notes.PDF'))
+        self.assertEqual(AttachmentBlob.objects.get().ref_count, 2)
+
+    def test_unreferenced_blobs_are_swept_after_the_grace_period(self):
+        first = self.make_loop('notes.pdf', b'version 1')
+        second = self.make_loop('notes.pdf', b'version 1')
+        old_name = first.attachment.name
+
+        first.attachment.save('notes.pdf', ContentFile(b'version 2'))
+        second.delete()
+        blob = AttachmentBlob.objects.get(name=old_name)
+        self.assertEqual(blob.ref_count, 0)
+
+        self.assertEqual(blobs.sweep(timedelta(hours=1)), (0, 0))
+        self.assertEqual(blobs.sweep(timedelta(0)), (1, len(b'version 1')))
+        self.assertFalse(blobs.attachment_storage().exists(old_name))
+        self.assertTrue(blobs.attachment_storage().exists(first.attachment.name))
+
+    def test_reupload_during_the_sweep_keeps_the_file(self):
+        storage = blobs.attachment_storage()
+        name = self.make_loop('notes.pdf', b'old notes').attachment.name
+        Loop.objects.all().delete()
+        AttachmentBlob.objects.update(released_at=timezone.now() - timedelta(days=2))
+
+        # The same bytes arrive again just before the sweep, but the loop isn't saved yet
+        self.assertEqual(storage.save('loop_attachments/again.pdf', ContentFile(b'old notes')), name)
+        self.assertEqual(blobs.sweep(timedelta(hours=1)), (0, 0))
+        self.assertTrue(storage.exists(name))
+
+        loop = self.make_loop()
+        loop.attachment = name
+        loop.save()
+        self.assertEqual(AttachmentBlob.objects.get(name=name).ref_count, 1)
+
+        # A stored file whose loop is never saved goes after the grace period
+        orphan = storage.save('loop_attachments/orphan.pdf', ContentFile(b'never attached'))
+        self.assertEqual(AttachmentBlob.objects.get(name=orphan).ref_count, 0)
+        self.assertEqual(blobs.sweep(timedelta(0)), (1, len(b'never attached')))
+        self.assertFalse(storage.exists(orphan))
+        self.assertTrue(storage.exists(name))
+
+    def test_deferred_and_refreshed_loops_keep_counts_right(self):
+        loop = self.make_loop('notes.pdf', b'notes')
+        other = self.make_loop('other.pdf', b'other')
+        counts = lambda: dict(AttachmentBlob.objects.values_list('name', 'ref_count'))
+
+        deferred = Loop.objects.only('title').get(pk=loop.pk)
+        deferred.title = 'Renamed'
+        deferred.save()
+        deferred.save(update_fields=['title'])
+
+        refreshed = Loop.objects.only('title').get(pk=loop.pk)
+        refreshed.refresh_from_db()
+        refreshed.save(update_fields=['attachment'])
+        self.assertEqual(counts(), {loop.attachment.name: 1, other.attachment.name: 1})
+
+        moved = Loop.objects.defer('attachment').get(pk=loop.pk)
+        moved.attachment = other.attachment.name
+        moved.save()
+        self.assertEqual(counts(), {loop.attachment.name: 0, other.attachment.name: 2})
+
+    def test_existing_attachments_are_deduplicated(self):
+        legacy = os.path.join(self.media, 'loop_attachments')
+        os.makedirs(legacy)
+        for filename, data in [('a.pdf', b'shared'), ('b.pdf', b'shared'), ('c.pdf', b'unique')]:
+            with open(os.path.join(legacy, filename), 'wb') as f:
+                f.write(data)
+        loops = [self.make_loop() for _ in range(3)]
+        for loop, filename in zip(loops, ['a.pdf', 'b.pdf', 'c.pdf']):
+            Loop.objects.filter(pk=loop.pk).update(attachment=f'loop_attachments/{filename}')
+
+        self.assertEqual(blobs.adopt_existing(), (2, 1, len(b'shared')))
+        a, b, c = [Loop.objects.get(pk=loop.pk) for loop in loops]
+        self.assertEqual(a.attachment.name, b.attachment.name)
+        self.assertEqual((b.attachment_name, c.attachment.read()), ('b.pdf', b'unique'))
+        self.assertEqual(AttachmentBlob.objects.get(name=a.attachment.name).ref_count, 2)
+        self.assertEqual(sorted(os.listdir(legacy)), sorted({a.attachment.name.split('/')[1], c.attachment.name.split('/')[1]}))
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False, LOOP_SIMILARITY_ASYNC=False, LOOP_PREVIEW_ASYNC=False,
+                   LOOP_PAGE_CACHE_ENABLED=False, LOOP_PREVIEW_SIZE=(64, 64))
+class PreviewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.user = User.objects.create_user(username='creator', password='pass')
+
+    def make_loop(self, filename, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            loop = Loop.objects.create(title='T', description='D', content='C', creator=self.user)
+            loop.attachment.save(filename, ContentFile(data))
+        return Loop.objects.get(pk=loop.pk)
+
+    def png(self, size=(400, 200)):
+        out = io.BytesIO()
+        Image.new('RGBA', size, (200, 10, 10, 128)).save(out, 'PNG')
+        return out.getvalue()
+
+    def test_image_attachments_get_a_preview(self):
+        loop = self.make_loop('diagram.png', self.png())
+        self.assertTrue(loop.preview.name.startswith('loop_previews/'))
+        self.assertEqual((loop.preview_width, loop.preview_height), (64, 32))
+        self.assertEqual(loop.preview_source, loop.attachment.name)
+
+        # The same image elsewhere reuses the rendered file
+        other = self.make_loop('copy.png', self.png())
+        self.assertEqual(other.preview.name, loop.preview.name)
+
+        content = self.client.get(reverse('loops_list')).content.decode()
+        self.assertIn(f'src="{loop.preview.url}"', content)
+        self.assertIn('width="64" height="32"', content)
+
+    def test_premium_loops_get_no_preview(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            loop = Loop.objects.create(
+                title='T', description='D', content='C', creator=self.user, is_premium=True, price=50,
+            )
+            loop.attachment.save('answers.png', ContentFile(self.png()))
+        loop.refresh_from_db()
+        self.assertFalse(loop.preview)
+        self.assertEqual(loop.preview_source, '')
+        self.assertNotIn(previews.PREVIEW_DIR, self.client.get(reverse('loops_list')).content.decode())
+
+        # Going premium later drops the preview it had
+        free = self.make_loop('diagram.png', self.png())
+        self.assertTrue(free.preview)
+        free.is_premium = True
+        with self.captureOnCommitCallbacks(execute=True):
+            free.save()
+        free.refresh_from_db()
+        self.assertFalse(free.preview)
+        cache.clear()
+        self.assertNotIn(previews.PREVIEW_DIR, self.client.get(reverse('loops_list')).content.decode())
+
+    def test_unpreviewable_attachments_are_not_retried(self):
+        loop = self.make_loop('notes.txt', b'plain text')
+        self.assertFalse(loop.preview)
+        self.assertEqual(loop.preview_source, loop.attachment.name)
+        self.assertFalse(previews.generate(loop.pk))
+
+    def test_backfill_command(self):
+        loop = self.make_loop('diagram.png', self.png())
+        Loop.objects.filter(pk=loop.pk).update(preview='', preview_source='')
+        call_command('generate_previews', threads=1, stdout=io.StringIO())
+        self.assertTrue(Loop.objects.get(pk=loop.pk).preview)
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False, LOOP_PAGE_CACHE_ENABLED=False, LOOP_SIMILARITY_ASYNC=False)
+class LoopBodyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='creator', password='pass')
+        self.lesson = 'Closures capture variables, not values. ' * 200
+        self.loop = Loop.objects.create(title='Closures', description='D', content=self.lesson, creator=self.user)
+
+    def test_body_is_stored_compressed(self):
+        body = LoopBody.objects.get(pk=self.loop.pk)
+        self.assertEqual(body.size, len(self.lesson))
+        self.assertLess(len(body.data), body.size // 10)
+        self.assertEqual(Loop.objects.get(pk=self.loop.pk).content, self.lesson)
+
+    def test_listings_leave_the_body_out(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('loops_list'))
+        sql = ' '.join(query['sql'] for query in ctx.captured_queries)
+        self.assertNotIn('loops_loopbody', sql)
+        self.assertNotIn('"loops_loop"."video_url"', sql)
+
+        response = self.client.get(reverse('loop_detail', args=[self.loop.pk]))
+        self.assertContains(response, 'Closures capture variables')
+
+    def test_editing_updates_the_body(self):
+        form = LoopForm(instance=Loop.objects.get(pk=self.loop.pk), user=self.user, data={
+            'title': 'Closures', 'description': 'D', 'content': 'Rewritten lesson',
+            'category': Loop.CATEGORY_CHOICES[0][0], 'difficulty': Loop.DIFFICULTY_CHOICES[0][0], 'price': 0,
+        })
+        self.assertEqual(form.initial['content'], self.lesson)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        self.assertEqual(Loop.objects.get(pk=self.loop.pk).content, 'Rewritten lesson')
+        self.assertEqual(LoopBody.objects.count(), 1)
+
+    def test_bodies_stay_searchable_without_the_fts_index(self):
+        with mock.patch.object(search, 'fts_available', return_value=False):
+            loop = Loop.objects.create(title='Generators', description='D', content='Lazy yield pipelines',
+                                       creator=self.user)
+            body = LoopBody.objects.get(pk=loop.pk)
+            self.assertEqual((bytes(body.data), body.plain_text), (b'', 'Lazy yield pipelines'))
+            self.assertEqual(Loop.objects.get(pk=loop.pk).content, 'Lazy yield pipelines')
+
+            response = self.client.get(reverse('loops_list'), {'q': 'yield'})
+            self.assertEqual([loop.title for loop in response.context['loops']], ['Generators'])
+        self.assertEqual(self.loop.body.plain_text, '')
+
+    def test_admin_edits_the_body(self):
+        admin = User.objects.create_superuser(username='admin', password='pass')
+        self.client.force_login(admin)
+        url = reverse('admin:loops_loop_change', args=[self.loop.pk])
+        self.assertContains(self.client.get(url), 'Closures capture variables')
+
+        version = Loop.objects.get(pk=self.loop.pk).card_version
+        response = self.client.post(url, {
+            'title': 'Closures', 'creator': self.user.pk, 'description': 'D', 'content': 'Admin rewrite',
+            'category': Loop.CATEGORY_CHOICES[0][0], 'difficulty': Loop.DIFFICULTY_CHOICES[0][0], 'price': 0,
+        })
+        self.assertEqual(response.status_code, 302)
+        loop = Loop.objects.get(pk=self.loop.pk)
+        self.assertEqual(loop.content, 'Admin rewrite')
+        self.assertEqual(loop.card_version, version + 1)
+        self.assertEqual([hit.pk for hit in search.search_loops(Loop.objects.all(), 'rewrite')], [loop.pk])
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False, LOOP_PAGE_CACHE_ENABLED=False, LOOP_SIMILARITY_ASYNC=False)
+class RenderedContentTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='creator', password='pass')
+        self.loop = Loop.objects.create(
+            title='T', description='D', content='<b>bold</b>\n\nSecond', creator=self.user,
+            video_url='https://youtu.be/abc123',
+        )
+        self.comment = Comment.objects.create(loop=self.loop, user=self.user, content='Nice\nthanks')
+
+    def test_html_is_rendered_when_saved(self):
+        loop = Loop.objects.select_related('body').get(pk=self.loop.pk)
+        self.assertEqual(loop.body.html_text, '<p>&lt;b&gt;bold&lt;/b&gt;</p>\n\n<p>Second</p>')
+        self.assertEqual(loop.video_embed_url, 'https://www.youtube.com/embed/abc123')
+        self.assertEqual(self.comment.rendered_html, '<p>Nice<br>thanks</p>')
+
+        # Viewing the loop uses the stored HTML
+        with mock.patch.object(rendering, 'render_text', side_effect=AssertionError("rendered on view")):
+            response = self.client.get(reverse('loop_detail', args=[self.loop.pk]))
+        self.assertContains(response, '<p>&lt;b&gt;bold&lt;/b&gt;</p>')
+        self.assertContains(response, 'src="https://www.youtube.com/embed/abc123"')
+        self.assertContains(response, '<p>Nice<br>thanks</p>')
+
+    def test_stale_rows_are_rendered_live_until_rerendered(self):
+        Loop.objects.filter(pk=self.loop.pk).update(render_version=0, video_embed_url='')
+        Comment.objects.filter(pk=self.comment.pk).update(render_version=0, rendered_html='')
+        response = self.client.get(reverse('loop_detail', args=[self.loop.pk]))
+        self.assertContains(response, 'src="https://www.youtube.com/embed/abc123"')
+        self.assertContains(response, '<p>Nice<br>thanks</p>')
+
+        call_command('rerender_content', stdout=io.StringIO())
+        loop = Loop.objects.get(pk=self.loop.pk)
+        self.assertEqual((loop.render_version, loop.video_embed_url), (rendering.RENDERER_VERSION, 'https://www.youtube.com/embed/abc123'))
+        self.assertEqual(Comment.objects.get(pk=self.comment.pk).rendered_html, '<p>Nice<br>thanks</p>')
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False, LOOP_SIMILARITY_ASYNC=False)
+class SimilarityTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path_override = override_settings(LOOP_SIMILARITY_PATH=os.path.join(tmp.name, 'similarity.npz'))
+        path_override.enable()
+        self.addCleanup(path_override.disable)
+
+        self.user = User.objects.create_user(username='user', password='pass')
+        topics = {
+            'algebra': 'quadratic equations factoring polynomials roots algebra',
+            'cells': 'biology cells mitochondria membrane nucleus organelles',
+            'python': 'python functions loops variables lists dictionaries programming',
+        }
+        self.loops = {}
+        for topic, words in topics.items():
+            for i in range(3):
+                self.loops[topic, i] = Loop.objects.create(
+                    title=f'{topic.title()} part {i}', description=words, content=f'{words} practice notes {i}',
+                    creator=self.user,
+                )
+
+    def test_rebuild_finds_loops_on_the_same_topic(self):
+        self.assertEqual(similarity.rebuild(batch_size=4, block_size=2), 9)
+
+        similar = similarity.similar_loops(self.loops['cells', 0])
+        self.assertEqual(
+            {loop.pk for loop in similar[:2]}, {self.loops['cells', 1].pk, self.loops['cells', 2].pk},
+        )
+
+    def test_new_loop_is_matched_incrementally(self):
+        similarity.rebuild()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            loop = Loop.objects.create(
+                title='More python', description='python functions lists programming',
+                content='python loops variables dictionaries', creator=self.user,
+            )
+
+        self.assertIn(self.loops['python', 0], similarity.similar_loops(loop, limit=3))
+        self.assertIn(loop, similarity.similar_loops(self.loops['python', 0], limit=10))
+
+    def test_detail_page_uses_precomputed_neighbours(self):
+        similarity.rebuild()
+
+        response = self.client.get(reverse('loop_detail', args=[self.loops['algebra', 0].pk]))
+
+        self.assertContains(response, 'Algebra part 1')
+        self.assertNotContains(response, 'Python part')
+
+
+@override_settings(LOOP_VIEWS_BUFFERED=False, LOOP_PAGE_CACHE_ENABLED=False)
+class TrendingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='pass')
+        self.old, self.new = (
+            Loop.objects.create(title=title, description='d', content='c', creator=self.user)
+            for title in ('Old favourite', 'New hit')
+        )
+
+    def score(self, loop):
+        return Loop.objects.values_list('trending_score', flat=True).get(pk=loop.pk)
+
+    def test_events_raise_the_score(self):
+        self.new.increment_views()
+        view = self.score(self.new)
+        Like.objects.create(user=self.user, loop=self.new)
+        Comment.objects.create(user=self.user, loop=self.new, content='Great')
+
+        self.assertGreater(view, 0)
+        self.assertGreater(self.score(self.new), view * 10)
+
+    def test_older_events_count_for_less(self):
+        Like.objects.create(user=self.user, loop=self.old)
+        # Pretend a day has passed since that like: moving the epoch back amplifies new events
+        TrendingEpoch.objects.update(epoch=F('epoch') - trending.half_life())
+        Like.objects.create(user=self.user, loop=self.new)
+
+        self.assertAlmostEqual(self.score(self.new) / self.score(self.old), 2, places=3)
+
+    def test_renormalize_keeps_the_order(self):
+        Like.objects.create(user=self.user, loop=self.old)
+        Comment.objects.create(user=self.user, loop=self.new, content='Great')
+        TrendingEpoch.objects.update(epoch=F('epoch') - 3 * trending.half_life())
+        before = self.score(self.new) / self.score(self.old)
+
+        factor = trending.renormalize()
+
+        self.assertAlmostEqual(factor, 0.125, places=3)
+        self.assertAlmostEqual(self.score(self.new) / self.score(self.old), before)
+
+    def test_trending_sort(self):
+        Like.objects.create(user=self.user, loop=self.old)
+
+        response = self.client.get(reverse('loops_list'), {'sort': 'trending'})
+
+        content = response.content.decode()
+        self.assertLess(content.index('Old favourite'), content.index('New hit'))
@@ -0,0 +1,122 @@
+"""
+Time-decayed trending score.
+
+A loop's trending score is the sum of its events (views, likes, comments,
+purchases), each weighted and decayed exponentially with age. Rather than
+decaying every score continuously, each event is stored *amplified* by
+``exp((t - epoch) / tau)``: all loops decay at the same rate, so ordering
+by the stored ``Loop.trending_score`` is ordering by the decayed score, and
+an event is just ``trending_score = trending_score + amplified weight``.
+
+The amplification grows over time, so ``manage.py renormalize_trending``
+(run daily) moves the epoch forward and scales every score down in one
+UPDATE. Events read the epoch from the database in the same statement, so
+they stay on the right scale even while a renormalization runs.
+"""
+import math
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, FloatField, Subquery, Value
+from django.db.models.functions import Coalesce, Exp
+
+DEFAULT_WEIGHTS = {
+    'view': 1.0,
+    'like': 5.0,
+    'comment': 8.0,
+    'purchase': 20.0,
+}
+
+
+def half_life():
+    """Seconds for an event's weight to halve."""
+    return getattr(settings, 'LOOP_TRENDING_HALF_LIFE', 24 * 60 * 60)
+
+
+def tau():
+    return half_life() / math.log(2)
+
+
+def weight(event):
+    return getattr(settings, 'LOOP_TRENDING_WEIGHTS', DEFAULT_WEIGHTS)[event]
+
+
+def amplified(event, count=1):
+    """SQL expression for ``count`` ``event``s happening now, on the current epoch's scale."""
+    from .models import TrendingEpoch
+
+    now = time.time()
+    epoch = Coalesce(
+        Subquery(TrendingEpoch.objects.filter(pk=1).values('epoch')[:1]), Value(now),
+        output_field=FloatField(),
+    )
+    return Value(weight(event) * count) * Exp((Value(now) - epoch) / Value(tau()))
+
+
+def score_change(event, count=1):
+    """``update()`` kwargs adding ``count`` ``event``s to the score."""
+    return {'trending_score': F('trending_score') + amplified(event, count)}
+
+
+def record(event, loop_ids, count=1):
+    """Add ``count`` ``event``s to each loop in ``loop_ids``."""
+    from .models import Loop
+
+    loop_ids = list(loop_ids)
+    if loop_ids:
+        Loop.objects.filter(pk__in=loop_ids).update(**score_change(event, count))
+
+
+def renormalize(floor=1e-6):
+    """
+    Move the epoch to now and scale every score to match. Scores that have
+    decayed below ``floor`` are zeroed. Returns the factor applied.
+    """
+    from .models import Loop, TrendingEpoch
+
+    with transaction.atomic():
+        state, _ = TrendingEpoch.objects.select_for_update().get_or_create(pk=1, defaults={'epoch': time.time()})
+        now = time.time()
+        factor = math.exp((state.epoch - now) / tau())
+        Loop.objects.filter(trending_score__gt=0).update(trending_score=F('trending_score') * factor)
+        Loop.objects.filter(trending_score__gt=0, trending_score__lt=floor).update(trending_score=0)
+        state.epoch = now
+        state.save(update_fields=['epoch'])
+    return factor
+
+
+def rebuild(batch_size=1000):
+    """
+    Recompute every score from the timestamped history (likes, comments
+    and successful payments; views have no timestamps and start from zero).
+    """
+    from django.db.models import Count
+    from django.db.models.functions import TruncHour
+    from payments.models import Payment
+
+    from .models import Comment, Like, Loop, TrendingEpoch
+
+    with transaction.atomic():
+        state, _ = TrendingEpoch.objects.select_for_update().get_or_create(pk=1, defaults={'epoch': time.time()})
+        scale = tau()
+        scores = {}
+        sources = (
+            ('like', Like.objects.all()),
+            ('comment', Comment.objects.all()),
+            ('purchase', Payment.objects.filter(status='Success')),
+        )
+        for event, rows in sources:
+            # Bucketing by hour keeps this to one row per loop-hour instead of one per event
+            buckets = (
+                rows.order_by().annotate(hour=TruncHour('created_at'))
+                .values_list('loop_id', 'hour').annotate(n=Count('pk'))
+            )
+            for loop_id, hour, n in buckets.iterator():
+                amount = weight(event) * n * math.exp((hour.timestamp() - state.epoch) / scale)
+                scores[loop_id] = scores.get(loop_id, 0.0) + amount
+
+        Loop.objects.update(trending_score=0)
+        loops = [Loop(pk=loop_id, trending_score=score) for loop_id, score in scores.items()]
+        Loop.objects.bulk_update(loops, ['trending_score'], batch_size=batch_size)
+    return len(loops)
@@ -0,0 +1,223 @@
+"""
+Resumable chunked attachment uploads.
+
+The browser starts an upload with the file's name and size, then PUTs it
+in chunks of ``LOOP_UPLOAD_CHUNK_SIZE`` bytes, each tagged with the offset
+it starts at. Every chunk is streamed from the request straight into the
+upload's part file, so a request only lives as long as one chunk takes
+and nothing is buffered in memory. If the connection drops the client
+asks for the current offset and carries on from there.
+
+The SHA-256 of the file is computed as the chunks arrive. The running
+hash lives in the process that received the previous chunk; when a chunk
+lands on another process (or after a restart) the part file received so
+far is re-hashed once from disk. When the last byte arrives the upload is
+complete, and the loop form attaches it by id: ``as_file()`` hands the
+part file to the storage, which moves it into place instead of copying.
+
+``manage.py clean_uploads`` removes abandoned uploads.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import File
+from django.utils import timezone
+
+from .models import ChunkedUpload
+
+COPY_BLOCK_SIZE = 64 * 1024
+# Running hashes kept per process; an evicted one is rebuilt from disk
+MAX_RUNNING_HASHES = 256
+
+
+class UploadError(Exception):
+    """The request can't be applied to the upload; ``status`` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class OffsetMismatch(UploadError):
+    def __init__(self, offset):
+        super().__init__(f"Expected a chunk at offset {offset}.", status=409)
+        self.offset = offset
+
+
+def chunk_size():
+    return getattr(settings, 'LOOP_UPLOAD_CHUNK_SIZE', 1024 * 1024)
+
+
+def max_size():
+    return getattr(settings, 'LOOP_UPLOAD_MAX_SIZE', 500 * 1024 * 1024)
+
+
+def upload_dir():
+    return str(getattr(settings, 'LOOP_UPLOAD_DIR', os.path.join(settings.BASE_DIR, 'var', 'uploads')))
+
+
+def part_path(upload):
+    return os.path.join(upload_dir(), f'{upload.pk}.part')
+
+
+_hashes = OrderedDict()
+_hashes_lock = threading.Lock()
+
+
+def _running_hash(upload, offset):
+    """A SHA-256 of the first ``offset`` bytes of the upload."""
+    with _hashes_lock:
+        cached = _hashes.pop(upload.pk, None)
+    if cached is not None and cached[0] == offset:
+        return cached[1]
+
+    digest = hashlib.sha256()
+    remaining = offset
+    with open(part_path(upload), 'rb') as f:
+        while remaining > 0:
+            block = f.read(min(COPY_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest
+
+
+def _remember_hash(upload, offset, digest):
+    with _hashes_lock:
+        _hashes[upload.pk] = (offset, digest)
+        while len(_hashes) > MAX_RUNNING_HASHES:
+            _hashes.popitem(last=False)
+
+
+def start(user, filename, size, sha256=''):
+    filename = os.path.basename((filename or '').replace('\\', '/')).strip()
+    if not filename:
+        raise UploadError("A file name is required.")
+    if size <= 0 or size > max_size():
+        raise UploadError(f"Attachments must be between 1 byte and {max_size()} bytes.", status=413)
+
+    upload = ChunkedUpload.objects.create(
+        user=user, filename=filename[:255], size=size, sha256=(sha256 or '').lower(),
+    )
+    os.makedirs(upload_dir(), exist_ok=True)
+    open(part_path(upload), 'wb').close()
+    return upload
+
+
+def write_chunk(upload, offset, stream, length):
+    """
+    Append ``length`` bytes read from ``stream`` at ``offset``; it must be
+    where the upload has got to. Returns the refreshed upload.
+    """
+    if upload.is_complete:
+        raise UploadError("The upload is already complete.", status=409)
+    if offset != upload.offset:
+        raise OffsetMismatch(upload.offset)
+    if length <= 0 or length > chunk_size() * 2 or offset + length > upload.size:
+        raise UploadError("Bad chunk length.", status=413)
+
+    digest = _running_hash(upload, offset)
+    written = 0
+    with open(part_path(upload), 'r+b') as f:
+        f.seek(offset)
+        while written < length:
+            block = stream.read(min(COPY_BLOCK_SIZE, length - written))
+            if not block:
+                break
+            f.write(block)
+            digest.update(block)
+            written += len(block)
+        # Drop anything left behind by an earlier, interrupted attempt at this chunk
+        f.truncate()
+    if written != length:
+        # The client went away mid-chunk; the offset stays where it was
+        raise UploadError("The chunk was cut short.")
+
+    new_offset = offset + written
+    sha256 = digest.hexdigest() if new_offset == upload.size else None
+    if sha256 and upload.sha256 and upload.sha256 != sha256:
+        # Start over rather than attach a corrupted file
+        ChunkedUpload.objects.filter(pk=upload.pk).update(offset=0, updated_at=timezone.now())
+        open(part_path(upload), 'wb').close()
+        raise UploadError("The uploaded file doesn't match its checksum.", status=422)
+
+    changes = {'offset': new_offset, 'updated_at': timezone.now()}
+    if sha256:
+        changes.update(sha256=sha256, completed_at=timezone.now())
+    claimed = ChunkedUpload.objects.filter(pk=upload.pk, offset=offset, completed_at__isnull=True).update(**changes)
+    if not claimed:
+        # Another request wrote this chunk first
+        upload.refresh_from_db()
+        raise OffsetMismatch(upload.offset)
+    if not sha256:
+        _remember_hash(upload, new_offset, digest)
+
+    upload.refresh_from_db()
+    return upload
+
+
+class AssembledFile(File):
+    """A completed upload, moved into storage rather than copied."""
+
+    def __init__(self, upload):
+        super().__init__(None, upload.filename)
+        self.size = upload.size
+        self.sha256 = upload.sha256
+        self._path = part_path(upload)
+
+    def temporary_file_path(self):
+        return self._path
+
+    def open(self, mode='rb'):
+        self.file = open(self._path, mode)
+        return self
+
+    def chunks(self, chunk_size=None):
+        # Storages that can't move the file stream it instead
+        if self.file is None:
+            self.open()
+        return super().chunks(chunk_size)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def as_file(upload):
+    return AssembledFile(upload)
+
+
+def discard(upload):
+    """Delete an upload and whatever is left of its part file."""
+    try:
+        os.remove(part_path(upload))
+    except FileNotFoundError:
+        pass
+    with _hashes_lock:
+        _hashes.pop(upload.pk, None)
+    upload.delete()
+
+
+def clean(older_than=None):
+    """Remove uploads untouched for ``older_than`` and orphaned part files. Returns how many went."""
+    older_than = older_than or timedelta(seconds=getattr(settings, 'LOOP_UPLOAD_EXPIRY', 24 * 60 * 60))
+    cutoff = timezone.now() - older_than
+    removed = 0
+    for upload in ChunkedUpload.objects.filter(updated_at__lt=cutoff).iterator():
+        discard(upload)
+        removed += 1
+
+    directory = upload_dir()
+    if os.path.isdir(directory):
+        known = {f'{pk}.part' for pk in ChunkedUpload.objects.values_list('pk', flat=True)}
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name not in known and os.path.getmtime(path) < cutoff.timestamp():
+                os.remove(path)
+                removed += 1
+    return removed
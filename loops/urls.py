@@ -5,9 +5,14 @@ urlpatterns = [
     path('', views.loops_list, name='loops_list'),
     path('create/', views.create_loop, name='create_loop'),
     path('my-loops/', views.my_loops, name='my_loops'),
+    path('uploads/', views.start_upload, name='start_upload'),
+    path('uploads/<uuid:upload_id>/', views.upload_chunk, name='upload_chunk'),
     path('category/<str:category>/', views.category_view, name='category'),
     path('<int:pk>/', views.loop_detail, name='loop_detail'),
     path('<int:pk>/edit/', views.edit_loop, name='edit_loop'),
     path('<int:pk>/delete/', views.delete_loop, name='delete_loop'),
+    path('<int:pk>/comments/', views.loop_comments, name='loop_comments'),
+    path('<int:pk>/comments/add/', views.add_comment, name='add_comment'),
+    path('<int:pk>/attachment/', views.loop_attachment, name='loop_attachment'),
     path('<int:pk>/like/', views.like_loop, name='like_loop'),
 ]
\ No newline at end of file
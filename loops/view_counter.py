@@ -0,0 +1,138 @@
+"""
+Write-behind view counting for loops.
+
+Page views are collected in memory and written back as grouped
+``UPDATE ... SET views = views + n`` statements, either every
+``LOOP_VIEWS_FLUSH_INTERVAL`` seconds or as soon as
+``LOOP_VIEWS_FLUSH_THRESHOLD`` views are pending. Whatever is still
+buffered is flushed when the worker exits.
+"""
+import atexit
+import logging
+import threading
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models import F
+
+from . import trending
+
+logger = logging.getLogger(__name__)
+
+# Keep each UPDATE ... WHERE id IN (...) well under SQLite's variable limit
+UPDATE_BATCH_SIZE = 500
+
+
+class ViewCounter:
+    def __init__(self, flush_interval=5.0, flush_threshold=500):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._pending = Counter()
+        self._pending_total = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def record(self, loop_id, count=1):
+        """Buffer ``count`` views for a loop."""
+        with self._lock:
+            self._pending[loop_id] += count
+            self._pending_total += count
+            should_flush = self._pending_total >= self.flush_threshold
+
+        self._ensure_thread()
+        if should_flush:
+            self.flush()
+
+    def pending(self, loop_id=None):
+        with self._lock:
+            if loop_id is None:
+                return self._pending_total
+            return self._pending[loop_id]
+
+    def flush(self):
+        """Write buffered views to the database. Returns the number written."""
+        from .models import Loop
+
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, Counter()
+                self._pending_total = 0
+
+            if not pending:
+                return 0
+
+            # One UPDATE per distinct increment instead of one per loop
+            by_increment = defaultdict(list)
+            for loop_id, count in pending.items():
+                by_increment[count].append(loop_id)
+
+            try:
+                with transaction.atomic():
+                    for count, loop_ids in by_increment.items():
+                        for i in range(0, len(loop_ids), UPDATE_BATCH_SIZE):
+                            Loop.objects.filter(
+                                pk__in=loop_ids[i:i + UPDATE_BATCH_SIZE]
+                            ).update(views=F('views') + count, **trending.score_change('view', count))
+            except DatabaseError:
+                # Put the views back so the next flush retries them
+                with self._lock:
+                    self._pending.update(pending)
+                    self._pending_total += sum(pending.values())
+                logger.exception("Failed to flush %d buffered loop views", sum(pending.values()))
+                return 0
+
+            return sum(pending.values())
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='loop-view-counter', daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            finally:
+                # This thread owns its own connection; don't hold it open between flushes
+                connection.close()
+
+
+view_counter = ViewCounter(
+    flush_interval=getattr(settings, 'LOOP_VIEWS_FLUSH_INTERVAL', 5.0),
+    flush_threshold=getattr(settings, 'LOOP_VIEWS_FLUSH_THRESHOLD', 500),
+)
+
+# Don't drop buffered views when the worker shuts down
+atexit.register(view_counter.stop)
+
+
+def record_view_id(loop_id):
+    """Count one view of the loop with id ``loop_id`` using the configured strategy."""
+    from .models import Loop
+
+    if getattr(settings, 'LOOP_VIEWS_BUFFERED', True):
+        view_counter.record(loop_id)
+    else:
+        Loop.objects.filter(pk=loop_id).update(views=F('views') + 1, **trending.score_change('view'))
+
+
+def record_view(loop):
+    """Count one view of ``loop`` using the configured strategy."""
+    record_view_id(loop.pk)
+
+    # Keep the in-memory instance in step for the page being rendered
+    loop.views += 1
@@ -1,16 +1,28 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
 from django.contrib import messages
-from django.db.models import Q, Count
-from django.http import JsonResponse
-from django.core.paginator import Paginator
-from .models import Loop, Like, Comment
+from django.conf import settings
+from django.db.models import Count, Sum
+from django.http import Http404, JsonResponse
+from django.template.loader import render_to_string
+from django.urls import reverse
+from .models import ChunkedUpload, Loop, Like, Comment
 from payments.models import Payment     
+from learnloop.db_router import primary, replica_reads
 from .forms import LoopForm, CommentForm
+from .delivery import attachment_response
+from . import cards, entitlements, similarity, uploads
+from .search import search_loops
+from .page_cache import cache_anonymous_page
+from .pagination import SORT_ORDERINGS, CursorPaginator, estimated_count
+from .view_counter import record_view_id
 
 
+@cache_anonymous_page
+@replica_reads
 def loops_list(request):
-    loops_list = Loop.objects.all()
+    loops_list = cards.for_cards(Loop.objects.all())
 
     # Filtering
     category = request.GET.get('category')
@@ -25,22 +37,16 @@ def loops_list(request):
         loops_list = loops_list.filter(difficulty=difficulty)
 
     if search_query:
-        loops_list = loops_list.filter(
-            Q(title__icontains=search_query) |
-            Q(description__icontains=search_query) |
-            Q(content__icontains=search_query) |
-            Q(category__icontains=search_query)
-        )
+        loops_list = search_loops(loops_list, search_query)
 
-    valid_sort_fields = ['-created_at', 'created_at', '-views', '-likes_count']
-    if sort_by in valid_sort_fields:
-        loops_list = loops_list.order_by(sort_by)
-
-    loops_list = loops_list.annotate(likes_count=Count('likes'))
+    if search_query and 'sort' not in request.GET and 'search_rank' in loops_list.query.annotations:
+        # Most relevant first when searching without an explicit sort
+        ordering = ('search_rank', '-pk')
+    else:
+        ordering = SORT_ORDERINGS.get(sort_by, SORT_ORDERINGS['-created_at'])
 
-    paginator = Paginator(loops_list, 12)
-    page_number = request.GET.get('page')
-    loops = paginator.get_page(page_number)
+    paginator = CursorPaginator(loops_list, ordering, per_page=12)
+    loops = paginator.get_page(request.GET.get('cursor'))
 
     context = {
         'loops': loops,
@@ -50,68 +56,157 @@ def loops_list(request):
         'current_difficulty': difficulty,
         'search_query': search_query,
         'sort_by': sort_by,
-        'total_loops': loops_list.count(),
+        'page_query': _page_query(request),
+        'sort_links': _sort_links(request),
+        'total_loops': _total(loops_list),
+        'purchased_loop_ids': entitlements.purchased_loop_ids(request.user),
     }
     return render(request, 'loops/loops_list.html', context)
 
 
-def _user_has_access(user, loop):
-    """Check if user purchased a premium loop."""
-    if not loop.is_premium:
-        return True
-    if not user.is_authenticated:
-        return False
-    return Payment.objects.filter(user=user, loop=loop, status="COMPLETED").exists()
+def _page_query(request):
+    """The current query string minus the cursor, for building page links."""
+    query = request.GET.copy()
+    query.pop('cursor', None)
+    query.pop('page', None)
+    return query.urlencode()
+
+
+SORT_LABELS = [
+    ('-created_at', 'Newest'),
+    ('trending', 'Trending'),
+    ('-views', 'Most viewed'),
+    ('-likes_count', 'Most liked'),
+]
+
+
+def _sort_links(request):
+    """``(value, label, query string)`` for each sort option, keeping the current filters."""
+    links = []
+    for value, label in SORT_LABELS:
+        query = request.GET.copy()
+        query.pop('cursor', None)
+        query['sort'] = value
+        links.append((value, label, query.urlencode()))
+    return links
 
 
+def _total(queryset):
+    if not getattr(settings, 'LOOP_LIST_ESTIMATE_TOTALS', True):
+        return None
+    return estimated_count(queryset)
+
+
+@cache_anonymous_page(on_hit=lambda request, pk: record_view_id(pk), loop_kwarg='pk')
+@replica_reads
 def loop_detail(request, pk):
-    loop = get_object_or_404(Loop, pk=pk)
+    loop = get_object_or_404(Loop.objects.select_related('creator', 'body'), pk=pk)
 
     # views
     loop.increment_views()
 
-    # like status
-    is_liked = False
-    if request.user.is_authenticated:
-        is_liked = Like.objects.filter(user=request.user, loop=loop).exists()
+    # The viewer's own likes and purchases come from the primary, so they show up straight away
+    with primary():
+        # like status
+        is_liked = False
+        if request.user.is_authenticated:
+            is_liked = Like.objects.filter(user=request.user, loop=loop).exists()
 
-    # USER ACCESS
-    has_access = _user_has_access(request.user, loop)
+        # USER ACCESS
+        has_access = entitlements.has_access(request.user, loop)
 
-    # Comments
-    comments = loop.comments.all()
+    # Newest comments only; older pages come from loop_comments
+    comments = _comment_page(loop.pk)
+    form = CommentForm()
 
-    if request.method == 'POST':
-        if not request.user.is_authenticated:
-            messages.warning(request, 'Please login to comment.')
-            return redirect('login')
-
-        form = CommentForm(request.POST)
-        if form.is_valid():
-            comment = form.save(commit=False)
-            comment.loop = loop
-            comment.user = request.user
-            comment.save()
-            messages.success(request, 'Comment added.')
-            return redirect('loop_detail', pk=pk)
-    else:
-        form = CommentForm()
-
-    similar_loops = Loop.objects.filter(category=loop.category).exclude(pk=pk)[:4]
+    similar_loops = similarity.similar_loops(loop, limit=4)
+    if not similar_loops:
+        # Not indexed yet (new loop, or rebuild_similarity hasn't run)
+        similar_loops = Loop.objects.filter(category=loop.category).exclude(pk=pk).only(*cards.COMPACT_COLUMNS)[:4]
 
     context = {
         'loop': loop,
         'has_access': has_access,
         'is_liked': is_liked,
         'comments': comments,
+        'comments_url': reverse('loop_comments', args=[loop.pk]),
         'form': form,
         'similar_loops': similar_loops,
-        'likes_count': loop.likes.count(),
-        'comments_count': comments.count(),
+        'likes_count': loop.likes_count,
+        'comments_count': loop.comments_count,
     }
     return render(request, 'loops/loop_detail.html', context)
 
 
+def _comment_page(loop_id, cursor=None):
+    """One page of a loop's comments, newest first (one query)."""
+    comments = Comment.objects.filter(loop_id=loop_id).select_related('user')
+    per_page = getattr(settings, 'LOOP_COMMENTS_PER_PAGE', 20)
+    return CursorPaginator(comments, SORT_ORDERINGS['-created_at'], per_page=per_page).get_page(cursor)
+
+
+def _is_ajax(request):
+    return request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+
+
+@replica_reads
+def loop_comments(request, pk):
+    """Older comments for the detail page: ``?cursor=`` from the previous page."""
+    page = _comment_page(pk, request.GET.get('cursor'))
+    html = render_to_string('loops/_comment_list.html', {'comments': page})
+    return JsonResponse({
+        'html': html,
+        'count': len(page),
+        'next_cursor': page.next_cursor,
+    })
+
+
+@login_required
+def add_comment(request, pk):
+    if request.method != 'POST':
+        return redirect('loop_detail', pk=pk)
+    loop = get_object_or_404(Loop.objects.only('pk'), pk=pk)
+
+    form = CommentForm(request.POST)
+    if not form.is_valid():
+        if _is_ajax(request):
+            return JsonResponse({'errors': form.errors}, status=400)
+        messages.error(request, 'Your comment could not be posted.')
+        return redirect('loop_detail', pk=pk)
+
+    comment = form.save(commit=False)
+    comment.loop = loop
+    comment.user = request.user
+    comment.save()
+
+    if _is_ajax(request):
+        return JsonResponse({
+            'html': render_to_string('loops/_comment.html', {'comment': comment}),
+            'comments_count': Loop.objects.values_list('comments_count', flat=True).get(pk=pk),
+        }, status=201)
+    messages.success(request, 'Comment added.')
+    return redirect('loop_detail', pk=pk)
+
+
+def loop_attachment(request, pk):
+    """Download a loop's attachment; premium ones need a purchase (or to be the creator)."""
+    loop = get_object_or_404(Loop.objects.only('pk', 'creator_id', 'is_premium', 'attachment', 'attachment_name'), pk=pk)
+    if not loop.attachment:
+        raise Http404("This loop has no attachment.")
+
+    if loop.is_premium and loop.creator_id != request.user.id:
+        if not request.user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        if not entitlements.has_access(request.user, loop):
+            messages.warning(request, 'Buy this loop to download its attachment.')
+            return redirect('loop_detail', pk=pk)
+
+    try:
+        return attachment_response(request, loop.attachment, loop.attachment_name)
+    except FileNotFoundError:
+        raise Http404("Attachment file is missing.")
+
+
 @login_required
 def purchase_loop(request, pk):
     loop = get_object_or_404(Loop, pk=pk)
@@ -121,7 +216,7 @@ def purchase_loop(request, pk):
         return redirect('loop_detail', pk=pk)
 
     # check if already purchased
-    if Payment.objects.filter(user=request.user, loop=loop, status="COMPLETED").exists():
+    if entitlements.has_access(request.user, loop):
         messages.success(request, "You already bought this loop.")
         return redirect('loop_detail', pk=pk)
 
@@ -130,7 +225,7 @@ def purchase_loop(request, pk):
         user=request.user,
         loop=loop,
         amount=loop.price,
-        status="PENDING",
+        status="Pending",
     )
 
     return redirect('initiate_payment', payment_id=payment.id)
@@ -139,7 +234,7 @@ def purchase_loop(request, pk):
 @login_required
 def create_loop(request):
     if request.method == 'POST':
-        form = LoopForm(request.POST, request.FILES)
+        form = LoopForm(request.POST, request.FILES, user=request.user)
         if form.is_valid():
             loop = form.save(commit=False)
             loop.creator = request.user
@@ -148,6 +243,7 @@ def create_loop(request):
                 loop.price = 0
 
             loop.save()
+            form.finish_upload()
             messages.success(request, 'Loop created!')
             return redirect('loop_detail', pk=loop.pk)
         else:
@@ -167,12 +263,13 @@ def edit_loop(request, pk):
         return redirect('loop_detail', pk=pk)
 
     if request.method == 'POST':
-        form = LoopForm(request.POST, request.FILES, instance=loop)
+        form = LoopForm(request.POST, request.FILES, instance=loop, user=request.user)
         if form.is_valid():
             loop = form.save(commit=False)
             if not loop.is_premium:
                 loop.price = 0
             loop.save()
+            form.finish_upload()
             messages.success(request, 'Updated.')
             return redirect('loop_detail', pk=pk)
     else:
@@ -181,6 +278,53 @@ def edit_loop(request, pk):
     return render(request, 'loops/edit_loop.html', {'form': form, 'loop': loop})
 
 
+def _upload_state(upload):
+    return {
+        'id': str(upload.pk),
+        'offset': upload.offset,
+        'size': upload.size,
+        'complete': upload.is_complete,
+        'url': reverse('upload_chunk', args=[upload.pk]),
+    }
+
+
+@login_required
+def start_upload(request):
+    """Begin a chunked attachment upload: POST ``filename``, ``size`` and optionally ``sha256``."""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required.'}, status=405)
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        return JsonResponse({'error': 'size must be a number of bytes.'}, status=400)
+    try:
+        upload = uploads.start(request.user, request.POST.get('filename'), size, request.POST.get('sha256', ''))
+    except uploads.UploadError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    return JsonResponse(dict(_upload_state(upload), chunk_size=uploads.chunk_size()), status=201)
+
+
+@login_required
+def upload_chunk(request, upload_id):
+    """GET the upload's progress, or PUT the chunk starting at the ``Upload-Offset`` header."""
+    upload = get_object_or_404(ChunkedUpload, pk=upload_id, user=request.user)
+    if request.method == 'PUT':
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return JsonResponse({'error': 'Upload-Offset and Content-Length are required.'}, status=400)
+        try:
+            upload = uploads.write_chunk(upload, offset, request, length)
+        except uploads.OffsetMismatch as e:
+            return JsonResponse(dict(_upload_state(upload), offset=e.offset, error=str(e)), status=e.status)
+        except uploads.UploadError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+    elif request.method not in ('GET', 'HEAD'):
+        return JsonResponse({'error': 'GET or PUT required.'}, status=405)
+    return JsonResponse(_upload_state(upload))
+
+
 @login_required
 def delete_loop(request, pk):
     loop = get_object_or_404(Loop, pk=pk)
@@ -210,10 +354,11 @@ def like_loop(request, pk):
         else:
             action = 'liked'
 
-        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        if _is_ajax(request):
+            likes_count = Loop.objects.values_list('likes_count', flat=True).get(pk=loop.pk)
             return JsonResponse({
                 'action': action,
-                'likes_count': loop.likes.count()
+                'likes_count': likes_count
             })
 
         messages.info(request, f"You {action} this loop.")
@@ -223,14 +368,30 @@ def like_loop(request, pk):
 
 @login_required
 def my_loops(request):
-    loops = Loop.objects.filter(creator=request.user).order_by('-created_at')
-    return render(request, 'loops/my_loops.html', {'loops': loops})
+    my_loops = cards.for_cards(Loop.objects.filter(creator=request.user))
+    paginator = CursorPaginator(my_loops, SORT_ORDERINGS['-created_at'], per_page=20)
+    loops = paginator.get_page(request.GET.get('cursor'))
+    stats = my_loops.aggregate(
+        total_loops=Count('pk'), total_views=Sum('views'), total_likes=Sum('likes_count'),
+    )
+    return render(request, 'loops/my_loops.html', {
+        'loops': loops,
+        'stats': stats,
+        'page_query': _page_query(request),
+    })
 
 
+@cache_anonymous_page
+@replica_reads
 def category_view(request, category):
-    loops = Loop.objects.filter(category=category).order_by('-created_at')
+    category_loops = cards.for_cards(Loop.objects.filter(category=category))
+    paginator = CursorPaginator(category_loops, SORT_ORDERINGS['-created_at'], per_page=12)
+    loops = paginator.get_page(request.GET.get('cursor'))
     return render(request, 'loops/category.html', {
         'loops': loops,
         'category': category,
         'category_name': dict(Loop.CATEGORY_CHOICES).get(category, category),
+        'total_loops': _total(category_loops),
+        'page_query': _page_query(request),
+        'purchased_loop_ids': entitlements.purchased_loop_ids(request.user),
     })
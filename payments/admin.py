@@ -1,4 +1,7 @@
 from django.contrib import admin
-from .models import Payment
+from .models import CallbackInbox, Payment, PaymentJob, ReconciliationCheckpoint
 
 admin.site.register(Payment)
+admin.site.register(PaymentJob)
+admin.site.register(CallbackInbox)
+admin.site.register(ReconciliationCheckpoint)
@@ -0,0 +1,110 @@
+"""
+M-Pesa callback ingestion.
+
+``mpesa_callback`` stores each callback in ``CallbackInbox`` with a single
+INSERT (Safaricom's retries hit the unique CheckoutRequestID and are
+dropped) and acknowledges straight away. ``process_batch`` then applies a
+batch of inbox rows in one transaction: it looks the payments up in one
+query, updates them in bulk and grants all the new purchases in one insert.
+Only payments still Pending are touched, so applying the same callback
+twice, or from two processors at once, changes nothing the second time.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from loops import entitlements
+
+from .models import CallbackInbox, Payment
+
+
+class MalformedCallback(ValueError):
+    pass
+
+
+def parse(payload):
+    """Return ``(checkout_id, result_code, receipt_number)`` from a callback body."""
+    try:
+        callback = payload["Body"]["stkCallback"]
+        checkout_id = str(callback["CheckoutRequestID"])
+        result_code = int(callback["ResultCode"])
+    except (KeyError, TypeError, ValueError) as exc:
+        raise MalformedCallback(f"Not an STK callback: {exc!r}") from exc
+
+    receipt = None
+    if result_code == 0:
+        items = (callback.get("CallbackMetadata") or {}).get("Item") or []
+        for item in items:
+            if item.get("Name") == "MpesaReceiptNumber":
+                receipt = str(item.get("Value"))
+    return checkout_id, result_code, receipt
+
+
+def receive(payload):
+    """Store a callback in the inbox; a repeat of a stored callback is ignored."""
+    checkout_id, _, _ = parse(payload)
+    CallbackInbox.objects.bulk_create(
+        [CallbackInbox(checkout_request_id=checkout_id, payload=payload)],
+        ignore_conflicts=True,
+    )
+
+
+def process_batch(limit=None, after=0):
+    """
+    Apply up to ``limit`` pending callbacks with ids above ``after``.
+    Returns ``(rows settled, last id looked at)``; the last id is None when
+    there was nothing left to look at.
+    """
+    limit = limit or getattr(settings, 'PAYMENT_CALLBACK_BATCH_SIZE', 500)
+    grace = timedelta(seconds=getattr(settings, 'PAYMENT_CALLBACK_ORPHAN_GRACE', 300))
+    now = timezone.now()
+
+    with transaction.atomic():
+        rows = list(
+            CallbackInbox.objects.filter(processed_at__isnull=True, pk__gt=after).order_by('pk')[:limit]
+        )
+        if not rows:
+            return 0, None
+
+        payments = Payment.objects.in_bulk(
+            [row.checkout_request_id for row in rows], field_name='checkout_request_id',
+        )
+        succeeded, failed, settled, orphans = [], [], [], []
+        for row in rows:
+            _, result_code, receipt = parse(row.payload)
+            payment = payments.get(row.checkout_request_id)
+            if payment is None:
+                # The worker may not have stored the checkout id yet; give it a while
+                if row.received_at > now - grace:
+                    continue
+                orphans.append(row.pk)
+                continue
+            settled.append(row.pk)
+            if payment.status != 'Pending':
+                continue
+            if result_code == 0:
+                payment.status = 'Success'
+                payment.receipt_number = receipt
+                succeeded.append(payment)
+            else:
+                failed.append(payment.pk)
+
+        Payment.objects.bulk_update(succeeded, ['status', 'receipt_number'])
+        Payment.objects.filter(pk__in=failed, status='Pending').update(status='Failed')
+        entitlements.grant_many((payment.user_id, payment.loop_id) for payment in succeeded)
+        CallbackInbox.objects.filter(pk__in=settled).update(processed_at=now)
+        CallbackInbox.objects.filter(pk__in=orphans).update(processed_at=now, error='No matching payment')
+
+    return len(settled) + len(orphans), rows[-1].pk
+
+
+def process_pending(limit=None):
+    """Work through the whole inbox batch by batch. Returns the number of rows settled."""
+    total, after = 0, 0
+    while True:
+        done, after = process_batch(limit, after=after)
+        if after is None:
+            return total
+        total += done
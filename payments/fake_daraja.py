@@ -0,0 +1,158 @@
+"""
+A local stand-in for the Daraja API, for tests and load runs.
+
+    with FakeDaraja(latency=0.2) as fake:
+        client = DarajaClient(base_url=fake.base_url, ...)
+
+or from the shell: ``manage.py fake_daraja --port 8089`` and point
+``MPESA_API_BASE_URL`` at it. It issues OAuth tokens, accepts STK pushes,
+answers STK queries and records every request it sees.
+"""
+import base64
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeDarajaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        fake = self.server.fake
+        fake.record(self)
+        if not self.path.startswith('/oauth/v1/generate'):
+            return self._send(404, {'errorMessage': 'Not found'})
+
+        expected = base64.b64encode(f"{fake.consumer_key}:{fake.consumer_secret}".encode()).decode()
+        if self.headers.get('Authorization') != f"Basic {expected}":
+            return self._send(401, {'errorMessage': 'Invalid credentials'})
+
+        with fake.lock:
+            fake.tokens_issued += 1
+            token = f"fake-token-{fake.tokens_issued}"
+            fake.valid_tokens.add(token)
+        self._send(200, {'access_token': token, 'expires_in': str(fake.token_ttl)})
+
+    def do_POST(self):
+        fake = self.server.fake
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        fake.record(self, body)
+
+        token = (self.headers.get('Authorization') or '').removeprefix('Bearer ')
+        if token not in fake.valid_tokens:
+            return self._send(401, {'errorMessage': 'Invalid Access Token'})
+
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        handler = fake.routes.get(self.path.split('?')[0])
+        if handler is None:
+            return self._send(404, {'errorMessage': 'Not found'})
+        status, payload = handler(json.loads(body or b'{}'))
+        self._send(status, payload)
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeDaraja:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, token_ttl=3599,
+                 consumer_key='test-key', consumer_secret='test-secret'):
+        self.latency = latency
+        self.token_ttl = token_ttl
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.lock = threading.Lock()
+        self.requests = []
+        self.tokens_issued = 0
+        self.valid_tokens = set()
+        self.stk_pushes = {}
+        # CheckoutRequestID -> ResultCode reported by STK query; unknown ids are "still processing"
+        self.results = {}
+        # CheckoutRequestID -> (HTTP status, errorCode) the STK query fails with instead
+        self.query_errors = {}
+        self.routes = {
+            '/mpesa/stkpush/v1/processrequest': self.handle_stk_push,
+            '/mpesa/stkpushquery/v1/query': self.handle_stk_query,
+        }
+        self.server = ThreadingHTTPServer((host, port), FakeDarajaHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record(self, handler, body=b''):
+        with self.lock:
+            self.requests.append((handler.command, handler.path, body))
+
+    def revoke_tokens(self):
+        with self.lock:
+            self.valid_tokens.clear()
+
+    def handle_stk_push(self, payload):
+        checkout_id = f"ws_CO_{uuid.uuid4().hex[:20]}"
+        with self.lock:
+            self.stk_pushes[checkout_id] = payload
+        return 200, {
+            'MerchantRequestID': uuid.uuid4().hex[:12],
+            'CheckoutRequestID': checkout_id,
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        }
+
+    def handle_stk_query(self, payload):
+        checkout_id = payload.get('CheckoutRequestID')
+        with self.lock:
+            result_code = self.results.get(checkout_id)
+            error = self.query_errors.get(checkout_id)
+        if error is not None:
+            status, error_code = error
+            return status, {
+                'requestId': uuid.uuid4().hex[:12],
+                'errorCode': error_code,
+                'errorMessage': 'Request rejected',
+            }
+        if result_code is None:
+            return 500, {
+                'requestId': uuid.uuid4().hex[:12],
+                'errorCode': '500.001.1001',
+                'errorMessage': 'The transaction is being processed',
+            }
+        return 200, {
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'MerchantRequestID': uuid.uuid4().hex[:12],
+            'CheckoutRequestID': checkout_id,
+            'ResultCode': str(result_code),
+            'ResultDesc': 'The service request is processed successfully.' if str(result_code) == '0' else 'Request cancelled by user',
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,197 @@
+"""
+Daraja (M-Pesa) API client.
+
+One ``DarajaClient`` is shared per process (``get_client()``). It keeps a
+pooled ``requests.Session`` with short timeouts, caches the OAuth token
+until shortly before it expires (only one thread refreshes it at a time),
+and limits how many calls can be in flight at once so a slow Safaricom
+endpoint can't tie up every worker thread: when the bulkhead is full,
+callers get ``GatewayBusy`` straight away instead of queueing.
+"""
+import base64
+import threading
+import time
+from datetime import datetime
+
+import requests
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from requests.adapters import HTTPAdapter
+
+# Safaricom's public test paybill, used when MPESA_SHORTCODE isn't set
+SANDBOX_SHORTCODE = "174379"
+
+TOKEN_PATH = "/oauth/v1/generate?grant_type=client_credentials"
+STK_PUSH_PATH = "/mpesa/stkpush/v1/processrequest"
+STK_QUERY_PATH = "/mpesa/stkpushquery/v1/query"
+
+
+class GatewayError(Exception):
+    """The Daraja API could not be reached or returned an error."""
+
+
+class GatewayBusy(GatewayError):
+    """Too many Daraja calls are already in flight."""
+
+
+class DarajaClient:
+    def __init__(self, base_url, consumer_key, consumer_secret, shortcode, passkey, callback_url,
+                 connect_timeout=3.05, read_timeout=10, pool_size=10, max_concurrency=4,
+                 bulkhead_wait=0.5, token_margin=60):
+        self.base_url = base_url.rstrip('/')
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.shortcode = shortcode
+        self.passkey = passkey
+        self.callback_url = callback_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.bulkhead_wait = bulkhead_wait
+        self.token_margin = token_margin
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._bulkhead = threading.BoundedSemaphore(max_concurrency)
+        self._token = None
+        self._token_expires_at = 0.0
+        self._token_lock = threading.Lock()
+
+    # --- Auth ---
+
+    def access_token(self):
+        """Return a valid OAuth token, fetching a new one only when it's about to expire."""
+        if self._token and time.monotonic() < self._token_expires_at:
+            return self._token
+
+        with self._token_lock:
+            # Another thread may have refreshed it while we waited
+            if self._token and time.monotonic() < self._token_expires_at:
+                return self._token
+
+            data = self._call('GET', TOKEN_PATH, auth=(self.consumer_key, self.consumer_secret))
+            token = data.get('access_token')
+            if not token:
+                raise GatewayError(f"No access token in Daraja response: {data}")
+            expires_in = int(data.get('expires_in', 3599))
+            self._token = token
+            self._token_expires_at = time.monotonic() + max(expires_in - self.token_margin, 0)
+            return token
+
+    def invalidate_token(self):
+        with self._token_lock:
+            self._token = None
+            self._token_expires_at = 0.0
+
+    def password(self, timestamp):
+        return base64.b64encode((self.shortcode + self.passkey + timestamp).encode()).decode()
+
+    # --- API calls ---
+
+    def stk_push(self, phone_number, amount, account_reference, transaction_desc, callback_url=None):
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": self.password(timestamp),
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": int(amount),
+            "PartyA": phone_number,
+            "PartyB": self.shortcode,
+            "PhoneNumber": phone_number,
+            "CallBackURL": callback_url or self.callback_url,
+            "AccountReference": account_reference,
+            "TransactionDesc": transaction_desc,
+        }
+        return self._authorized_call('POST', STK_PUSH_PATH, payload)
+
+    def stk_query(self, checkout_request_id):
+        """Ask Daraja for the outcome of an STK push."""
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": self.password(timestamp),
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id,
+        }
+        return self._authorized_call('POST', STK_QUERY_PATH, payload)
+
+    def _authorized_call(self, method, path, payload):
+        try:
+            return self._call(method, path, json=payload, token=self.access_token())
+        except GatewayError as exc:
+            if getattr(exc, 'status_code', None) != 401:
+                raise
+        # The token was revoked early; refresh once and retry
+        self.invalidate_token()
+        return self._call(method, path, json=payload, token=self.access_token())
+
+    def _call(self, method, path, token=None, **kwargs):
+        if not self._bulkhead.acquire(timeout=self.bulkhead_wait):
+            raise GatewayBusy("Too many M-Pesa requests in flight")
+        try:
+            headers = {"Authorization": f"Bearer {token}"} if token else {}
+            response = self.session.request(
+                method, self.base_url + path, headers=headers, timeout=self.timeout, **kwargs
+            )
+        except requests.RequestException as exc:
+            raise GatewayError(f"Daraja request to {path} failed: {exc}") from exc
+        finally:
+            self._bulkhead.release()
+
+        if response.status_code >= 400:
+            error = GatewayError(f"Daraja {path} returned {response.status_code}: {response.text[:200]}")
+            error.status_code = response.status_code
+            try:
+                error.error_code = response.json().get('errorCode')
+            except ValueError:
+                error.error_code = None
+            raise error
+        try:
+            return response.json()
+        except ValueError as exc:
+            raise GatewayError(f"Daraja {path} returned invalid JSON") from exc
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _credential(name):
+    value = getattr(settings, name, None)
+    if not value:
+        raise ImproperlyConfigured(f"{name} is not set; provide it in the environment to call Daraja.")
+    return value
+
+
+def get_client():
+    """
+    Return the process-wide Daraja client, creating it from settings on
+    first use. Raises ImproperlyConfigured when the credentials are missing.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = DarajaClient(
+                    base_url=settings.MPESA_API_BASE_URL,
+                    consumer_key=_credential('MPESA_CONSUMER_KEY'),
+                    consumer_secret=_credential('MPESA_CONSUMER_SECRET'),
+                    shortcode=settings.MPESA_EXPRESS_SHORTCODE or SANDBOX_SHORTCODE,
+                    passkey=_credential('MPESA_PASSKEY'),
+                    callback_url=settings.MPESA_CALLBACK_URL,
+                    connect_timeout=settings.MPESA_CONNECT_TIMEOUT,
+                    read_timeout=settings.MPESA_READ_TIMEOUT,
+                    pool_size=settings.MPESA_POOL_SIZE,
+                    max_concurrency=settings.MPESA_MAX_CONCURRENCY,
+                    bulkhead_wait=settings.MPESA_BULKHEAD_WAIT,
+                )
+    return _client
+
+
+def reset_client():
+    """Drop the shared client (e.g. after changing settings in tests)."""
+    global _client
+    with _client_lock:
+        _client = None
@@ -0,0 +1,118 @@
+"""
+Database-backed queue for gateway work.
+
+The web process only inserts a ``PaymentJob``; ``manage.py run_payment_worker``
+claims due jobs, calls Daraja and records the outcome. A claim is a
+conditional UPDATE, so two workers can never run the same job, and a job
+whose worker died is picked up again once its lease runs out. Failed calls
+are retried with exponential backoff until ``PAYMENT_JOB_MAX_ATTEMPTS``.
+"""
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .gateway import GatewayBusy, GatewayError, get_client
+from .models import Payment, PaymentJob
+
+
+def max_attempts():
+    return getattr(settings, 'PAYMENT_JOB_MAX_ATTEMPTS', 5)
+
+
+def enqueue_stk_push(payment, delay=0):
+    return PaymentJob.objects.create(
+        payment=payment,
+        kind=PaymentJob.KIND_STK_PUSH,
+        run_after=timezone.now() + timedelta(seconds=delay),
+    )
+
+
+def backoff(attempts):
+    """Seconds to wait before retry number ``attempts`` (1-based), with jitter."""
+    base = getattr(settings, 'PAYMENT_JOB_RETRY_BASE', 2)
+    delay = min(base * 2 ** (attempts - 1), getattr(settings, 'PAYMENT_JOB_RETRY_MAX', 300))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _due(now):
+    # Queued and due, or claimed by a worker whose lease has run out
+    return Q(status='Queued', run_after__lte=now) | Q(status='Running', locked_until__lt=now)
+
+
+def claim(worker_id, limit=10):
+    """Atomically take up to ``limit`` due jobs for ``worker_id``."""
+    now = timezone.now()
+    lease_until = now + timedelta(seconds=getattr(settings, 'PAYMENT_JOB_LEASE', 60))
+    ids = list(
+        PaymentJob.objects.filter(_due(now)).order_by('run_after', 'pk').values_list('pk', flat=True)[:limit]
+    )
+    if not ids:
+        return []
+    # Re-checking the due condition in the UPDATE means only one worker wins each row
+    PaymentJob.objects.filter(_due(now), pk__in=ids).update(
+        status='Running', locked_by=worker_id, locked_until=lease_until, attempts=F('attempts') + 1,
+    )
+    return list(
+        PaymentJob.objects.filter(pk__in=ids, locked_by=worker_id, locked_until=lease_until)
+        .select_related('payment')
+    )
+
+
+def run(job):
+    """Carry out a claimed job and record the result."""
+    payment = job.payment
+    if payment.checkout_request_id or payment.status != 'Pending':
+        # Already pushed by an earlier run that died before marking the job done
+        return _finish(job, 'Done')
+
+    try:
+        response = get_client().stk_push(
+            phone_number=payment.phone_number,
+            amount=payment.amount,
+            account_reference=f"Loop-{payment.loop_id}",
+            transaction_desc="Payment for Premium Loop Access",
+        )
+    except GatewayError as exc:
+        return _retry_or_fail(job, exc)
+
+    with transaction.atomic():
+        Payment.objects.filter(pk=payment.pk).update(
+            checkout_request_id=response.get("CheckoutRequestID"),
+            merchant_request_id=response.get("MerchantRequestID"),
+        )
+        _finish(job, 'Done')
+
+
+def _retry_or_fail(job, exc):
+    status_code = getattr(exc, 'status_code', None)
+    # Rejected requests (bad phone number, wrong amount) won't succeed on retry
+    permanent = status_code is not None and 400 <= status_code < 500 and status_code != 429
+    if not permanent and (isinstance(exc, GatewayBusy) or job.attempts < max_attempts()):
+        run_after = timezone.now() + timedelta(seconds=backoff(job.attempts))
+        PaymentJob.objects.filter(pk=job.pk, locked_by=job.locked_by).update(
+            status='Queued', run_after=run_after, locked_by='', locked_until=None,
+            last_error=str(exc), updated_at=timezone.now(),
+        )
+        return
+
+    with transaction.atomic():
+        _finish(job, 'Failed', error=str(exc))
+        Payment.objects.filter(pk=job.payment_id, status='Pending').update(status='Failed')
+
+
+def _finish(job, status, error=''):
+    PaymentJob.objects.filter(pk=job.pk, locked_by=job.locked_by).update(
+        status=status, locked_until=None, last_error=error, updated_at=timezone.now(),
+    )
+
+
+def run_pending(worker_id, limit=10):
+    """Claim and run one batch of due jobs in this thread. Returns how many ran."""
+    jobs = claim(worker_id, limit=limit)
+    for job in jobs:
+        run(job)
+    return len(jobs)
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from payments.fake_daraja import FakeDaraja
+
+
+class Command(BaseCommand):
+    help = "Run a local fake Daraja API (point MPESA_API_BASE_URL at it)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8089)
+        parser.add_argument('--latency', type=float, default=0.0, help="Seconds to delay each API call")
+        parser.add_argument('--consumer-key', default='test-key')
+        parser.add_argument('--consumer-secret', default='test-secret')
+
+    def handle(self, *args, **options):
+        fake = FakeDaraja(
+            host=options['host'], port=options['port'], latency=options['latency'],
+            consumer_key=options['consumer_key'], consumer_secret=options['consumer_secret'],
+        ).start()
+        self.stdout.write(f"Fake Daraja listening on {fake.base_url} (Ctrl+C to stop)")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            fake.stop()
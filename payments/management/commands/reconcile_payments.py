@@ -0,0 +1,70 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from payments import reconciliation
+
+
+class Command(BaseCommand):
+    help = (
+        "Resolve stale Pending payments with Daraja STK queries. Resumes from the last checkpoint; "
+        "use --every to keep running as a daemon."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than', type=int, default=getattr(settings, 'PAYMENT_RECONCILE_AFTER', 600),
+            help="Only check payments pending for at least this many seconds",
+        )
+        parser.add_argument(
+            '--expire-unsent-after', type=int, default=getattr(settings, 'PAYMENT_UNSENT_EXPIRY', 24 * 3600),
+            help="Fail payments that never got an STK push after this many seconds",
+        )
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument(
+            '--threads', type=int, default=None,
+            help="Parallel STK queries (defaults to MPESA_MAX_CONCURRENCY)",
+        )
+        parser.add_argument('--limit', type=int, default=None, help="Stop after this many payments")
+        parser.add_argument('--name', default='default', help="Checkpoint name, for separate concurrent runs")
+        parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint and start from the beginning")
+        parser.add_argument('--every', type=int, default=None, help="Repeat every N seconds instead of exiting")
+
+    def handle(self, *args, **options):
+        while True:
+            self._run(options)
+            if not options['every']:
+                return
+            options['restart'] = False
+            time.sleep(options['every'])
+
+    def _run(self, options):
+        verbosity = options['verbosity']
+
+        def progress(checkpoint):
+            if verbosity > 1:
+                self.stdout.write(
+                    f"  up to payment {checkpoint.last_payment_id}: "
+                    f"{checkpoint.checked} checked, {checkpoint.resolved} resolved"
+                )
+
+        expired = reconciliation.expire_unsent(
+            timezone.now() - timedelta(seconds=options['expire_unsent_after'])
+        )
+        checkpoint = reconciliation.reconcile(
+            name=options['name'],
+            older_than=timedelta(seconds=options['older_than']),
+            batch_size=options['batch_size'],
+            threads=options['threads'] or getattr(settings, 'MPESA_MAX_CONCURRENCY', 4),
+            limit=options['limit'],
+            restart=options['restart'],
+            progress=progress,
+        )
+        state = "paused" if checkpoint.last_payment_id else "complete"
+        self.stdout.write(self.style.SUCCESS(
+            f"Reconciliation {state}: {checkpoint.checked} checked, {checkpoint.resolved} resolved, "
+            f"{expired} unsent payments expired."
+        ))
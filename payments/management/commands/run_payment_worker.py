@@ -0,0 +1,72 @@
+import os
+import socket
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+
+from payments import callbacks, jobs
+from payments.gateway import get_client
+
+
+class Command(BaseCommand):
+    help = (
+        "Process queued payment jobs (STK pushes) with retries and apply received M-Pesa callbacks. "
+        "Run one or more of these next to the web server."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads', type=int, default=None,
+            help="Jobs run in parallel (defaults to MPESA_MAX_CONCURRENCY)",
+        )
+        parser.add_argument('--batch-size', type=int, default=10, help="Jobs claimed per thread at a time")
+        parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds to sleep when the queue is empty")
+        parser.add_argument('--once', action='store_true', help="Exit when no jobs are due instead of polling")
+        parser.add_argument('--no-callbacks', action='store_true', help="Leave the callback inbox to another worker")
+
+    def handle(self, *args, **options):
+        try:
+            # Fail now rather than in every job
+            get_client()
+        except ImproperlyConfigured as exc:
+            raise CommandError(str(exc))
+
+        threads = options['threads'] or getattr(settings, 'MPESA_MAX_CONCURRENCY', 4)
+        prefix = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        stop = threading.Event()
+        processed = [0] * threads
+
+        def work(index):
+            worker_id = f"{prefix}:{index}"
+            try:
+                while not stop.is_set():
+                    close_old_connections()
+                    ran = jobs.run_pending(worker_id, limit=options['batch_size'])
+                    if index == 0 and not options['no_callbacks']:
+                        ran += callbacks.process_pending()
+                    processed[index] += ran
+                    if not ran:
+                        if options['once']:
+                            return
+                        stop.wait(options['poll_interval'])
+            finally:
+                connection.close()
+
+        self.stdout.write(f"Payment worker {prefix} started with {threads} thread(s).")
+        workers = [threading.Thread(target=work, args=(i,), daemon=True) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        try:
+            while any(worker.is_alive() for worker in workers):
+                time.sleep(0.2)
+        except KeyboardInterrupt:
+            # Let each thread finish the batch it has claimed
+            stop.set()
+            for worker in workers:
+                worker.join()
+        self.stdout.write(f"Processed {sum(processed)} job(s).")
@@ -0,0 +1,50 @@
+# Generated by Django 6.0 on 2026-10-18 11:20
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def clear_duplicate_checkout_ids(apps, schema_editor):
+    # Keep the checkout id on the newest payment; older duplicates can't be matched reliably
+    Payment = apps.get_model('payments', 'Payment')
+    duplicates = (
+        Payment.objects.exclude(checkout_request_id__isnull=True)
+        .values('checkout_request_id').annotate(n=Count('id')).filter(n__gt=1)
+        .values_list('checkout_request_id', flat=True)
+    )
+    for checkout_id in list(duplicates):
+        keep = Payment.objects.filter(checkout_request_id=checkout_id).order_by('-id').values_list('id', flat=True)[0]
+        Payment.objects.filter(checkout_request_id=checkout_id).exclude(id=keep).update(checkout_request_id=None)
+    Payment.objects.filter(checkout_request_id='').update(checkout_request_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0003_paymentjob'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_checkout_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='payment',
+            name='checkout_request_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.CreateModel(
+            name='CallbackInbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('checkout_request_id', models.CharField(max_length=100, unique=True)),
+                ('payload', models.JSONField()),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.CharField(blank=True, max_length=255)),
+            ],
+            options={
+                'verbose_name_plural': 'callback inbox',
+                'ordering': ['pk'],
+                'indexes': [models.Index(fields=['processed_at', 'id'], name='payments_inbox_pending_idx')],
+            },
+        ),
+    ]
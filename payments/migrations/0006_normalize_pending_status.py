@@ -0,0 +1,20 @@
+# Generated by Django 6.0 on 2026-10-19 09:45
+
+from django.db import migrations
+
+
+def normalize_pending(apps, schema_editor):
+    # loops.views.purchase_loop used to write "PENDING", which nothing else matches
+    Payment = apps.get_model('payments', 'Payment')
+    Payment.objects.filter(status='PENDING').update(status='Pending')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0005_reconciliation'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_pending, migrations.RunPython.noop),
+    ]
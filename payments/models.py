@@ -14,7 +14,7 @@ class Payment(models.Model):
     phone_number = models.CharField(max_length=15)
     amount = models.PositiveIntegerField()
     
-    checkout_request_id = models.CharField(max_length=100, blank=True, null=True)
+    checkout_request_id = models.CharField(max_length=100, blank=True, null=True, unique=True)
     merchant_request_id = models.CharField(max_length=100, blank=True, null=True)
     receipt_number = models.CharField(max_length=100, blank=True, null=True)
     
@@ -23,6 +23,82 @@ class Payment(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'id'], name='payments_status_id_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.loop.title} - {self.status}"
+
+
+class PaymentJob(models.Model):
+    """
+    A unit of gateway work (e.g. an STK push) queued by the web process and
+    carried out by ``manage.py run_payment_worker``.
+    """
+    KIND_STK_PUSH = 'stk_push'
+    KIND_CHOICES = [
+        (KIND_STK_PUSH, 'STK push'),
+    ]
+
+    STATUS_CHOICES = [
+        ('Queued', 'Queued'),
+        ('Running', 'Running'),
+        ('Done', 'Done'),
+        ('Failed', 'Failed'),
+    ]
+
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name='jobs')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, default=KIND_STK_PUSH)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='Queued')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField()
+    locked_by = models.CharField(max_length=64, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['run_after', 'pk']
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='payments_job_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} for payment {self.payment_id} - {self.status}"
+
+
+class CallbackInbox(models.Model):
+    """
+    M-Pesa callbacks as received, one row per CheckoutRequestID. The callback
+    view only inserts here; ``payments.callbacks.process_batch`` applies them.
+    """
+    checkout_request_id = models.CharField(max_length=100, unique=True)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    error = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        ordering = ['pk']
+        verbose_name_plural = 'callback inbox'
+        indexes = [
+            models.Index(fields=['processed_at', 'id'], name='payments_inbox_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.checkout_request_id} - {'processed' if self.processed_at else 'pending'}"
+
+
+class ReconciliationCheckpoint(models.Model):
+    """How far a ``reconcile_payments`` run has got, so it can resume after a restart."""
+    name = models.CharField(max_length=50, unique=True)
+    last_payment_id = models.BigIntegerField(default=0)
+    checked = models.PositiveIntegerField(default=0)
+    resolved = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} at payment {self.last_payment_id}"
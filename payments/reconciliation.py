@@ -0,0 +1,117 @@
+"""
+Settle payments whose M-Pesa callback never arrived.
+
+``reconcile()`` walks stale Pending payments in primary-key order, asks
+Daraja for each one's outcome with an STK query (several at once, through
+the shared client and its cached token) and applies a whole page of
+answers in one transaction. After every page the position is saved in a
+``ReconciliationCheckpoint``, so an interrupted run picks up where it
+stopped; a run that reaches the end resets it for the next pass.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from loops import entitlements
+
+from .gateway import GatewayError, get_client
+from .models import Payment, PaymentJob, ReconciliationCheckpoint
+
+# Daraja's STK query error code for "the customer hasn't answered yet"
+STILL_PROCESSING = '500.001.1001'
+# Client errors that say nothing about the payment itself: our credentials, or throttling
+RETRYABLE_STATUSES = {401, 403, 408, 429}
+
+
+def query_outcome(client, checkout_request_id):
+    """Return 'Success', 'Failed', or None if the outcome isn't known yet."""
+    try:
+        data = client.stk_query(checkout_request_id)
+    except GatewayError as exc:
+        status = getattr(exc, 'status_code', None)
+        if getattr(exc, 'error_code', None) == STILL_PROCESSING:
+            return None
+        if status is not None and 400 <= status < 500 and status not in RETRYABLE_STATUSES:
+            # Daraja rejected the query outright (e.g. an unknown CheckoutRequestID);
+            # asking again on every pass would never settle it
+            return 'Failed'
+        # Throttled, unreachable or a server error: try again on the next pass
+        return None
+    result_code = str(data.get('ResultCode', ''))
+    if result_code == '0':
+        return 'Success'
+    return 'Failed' if result_code else None
+
+
+def stale_page(after, cutoff, size):
+    return list(
+        Payment.objects.filter(status='Pending', created_at__lt=cutoff, pk__gt=after)
+        .order_by('pk').values('pk', 'checkout_request_id')[:size]
+    )
+
+
+def apply_outcomes(outcomes):
+    """Apply ``{payment_id: 'Success' | 'Failed'}``. Returns how many payments changed."""
+    succeeded = [pk for pk, outcome in outcomes.items() if outcome == 'Success']
+    failed = [pk for pk, outcome in outcomes.items() if outcome == 'Failed']
+    with transaction.atomic():
+        # A callback may have settled some of these since the page was read
+        won = list(
+            Payment.objects.filter(pk__in=succeeded, status='Pending').values_list('pk', 'user_id', 'loop_id')
+        )
+        Payment.objects.filter(pk__in=[pk for pk, _, _ in won]).update(status='Success')
+        entitlements.grant_many((user_id, loop_id) for _, user_id, loop_id in won)
+        changed = Payment.objects.filter(pk__in=failed, status='Pending').update(status='Failed')
+    return len(won) + changed
+
+
+def expire_unsent(cutoff):
+    """Fail Pending payments that never got an STK push and have nothing queued to send one."""
+    active_job = PaymentJob.objects.filter(payment=OuterRef('pk'), status__in=['Queued', 'Running'])
+    return (
+        Payment.objects.filter(status='Pending', checkout_request_id__isnull=True, created_at__lt=cutoff)
+        .exclude(Exists(active_job))
+        .update(status='Failed')
+    )
+
+
+def reconcile(name='default', older_than=timedelta(minutes=10), batch_size=200, threads=4,
+              limit=None, restart=False, client=None, progress=None):
+    """
+    Run (or resume) a reconciliation pass. Stops early after ``limit``
+    payments, keeping the checkpoint so the next call carries on.
+    Returns the checkpoint.
+    """
+    client = client or get_client()
+    checkpoint, _ = ReconciliationCheckpoint.objects.get_or_create(name=name)
+    if restart or not checkpoint.last_payment_id:
+        checkpoint.last_payment_id = checkpoint.checked = checkpoint.resolved = 0
+        checkpoint.started_at = timezone.now()
+        checkpoint.save()
+
+    cutoff = timezone.now() - older_than
+    seen = 0
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while limit is None or seen < limit:
+            size = batch_size if limit is None else min(batch_size, limit - seen)
+            page = stale_page(checkpoint.last_payment_id, cutoff, size)
+            if not page:
+                checkpoint.last_payment_id = 0
+                checkpoint.save(update_fields=['last_payment_id', 'updated_at'])
+                break
+
+            sent = [row for row in page if row['checkout_request_id']]
+            results = pool.map(lambda row: query_outcome(client, row['checkout_request_id']), sent)
+            outcomes = {row['pk']: outcome for row, outcome in zip(sent, results) if outcome}
+
+            checkpoint.resolved += apply_outcomes(outcomes)
+            checkpoint.checked += len(page)
+            checkpoint.last_payment_id = page[-1]['pk']
+            checkpoint.save(update_fields=['last_payment_id', 'checked', 'resolved', 'updated_at'])
+            seen += len(page)
+            if progress:
+                progress(checkpoint)
+    return checkpoint
@@ -1,3 +1,299 @@
-from django.test import TestCase
+import json
+import threading
+import time
+from datetime import timedelta
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from learnloop.querybudget import QueryBudgetTestMixin
+from loops.models import Loop
+
+from . import callbacks, jobs, reconciliation
+from .fake_daraja import FakeDaraja
+from .gateway import DarajaClient, GatewayBusy, get_client, reset_client
+from .models import CallbackInbox, Payment, PaymentJob
+
+
+class DarajaClientTests(TestCase):
+    def setUp(self):
+        self.fake = FakeDaraja().start()
+        self.addCleanup(self.fake.stop)
+
+    def make_client(self, **kwargs):
+        options = dict(
+            base_url=self.fake.base_url, consumer_key='test-key', consumer_secret='test-secret',
+            shortcode='174379', passkey='passkey', callback_url='https://example.com/callback',
+        )
+        options.update(kwargs)
+        return DarajaClient(**options)
+
+    def push(self, client):
+        return client.stk_push('254700000000', 10, 'Loop-1', 'Test payment')
+
+    def test_token_is_fetched_once_for_concurrent_pushes(self):
+        client = self.make_client(max_concurrency=8)
+        threads = [threading.Thread(target=self.push, args=(client,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.fake.tokens_issued, 1)
+        self.assertEqual(len(self.fake.stk_pushes), 8)
+
+    def test_revoked_token_is_refreshed_and_retried(self):
+        client = self.make_client()
+        self.push(client)
+        self.fake.revoke_tokens()
+
+        response = self.push(client)
+
+        self.assertEqual(response['ResponseCode'], '0')
+        self.assertEqual(self.fake.tokens_issued, 2)
+
+    def test_bulkhead_rejects_when_full(self):
+        self.fake.latency = 0.5
+        client = self.make_client(max_concurrency=1, bulkhead_wait=0.05)
+        client.access_token()
+        slow = threading.Thread(target=self.push, args=(client,))
+        slow.start()
+        self.addCleanup(slow.join)
+        while not self.fake.requests or self.fake.requests[-1][0] != 'POST':
+            time.sleep(0.01)
+
+        with self.assertRaises(GatewayBusy):
+            self.push(client)
+
+    @override_settings(MPESA_CONSUMER_KEY='test-key', MPESA_CONSUMER_SECRET='', MPESA_PASSKEY='test-passkey')
+    def test_missing_credentials_are_improperly_configured(self):
+        reset_client()
+        self.addCleanup(reset_client)
+        with self.assertRaisesMessage(ImproperlyConfigured, 'MPESA_CONSUMER_SECRET'):
+            get_client()
+
+
+@override_settings(
+    QUERY_BUDGET_ENABLED=True, LOOP_VIEWS_BUFFERED=False,
+    MPESA_CONSUMER_KEY='test-key', MPESA_CONSUMER_SECRET='test-secret', MPESA_PASSKEY='test-passkey',
+)
+class PaymentQueueTests(TestCase):
+    def setUp(self):
+        self.fake = FakeDaraja().start()
+        self.addCleanup(self.fake.stop)
+        settings_override = override_settings(MPESA_API_BASE_URL=self.fake.base_url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        reset_client()
+        self.addCleanup(reset_client)
+
+        self.user = User.objects.create_user('buyer', password='password')
+        creator = User.objects.create_user('creator', password='password')
+        self.loop = Loop.objects.create(
+            title='Premium', description='d', content='c', creator=creator,
+            is_premium=True, price=50,
+        )
+        self.client.force_login(self.user)
+
+    def test_initiate_queues_push_without_calling_gateway(self):
+        response = self.client.post(reverse('payments:initiate', args=[self.loop.pk]), {'phone': '254700000000'})
+
+        payment = Payment.objects.get()
+        self.assertRedirects(response, reverse('payments:pending', args=[payment.pk]))
+        self.assertEqual(payment.jobs.get().status, 'Queued')
+        self.assertEqual(self.fake.requests, [])
+
+    def test_worker_sends_push_and_records_checkout_id(self):
+        payment = Payment.objects.create(user=self.user, loop=self.loop, phone_number='254700000000', amount=50)
+        jobs.enqueue_stk_push(payment)
+
+        self.assertEqual(jobs.run_pending('test-worker'), 1)
+
+        payment.refresh_from_db()
+        self.assertIn(payment.checkout_request_id, self.fake.stk_pushes)
+        self.assertEqual(payment.jobs.get().status, 'Done')
+        self.assertEqual(jobs.run_pending('test-worker'), 0)
+
+    def test_gateway_errors_are_retried_then_fail_payment(self):
+        self.fake.routes['/mpesa/stkpush/v1/processrequest'] = lambda payload: (503, {'errorMessage': 'down'})
+        payment = Payment.objects.create(user=self.user, loop=self.loop, phone_number='254700000000', amount=50)
+        job = jobs.enqueue_stk_push(payment)
+
+        for attempt in range(1, jobs.max_attempts() + 1):
+            PaymentJob.objects.filter(pk=job.pk).update(run_after=timezone.now())
+            self.assertEqual(jobs.run_pending('test-worker'), 1)
+            job.refresh_from_db()
+            self.assertEqual(job.attempts, attempt)
+
+        self.assertEqual(job.status, 'Failed')
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'Failed')
+
+    def test_status_reports_outcome(self):
+        payment = Payment.objects.create(
+            user=self.user, loop=self.loop, phone_number='254700000000', amount=50, status='Success',
+        )
+
+        response = self.client.get(reverse('payments:status', args=[payment.pk]), {'wait': 5})
+
+        self.assertEqual(response.json()['status'], 'Success')
+        self.assertEqual(response.json()['redirect'], reverse('loop_detail', args=[self.loop.pk]))
+
+    def test_status_is_private(self):
+        other = User.objects.create_user('other', password='password')
+        payment = Payment.objects.create(user=other, loop=self.loop, phone_number='254700000000', amount=50)
+
+        response = self.client.get(reverse('payments:status', args=[payment.pk]))
+
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(QUERY_BUDGET_ENABLED=True, LOOP_VIEWS_BUFFERED=False)
+class CallbackInboxTests(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', password='password')
+        self.loop = Loop.objects.create(
+            title='Premium', description='d', content='c', creator=self.user, is_premium=True, price=50,
+        )
+        self.payment = Payment.objects.create(
+            user=self.user, loop=self.loop, phone_number='254700000000', amount=50,
+            checkout_request_id='ws_CO_1',
+        )
+
+    def post_callback(self, checkout_id='ws_CO_1', result_code=0):
+        callback = {'CheckoutRequestID': checkout_id, 'ResultCode': result_code, 'ResultDesc': 'ok'}
+        if result_code == 0:
+            callback['CallbackMetadata'] = {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'RCT123'}]}
+        return self.client.post(
+            reverse('payments:mpesa_callback'),
+            data=json.dumps({'Body': {'stkCallback': callback}}),
+            content_type='application/json',
+        )
+
+    def test_callback_is_stored_and_acknowledged(self):
+        response = self.post_callback()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertWithinQueryBudget(response)
+        self.assertEqual(CallbackInbox.objects.count(), 1)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'Pending')
+
+    def test_retried_callbacks_grant_access_once(self):
+        for _ in range(3):
+            self.post_callback()
+
+        self.assertEqual(callbacks.process_pending(), 1)
+        self.assertEqual(callbacks.process_pending(), 0)
+
+        self.payment.refresh_from_db()
+        self.assertEqual((self.payment.status, self.payment.receipt_number), ('Success', 'RCT123'))
+        self.assertEqual(self.loop.is_purchased_by.count(), 1)
+
+    def test_failed_result_marks_payment_failed(self):
+        self.post_callback(result_code=1032)
+
+        callbacks.process_pending()
+
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'Failed')
+        self.assertFalse(self.loop.is_purchased_by.exists())
+
+    def test_unknown_checkout_waits_then_is_dropped(self):
+        self.post_callback(checkout_id='ws_CO_unknown')
+
+        self.assertEqual(callbacks.process_pending(), 0)
+        CallbackInbox.objects.update(received_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(callbacks.process_pending(), 1)
+        self.assertEqual(CallbackInbox.objects.get().error, 'No matching payment')
+
+    def test_malformed_callback_is_rejected(self):
+        response = self.client.post(
+            reverse('payments:mpesa_callback'), data='{"Body": {}}', content_type='application/json',
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CallbackInbox.objects.exists())
+
+
+@override_settings(MPESA_CONSUMER_KEY='test-key', MPESA_CONSUMER_SECRET='test-secret', MPESA_PASSKEY='test-passkey')
+class ReconciliationTests(TestCase):
+    def setUp(self):
+        self.fake = FakeDaraja().start()
+        self.addCleanup(self.fake.stop)
+        settings_override = override_settings(MPESA_API_BASE_URL=self.fake.base_url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        reset_client()
+        self.addCleanup(reset_client)
+
+        self.user = User.objects.create_user('buyer', password='password')
+        self.loop = Loop.objects.create(
+            title='Premium', description='d', content='c', creator=self.user, is_premium=True, price=50,
+        )
+        self.payments = [
+            Payment.objects.create(
+                user=self.user, loop=self.loop, phone_number='254700000000', amount=50,
+                checkout_request_id=f'ws_CO_{i}',
+            )
+            for i in range(6)
+        ]
+        Payment.objects.update(created_at=timezone.now() - timedelta(hours=1))
+        self.fake.results.update({'ws_CO_0': '0', 'ws_CO_1': '1032', 'ws_CO_3': '0', 'ws_CO_4': '1037'})
+
+    def statuses(self):
+        return list(Payment.objects.order_by('pk').values_list('status', flat=True))
+
+    def test_stale_payments_are_resolved(self):
+        checkpoint = reconciliation.reconcile(batch_size=4, threads=3)
+
+        self.assertEqual(
+            self.statuses(), ['Success', 'Failed', 'Pending', 'Success', 'Failed', 'Pending'],
+        )
+        self.assertEqual((checkpoint.checked, checkpoint.resolved, checkpoint.last_payment_id), (6, 4, 0))
+        self.assertTrue(self.loop.is_purchased_by.filter(pk=self.user.pk).exists())
+        # One shared token for every query
+        self.assertEqual(self.fake.tokens_issued, 1)
+
+    def test_rejected_queries_fail_the_payment(self):
+        self.fake.query_errors.update({
+            'ws_CO_2': (400, '400.002.02'), 'ws_CO_5': (429, '429.001.01'),
+        })
+        reconciliation.reconcile(batch_size=4)
+        self.assertEqual(
+            self.statuses(), ['Success', 'Failed', 'Failed', 'Success', 'Failed', 'Pending'],
+        )
+
+    def test_interrupted_run_resumes_from_checkpoint(self):
+        checkpoint = reconciliation.reconcile(batch_size=2, limit=2)
+        self.assertEqual(checkpoint.last_payment_id, self.payments[1].pk)
+        self.assertEqual(self.statuses()[3], 'Pending')
+
+        queried = len([r for r in self.fake.requests if 'stkpushquery' in r[1]])
+        checkpoint = reconciliation.reconcile(batch_size=2)
+
+        self.assertEqual(checkpoint.checked, 6)
+        self.assertEqual(self.statuses()[3], 'Success')
+        # The first two payments weren't queried again
+        self.assertEqual(len([r for r in self.fake.requests if 'stkpushquery' in r[1]]) - queried, 4)
+
+    def test_recent_payments_are_left_alone(self):
+        Payment.objects.filter(pk=self.payments[0].pk).update(created_at=timezone.now())
+
+        reconciliation.reconcile()
+
+        self.assertEqual(self.statuses()[0], 'Pending')
+
+    def test_unsent_payments_expire(self):
+        unsent = Payment.objects.create(user=self.user, loop=self.loop, phone_number='2547', amount=50)
+        queued = Payment.objects.create(user=self.user, loop=self.loop, phone_number='2547', amount=50)
+        jobs.enqueue_stk_push(queued)
+
+        reconciliation.expire_unsent(timezone.now() + timedelta(seconds=1))
+
+        unsent.refresh_from_db()
+        queued.refresh_from_db()
+        self.assertEqual((unsent.status, queued.status), ('Failed', 'Pending'))
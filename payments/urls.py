@@ -7,6 +7,8 @@ urlpatterns = [
     path("index/", views.index, name="index"),
     path("initiate/<int:loop_id>/", views.initiate_payment, name="initiate"),
     path("buy/<int:loop_id>/", views.initiate_payment, name="buy_loop"),  
+    path("pending/<int:payment_id>/", views.payment_pending, name="pending"),
+    path("status/<int:payment_id>/", views.payment_status, name="status"),
     path("success/", views.payment_success, name="success"),
     path("mpesa-callback/", views.mpesa_callback, name="mpesa_callback"),
 ]
@@ -1,30 +1,26 @@
 import json
-import requests
-import base64
-from datetime import datetime
+import logging
+import time
+from django.conf import settings
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
 from django.shortcuts import render, redirect, get_object_or_404
 from django.http import JsonResponse, HttpResponse
 from django.contrib.auth.decorators import login_required
+from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
 
-from .models import Payment
+from . import callbacks, jobs
+from .models import Payment, PaymentJob
+from learnloop.querybudget import query_budget_exempt
 from loops.models import Loop
+from loops import entitlements
 from django_daraja.mpesa.core import MpesaClient
 
+logger = logging.getLogger(__name__)
 
 
 
-"""
-============================
- M-PESA CONFIG (MOVE TO .env)
-============================
-"""
-MPESA_CONSUMER_KEY = "QIIabyOC4ZKYOKMHLfgZwGlHt7dzGJOBQbscF9hFMhPFvNKi"
-MPESA_CONSUMER_SECRET = "GilorS2HyArZGzfYGBS8rKDhi4yYHX5OswqdJl1fIvA6z1nGEDgw218GYrftpFbf"
-MPESA_SHORTCODE = "174379"
-MPESA_PASSKEY = "bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c919"
-CALLBACK_URL = 'https://api.darajambili.com/express-payment'
-
 
 def index(request):
     cl = MpesaClient()
@@ -39,12 +35,6 @@ def index(request):
 
 
 
-def get_mpesa_token():
-    url = "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
-    response = requests.get(url, auth=(MPESA_CONSUMER_KEY, MPESA_CONSUMER_SECRET))
-    return response.json().get("access_token")
-
-
 """
 ============================
  STEP 1: User clicks BUY
@@ -55,7 +45,7 @@ def buy_loop(request, loop_id):
     loop = get_object_or_404(Loop, pk=loop_id)
 
     # If already purchased → redirect
-    if request.user in loop.is_purchased_by.all():
+    if entitlements.has_access(request.user, loop):
         return redirect("loop_detail", pk=loop.pk)
 
     return redirect("initiate_payment", loop_id=loop.id)
@@ -72,73 +62,76 @@ def initiate_payment(request, loop_id):
     loop = get_object_or_404(Loop, pk=loop_id)
 
     if request.method == "POST":
-        cl = MpesaClient
         phone = request.POST.get("phone")
 
-        # CREATE PAYMENT RECORD
-        payment = Payment.objects.create(
-            user=request.user,
-            loop=loop,
-            phone_number=phone,
-            amount=loop.price,
-            status="Pending"
-        )
-
-        # Generate access token
-        access_token = get_mpesa_token()
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-
-        # Create password for M-Pesa
-        password = base64.b64encode(
-            (MPESA_SHORTCODE + MPESA_PASSKEY + timestamp).encode()
-        ).decode()
-
-        # STK PUSH URL
-        stk_url = "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
-
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        }
-
-        payload = {
-            "BusinessShortCode": MPESA_SHORTCODE,
-            "Password": password,
-            "Timestamp": timestamp,
-            "TransactionType": "CustomerPayBillOnline",
-            "Amount": int(loop.price),
-            "PartyA": phone,
-            "PartyB": MPESA_SHORTCODE,
-            "phone_number": phone,
-            "callback_url": "https://api.darajambili.com/express-payment",
-        
-            "account_reference": f"Loop-{loop.id}",
-            "transaction_desc": "Payment for Premium Loop Access"
-        }
-
-        # Send request
-        mpesa_response = requests.post(stk_url, json=payload, headers=headers).json()
-
-        payment.checkout_request_id = mpesa_response.get("CheckoutRequestID")
-        payment.merchant_request_id = mpesa_response.get("MerchantRequestID")
-        payment.save()
-        mpesa_client = MpesaClient()  
-        response = mpesa_client.stk_push(phone_number= phone,
-            callback_url='https://api.darajambili.com/express-payment',
-        
-            account_reference= f"Loop-{loop.id}",
-            transaction_desc= "Payment for Premium Loop Access",  
-            amount=loop.price)
-        
-        return HttpResponse(f"STK Push initiated. Response: {response}")
-    
-        return redirect("payment_success")
+        # CREATE PAYMENT RECORD and queue the STK push for the payment worker
+        with transaction.atomic():
+            payment = Payment.objects.create(
+                user=request.user,
+                loop=loop,
+                phone_number=phone,
+                amount=loop.price,
+                status="Pending"
+            )
+            jobs.enqueue_stk_push(payment)
+
+        return redirect("payments:pending", payment_id=payment.id)
     else:
 
      return render(request, "payments/initiate_payment.html", {"loop": loop})
 
 
 
+"""
+============================
+ STEP 2b: Wait for the customer to confirm on their phone
+============================
+"""
+@login_required
+def payment_pending(request, payment_id):
+    payment = get_object_or_404(Payment.objects.select_related("loop"), pk=payment_id, user=request.user)
+    return render(request, "payments/payment_pending.html", {"payment": payment})
+
+
+@query_budget_exempt
+@login_required
+def payment_status(request, payment_id):
+    """
+    Current state of a payment as JSON. With ``?wait=<seconds>`` the request
+    is held (long poll) until the payment leaves Pending or the wait runs out.
+    """
+    try:
+        wait = min(max(float(request.GET.get("wait", 0)), 0), settings.PAYMENT_STATUS_MAX_WAIT)
+    except ValueError:
+        wait = 0
+    deadline = time.monotonic() + wait
+
+    latest_job = PaymentJob.objects.filter(payment=OuterRef("pk")).order_by("-pk")
+    payments = Payment.objects.filter(user=request.user).annotate(
+        dispatch=Subquery(latest_job.values("status")[:1]),
+        last_error=Subquery(latest_job.values("last_error")[:1]),
+    ).only("id", "status", "loop_id")
+
+    while True:
+        payment = get_object_or_404(payments, pk=payment_id)
+        if payment.status != "Pending" or time.monotonic() >= deadline:
+            break
+        time.sleep(min(settings.PAYMENT_STATUS_POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+
+    data = {
+        "id": payment.id,
+        "status": payment.status,
+        "dispatch": payment.dispatch,
+        "done": payment.status != "Pending",
+    }
+    if payment.status == "Success":
+        data["redirect"] = reverse("loop_detail", args=[payment.loop_id])
+    elif payment.status == "Failed" and payment.dispatch == "Failed":
+        data["error"] = "We couldn't send the M-Pesa prompt. Please check the number and try again."
+    return JsonResponse(data)
+
+
+
 """
 ============================
  STEP 3: Success Page
@@ -156,37 +149,11 @@ def payment_success(request):
 """
 @csrf_exempt
 def mpesa_callback(request):
-    data = request.body.decode("utf-8")
-    mpesa_data = json.loads(data)
-
-    print("===== MPESA CALLBACK RECEIVED =====")
-    print(mpesa_data)
-
-    checkout_id = mpesa_data["Body"]["stkCallback"]["CheckoutRequestID"]
-    result_code = mpesa_data["Body"]["stkCallback"]["ResultCode"]
-
-    payment = Payment.objects.filter(checkout_request_id=checkout_id).first()
-
-    if not payment:
-        return HttpResponse(status=200)
-
-    if result_code == 0:
-        # PAYMENT SUCCESSFUL
-        payment.status = "Success"
-
-        # Extract receipt number
-        items = mpesa_data["Body"]["stkCallback"]["CallbackMetadata"]["Item"]
-        for item in items:
-            if item["Name"] == "MpesaReceiptNumber":
-                payment.receipt_number = item["Value"]
-
-        payment.save()
-
-        payment.loop.is_purchased_by.add(payment.user)
-
-    else:
-        # PAYMENT FAILED
-        payment.status = "Failed"
-        payment.save()
+    # Store and acknowledge straight away; the payment worker applies it
+    try:
+        callbacks.receive(json.loads(request.body))
+    except (ValueError, callbacks.MalformedCallback):
+        logger.warning("Ignoring malformed M-Pesa callback: %r", request.body[:500])
+        return HttpResponse(status=400)
 
     return HttpResponse(status=200)